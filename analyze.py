@@ -19,7 +19,115 @@ from globus_compute_sdk import Client
 # Registered as: 62f120cd-9249-4124-b9df-44f8e1c44fe1
 
 
-def analyze(endpoint_id, input_path, output_path):
+def callback_part(input_path, output_path, run, part, segs, warm=False):
+    """Callback function to sort a group of consecutive segments as one part 
+    of a parallel analysis.
+
+    Parameters
+    ----------
+    input_path : str
+        Path to input converted files, mounted at /input in the image.
+    output_path : str
+        Path to output partial sorted files, mounted at /output in the image.
+    run : int
+        Run number to analyze.
+    part : int
+        Part number, which orders the parts when they are merged.
+    segs : list of int
+        Consecutive segment numbers to sort in this part.
+    warm : bool
+        Run the job script in this block's warm container worker, starting 
+        it if necessary, rather than in a new shifter container 
+        (default=False).
+
+    Returns
+    -------
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
+
+    """
+    if warm:
+        import sys
+        sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+        from container_worker import run_warm
+        return run_warm(
+            "analyze",
+            "/global/homes/c/chester/globus_flows/run_compute_analyze_part.sh",
+            [run, part] + list(segs),
+            {"INPUT_DIR": input_path, "OUTPUT_DIR": output_path}
+        )
+
+    import time
+    import subprocess
+    start = time.time()
+    p = subprocess.run(
+        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=1000G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_analyze_part.sh {run} {part}".split() + [str(s) for s in segs],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    return (
+        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8"),
+        time.time() - start
+    )
+
+
+def callback_merge(input_path, output_path, run, warm=False):
+    """Callback function to merge the parts of a parallel analysis into the 
+    sorted output of the run.
+
+    Parameters
+    ----------
+    input_path : str
+        Path to input partial sorted files, mounted at /input in the image.
+    output_path : str
+        Path to output analyzed files, mounted at /output in the image.
+    run : int
+        Run number to merge.
+    warm : bool
+        Run the job script in this block's warm container worker, starting 
+        it if necessary, rather than in a new shifter container 
+        (default=False).
+
+    Returns
+    -------
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
+
+    """
+    if warm:
+        import sys
+        sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+        from container_worker import run_warm
+        return run_warm(
+            "merge",
+            "/global/homes/c/chester/globus_flows/run_compute_merge.sh",
+            [run],
+            {"INPUT_DIR": input_path, "OUTPUT_DIR": output_path}
+        )
+
+    import time
+    import subprocess
+    start = time.time()
+    p = subprocess.run(
+        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=1000G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_merge.sh {run}".split(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    return (
+        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8"),
+        time.time() - start
+    )
+
+
+def analyze(
+        endpoint_id, input_path, output_path, force=False, warm=False,
+        parallel=False, segments_per_task=1, part_callback_id=None,
+        merge_callback_id=None
+):
     """Registered function to analyze data with the Liddick group betasort.
 
     Parameters
@@ -30,24 +138,58 @@ def analyze(endpoint_id, input_path, output_path):
         Input data path contining the files to analyze.
     output_path : str
         Output path for analyzed data.
+    force : bool
+        Analyze the run even if its output is current in the manifest of 
+        the output path (default=False).
+    warm : bool
+        Run the analysis in a warm container worker on its node, which 
+        sets up the container once per block rather than once per run 
+        (default=False).
+    parallel : bool
+        Sort groups of consecutive segments as separate tasks across the 
+        endpoint's blocks and merge their outputs with hadd, rather than 
+        sorting the whole run in one task. Betasort only correlates events 
+        within a group, so correlations which span the boundary between 
+        two groups are lost. Requires part_callback_id and 
+        merge_callback_id (default=False).
+    segments_per_task : int
+        Number of consecutive segments sorted by each task of a parallel 
+        analysis. Larger groups lose fewer correlations at the group 
+        boundaries, smaller groups finish sooner (default=1).
+    part_callback_id, merge_callback_id : str, str
+        UUIDs of callback_part and callback_merge, registered with 
+        --register-part-callback and --register-merge-callback. Required 
+        for a parallel analysis (default=None).
 
     Throws
     ------
     RuntimeError
-        No datafiles found in the input path.
+        No datafiles found in the input path, a part or the merge failed 
+        on every attempt or a parallel analysis is requested without the 
+        callback UUIDs.
 
     Returns
     -------
-    tuple : int, str, str
-        (returncode, stdout, stderr). (0, "", "") if success.
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
 
     """
     import os
+    import sys
+    import time
+    import shutil
     import fnmatch
     from globus_compute_sdk import Executor
     import concurrent.futures
+
+    # Shared helpers installed with the job scripts:
+    sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+    from batch_results import run_batch
+    from globus_api import compute_client
+    from manifest import Manifest, tool_version
     
-    def callback(input_path, output_path, run, nsegs):
+    def callback(input_path, output_path, run, nsegs, warm=False):
         """Callback function to run using the Executor.
 
         Parameters
@@ -60,6 +202,10 @@ def analyze(endpoint_id, input_path, output_path):
             Run number to analyze.
         nsegs : int
             Number of segments to include in the analysis.
+        warm : bool
+            Run the job script in this block's warm container worker, starting 
+            it if necessary, rather than in a new shifter container 
+            (default=False).
 
         Throws
         ------
@@ -68,11 +214,25 @@ def analyze(endpoint_id, input_path, output_path):
 
         Returns
         -------
-        tuple : int, str, str
-            (returncode, stdout, stderr). (0, "", "") if success.
+        tuple : int, str, str, float
+            (returncode, stdout, stderr, seconds the job script ran for). 
+            Returncode 0 if success.
 
         """
+        if warm:
+            import sys
+            sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+            from container_worker import run_warm
+            return run_warm(
+                "analyze",
+                "/global/homes/c/chester/globus_flows/run_compute_analyze.sh",
+                [run, nsegs],
+                {"INPUT_DIR": input_path, "OUTPUT_DIR": output_path}
+            )
+
+        import time
         import subprocess
+        start = time.time()
         p = subprocess.run(
             f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=1000G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_analyze.sh {run} {nsegs}".split(),
             stdout=subprocess.PIPE,
@@ -80,29 +240,83 @@ def analyze(endpoint_id, input_path, output_path):
         )
         
         return (
-            p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8")
+            p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8"),
+            time.time() - start
         ) 
 
     # Configure the job:
 
     run = os.path.basename(input_path).replace("run", "")
-    segments = len(fnmatch.filter(os.listdir(input_path), "*.root"))
+    roots = sorted(fnmatch.filter(os.listdir(input_path), "*.root"))
+    segments = len(roots)
 
     if segments == 0:
         raise RuntimeError(f"No event files in {input_path}!")
+
+    # The sorted output depends on every converted segment, so the run is
+    # analyzed again only if any of them has changed. The analyzed directory
+    # is shared by every run, so each run has its own manifest entry:
+    inputs = [os.path.join(input_path, f) for f in roots]
+    output = os.path.join(output_path, f"run-{int(run):04}-sorted.root")
+    key = f"run{int(run):04}"
+    manifest = Manifest(output_path, tool_version("analyze"))
+    if not force and not manifest.stale(key, inputs, output):
+        return (0, f"{output} is current", "", 0.0)
     
     # Run the function:
-    
-    with Executor(endpoint_id=endpoint_id) as gce:
-        future = gce.submit(
-            callback, input_path, output_path, run, segments
+
+    start = time.time()
+    if parallel:
+        if not (part_callback_id and merge_callback_id):
+            raise RuntimeError("No parallel analysis callback UUIDs given!")
+
+        # Sort each group of consecutive segments as one part, in a hidden
+        # directory so that parts left by a failed attempt are not merged:
+        nums = [int(f.split("-")[2]) for f in roots]
+        k = max(segments_per_task, 1)
+        groups = [tuple(nums[i:i + k]) for i in range(0, len(nums), k)]
+        parts_path = os.path.join(output_path, f".parts-run{int(run):04}")
+        shutil.rmtree(parts_path, ignore_errors=True)
+        os.makedirs(parts_path) # Must exist to mount it.
+
+        gcc = compute_client()
+        kwargs = {"warm": True} if warm else None
+        run_batch(
+            gcc, endpoint_id, part_callback_id,
+            {
+                g: (input_path, parts_path, run, p, list(g))
+                for p, g in enumerate(groups)
+            },
+            kwargs=kwargs
+        )
+        results = run_batch(
+            gcc, endpoint_id, merge_callback_id,
+            {"merge": (parts_path, output_path, run)}, kwargs=kwargs
         )
-        # Must handle results inside the `with` statement before implicit
-        # invocation of `.shutdown()`.
-        result = future.result()
+        result = tuple(next(iter(results.values()))["result"])
+        shutil.rmtree(parts_path, ignore_errors=True)
+    else:
+        with Executor(endpoint_id=endpoint_id) as gce:
+            future = gce.submit(
+                callback, input_path, output_path, run, segments, warm=warm
+            )
+            # Must handle results inside the `with` statement before implicit
+            # invocation of `.shutdown()`.
+            result = future.result()
 
     if result[0] != 0:
         raise RuntimeError(f"ERROR: {result}")
+
+    # Only a complete analysis is recorded as current. The job scripts exit
+    # non-zero if any step fails, and the sorted output must be in place:
+    if not os.path.exists(output):
+        raise RuntimeError(f"ERROR: {output} was not written: {result}")
+
+    # The callback times the job script. For a parallel analysis this is
+    # the time for all parts and the merge, including their queue time:
+    runtime = time.time() - start if parallel else result[3]
+    manifest.record(key, inputs, output, runtime=runtime)
+    manifest.save()
             
     return result
 
@@ -118,6 +332,34 @@ def register_function():
     )
     
     return uuid    
+
+
+def register_part_callback():
+    """Register the parallel analysis part callback and return its UUID.
+
+    """
+    gcc = Client()
+    uuid = gcc.register_function(
+        callback_part, function_name="callback_analyze_part",
+        description="Callback to analyze a group of segments with betasort "
+        "as one part of a parallel analysis"
+    )
+
+    return uuid
+
+
+def register_merge_callback():
+    """Register the parallel analysis merge callback and return its UUID.
+
+    """
+    gcc = Client()
+    uuid = gcc.register_function(
+        callback_merge, function_name="callback_analyze_merge",
+        description="Callback to merge the parts of a parallel betasort "
+        "analysis with hadd"
+    )
+
+    return uuid
     
 
 def parse_args():
@@ -132,6 +374,16 @@ def parse_args():
         action="store_true",
         help="(Optional) Re-register the compute function."
     )
+    parser.add_argument(
+        "--register-part-callback",
+        action="store_true",
+        help="(Optional) Re-register the parallel analysis part callback."
+    )
+    parser.add_argument(
+        "--register-merge-callback",
+        action="store_true",
+        help="(Optional) Re-register the parallel analysis merge callback."
+    )
 
     return parser.parse_args()
 
@@ -144,3 +396,9 @@ if __name__ == "__main__":
     if (args.register):
         uuid = register_function()
         print(f"Betasort analysis function UUID: {uuid}")
+    if args.register_part_callback:
+        uuid = register_part_callback()
+        print(f"Part callback function UUID: {uuid}")
+    if args.register_merge_callback:
+        uuid = register_merge_callback()
+        print(f"Merge callback function UUID: {uuid}")
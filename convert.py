@@ -19,7 +19,7 @@ from globus_compute_sdk import Client
 # Registered as: 2be66611-af61-4a9e-a0b2-3407675771c7
 
 
-def callback(input_path, output_path, run, seg):
+def callback(input_path, output_path, run, seg, warm=False):
     """Callback function to run using the Executor.
 
     Parameters
@@ -30,8 +30,14 @@ def callback(input_path, output_path, run, seg):
         Path to output converted files, mounted at /output in the image.
     run : int
         Run number to analyze.
-    seg : int
-        Number of segments in the run.
+    seg : int or list of int
+        Segment number to convert. If a list, the segments are converted in 
+        turn, copying the next segment to node-local /tmp while the current 
+        one is converted.
+    warm : bool
+        Run the job script in this block's warm container worker, starting 
+        it if necessary, rather than in a new shifter container 
+        (default=False).
 
     Throws
     ------
@@ -40,23 +46,43 @@ def callback(input_path, output_path, run, seg):
 
     Returns
     -------
-    tuple : int, str, str
-        (returncode, stdout, stderr). (0, "", "") if success.
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
     
     """
+    segs = seg if isinstance(seg, list) else [seg]
+    if warm:
+        import sys
+        sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+        from container_worker import run_warm
+        return run_warm(
+            "convert",
+            "/global/homes/c/chester/globus_flows/run_compute_convert.sh",
+            [run] + segs,
+            {"INPUT_DIR": input_path, "OUTPUT_DIR": output_path}
+        )
+
+    import time
     import subprocess
+    start = time.time()
     p = subprocess.run(
-        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=1000G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_convert.sh {run} {seg}".split(),
+        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=1000G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_convert.sh {run}".split() + [str(s) for s in segs],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE
     )
     
     return (
-        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8")
+        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8"),
+        time.time() - start
     )  
 
 
-def convert(endpoint_id, input_path, output_path):
+def convert(
+        endpoint_id, input_path, output_path, segments=None, max_attempts=3,
+        retry_delay=30, force=False, warm=False, segments_per_task=1,
+        callback_id=None
+):
     """Registered function for converting fitted dat to ROOT format.
 
     Parameters
@@ -67,61 +93,122 @@ def convert(endpoint_id, input_path, output_path):
         Input data path contining the files to convert.
     output_path : str
         Output path for fitted data.
+    segments : list of int
+        Segment numbers to convert. If None, convert every segment in the 
+        input path; if empty, there is nothing to convert (default=None).
+    max_attempts : int
+        Maximum attempts for each segment. A failed segment is resubmitted 
+        on its own, e.g. after a node failure or walltime kill (default=3).
+    retry_delay : float
+        Seconds before a failed segment is first resubmitted, doubling for 
+        each further attempt (default=30).
+    force : bool
+        Convert every segment, even if its output is current in the 
+        manifest of the output path (default=False).
+    warm : bool
+        Run each segment in a warm container worker on its node, which 
+        sets up the container and environment once per block rather than 
+        once per segment. Requires callback_id (default=False).
+    segments_per_task : int
+        Number of segments converted in turn by each task, copying the next 
+        segment's input to the node while the current one is converted. 
+        Requires callback_id (default=1).
+    callback_id : str
+        UUID of the conversion callback, registered with 
+        --register-callback. The original registration, used if None, 
+        takes neither the warm keyword nor a list of segments 
+        (default=None).
 
     Throws
     ------
     RuntimeError
-        No datafiles found in the input path.
+        No datafiles found in the input path, or a segment failed on every 
+        attempt.
 
     Returns
     -------
     dict
-        A dict of tuple objects returned from the callback function, keyed 
-        by task ID: (returncode, stdout, stderr). (0, "", "") if success.
+        A dict of task results, keyed by task ID. Each holds the tuple 
+        returned from the callback function under "result": (returncode, 
+        stdout, stderr), (0, "", "") if success, the task's queue and run 
+        times under "timing", the tuple of its segment numbers under 
+        "task", its position in the largest-first submission order under 
+        "order" and the attempts made under "attempts". Empty if every 
+        segment is current.
 
     """
     import os
+    import sys
     import fnmatch
-    import time
-    
-    from globus_compute_sdk import Client
+
+    # Shared helpers installed with the job scripts:
+    sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+    from batch_results import (
+        run_batch, largest_first, chunk_tasks, failed_segments
+    )
+    from globus_api import compute_client
+    from manifest import Manifest, tool_version
 
     # Configure the job:
 
     run = os.path.basename(input_path).replace("run", "")
-    segments = len(fnmatch.filter(os.listdir(input_path), "*.evt"))
-
-    if segments == 0:
-        raise RuntimeError(f"No event files in {input_path}!")
-
-    gcc = Client()
-    function_id = "8ca70c9d-887e-421e-939e-8caa223f44d7" # callback
-    batch = gcc.create_batch()
-    for s in range(segments):
-        batch.add(
-            function_id=function_id, args=(input_path, output_path, run, s)
+    if segments is None:
+        nevt = len(fnmatch.filter(os.listdir(input_path), "*.evt"))
+        if nevt == 0:
+            raise RuntimeError(f"No event files in {input_path}!")
+        segments = range(nevt)
+    elif len(segments) == 0:
+        return {} # Nothing to do for this flow run.
+
+    # Convert only the segments whose outputs are missing or out of date:
+    manifest = Manifest(output_path, tool_version("convert"))
+    files = {}
+    for s in segments:
+        name = f"run-{int(run):04}-{s:02}-fitted"
+        files[s] = (
+            [os.path.join(input_path, f"{name}.evt")],
+            os.path.join(output_path, f"{name}.root")
         )
-
-    batch_res = gcc.batch_run(endpoint_id=endpoint_id, batch=batch)
-    results = gcc.get_batch_result(batch_res["tasks"][function_id])
-        
-    def check_status(res):
-        for k, v in res.items():
-            if not "completion_t" in v:
-                return False
-        return True
-            
-    while not check_status(results):
-        time.sleep(10)
-        results = gcc.get_batch_result(batch_res["tasks"][function_id])
+    if not force:
+        segments = [s for s in segments if manifest.stale(s, *files[s])]
+        if not segments:
+            return {} # Every segment is current.
+
+    # Start the largest segments first to shorten the tail of the batch, and
+    # group them into chunks converted in turn by one task each:
+    segments = largest_first({s: files[s][0][0] for s in segments})
+    chunks = chunk_tasks(segments, segments_per_task)
+
+    # The job script reports the failed segments of a chunk, so the rest
+    # are recorded and only the failed ones retried:
+    def task_args(c):
+        return (input_path, output_path, run, list(c) if len(c) > 1 else c[0])
+
+    # Record each task's outputs as soon as it succeeds, so that they are
+    # kept even if another segment fails on every attempt:
+    def record(v):
+        # The runtime timed by the callback, or the poll-derived run time
+        # for callbacks which do not time the job script:
+        run_s = v["timing"]["task_s"]
+        if run_s is None:
+            run_s = v["timing"]["run_s"]
+        for s in v["task"]:
+            runtime = run_s/len(v["task"]) if run_s else None
+            manifest.record(s, *files[s], runtime=runtime)
+        manifest.save()
+
+    gcc = compute_client()
+    function_id = callback_id or "8ca70c9d-887e-421e-939e-8caa223f44d7"
+    results = run_batch(
+        gcc, endpoint_id, function_id, {c: task_args(c) for c in chunks},
+        max_attempts=max_attempts, retry_delay=retry_delay,
+        kwargs={"warm": True} if warm else None,
+        split=failed_segments, task_args=task_args, on_result=record
+    )
 
     if not results:
         raise RuntimeError("Batch results dictionary is empty!")
-        
-    for k, v in results.items():
-        if v["result"][0] != 0:
-            raise RuntimeError(f"ERROR: {v['result']}")    
-                                           
+    
     return results
 
 
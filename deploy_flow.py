@@ -10,6 +10,7 @@ import argparse
 import json
 
 from flows_service import create_flows_client
+from flow_definition import build_definition
 
 
 def deploy_flow():
@@ -24,13 +25,17 @@ def deploy_flow():
     args = parse_args()
     fc = create_flows_client()
 
-    # Get flow and input schema definitions
-    with open(args.flowdef, "r") as f:
-        flow_def = f.read()
-
+    # Get flow and input schema definitions. Generated definitions are
+    # built from the pipeline description in flow_definition.py:
     with open(args.schema, "r") as f:
         schema = f.read()
 
+    if args.generate:
+        flow_def = json.dumps(build_definition())
+    else:
+        with open(args.flowdef, "r") as f:
+            flow_def = f.read()
+
     if args.flowid:
         # Assume we're updating an existing flow
         flow_id = args.flowid
@@ -64,8 +69,14 @@ def parse_args():
     )
     parser.add_argument(
         "--flowdef",
-        required=True,
-        help="Name of file containing the flow definition.",
+        help="Name of file containing the flow definition. Required unless "
+        "--generate is given.",
+    )
+    parser.add_argument(
+        "--generate",
+        action="store_true",
+        help="Deploy the analysis pipeline flow definition generated by "
+        "flow_definition.py rather than reading --flowdef.",
     )
     parser.add_argument(
         "--schema",
@@ -82,7 +93,11 @@ def parse_args():
     )
     parser.set_defaults(verbose=True)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.flowdef and not args.generate:
+        parser.error("one of --flowdef or --generate is required")
+
+    return args
 
 
 if __name__ == "__main__":
@@ -8,15 +8,27 @@
 #
 
 import os
+import re
 import sys
 import time
+import heapq
+import fnmatch
+import itertools
+import collections
 import logging
 logging.basicConfig(
     level=logging.INFO,
     format="%(levelname)s - %(asctime)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 )
+import weakref
 import threading
+import concurrent.futures
+
+
+# rsync writes each file to a hidden temporary file, .name.XXXXXX, in the
+# destination directory and renames it once the file is complete:
+RSYNC_TEMP = re.compile(r"^\.(?P<name>.+)\.[A-Za-z0-9]{6}$")
 
 
 class DirectoryTrigger:
@@ -26,51 +38,222 @@ class DirectoryTrigger:
 
     Attributes
     ----------
-    watch_dir : str
-        The top-level directory to watch for the appearence of run dirs.
+    watch_dirs : list of str
+        The top-level directories to watch for the appearence of run dirs.
     delay : int
-        Seconds to potentially delay the trigger to start the flow. All files 
-        in the input directory must be older than trigger_delay seconds.
+        Seconds the contents of a run directory must be unchanged before the 
+        run is complete and the flow is triggered.
     FlowRunner : function
         Callback function to run when an event is observed.
+    patterns : list of str
+        Shell-style patterns matched against run directory names.
+    interval : float
+        Seconds between cheap checks of the watch directory mtimes.
+    rescan : float
+        Seconds between full rescans of each watch directory, regardless of 
+        whether its mtime has changed.
+    max_backoff : float
+        Upper limit in seconds on the readiness polling interval of a 
+        pending run directory.
+    SegmentRunner : function
+        Callback function to run for each finished run segment. If set, the 
+        watcher runs in streaming mode.
+    on_new : function
+        Callback function to run as soon as a new run directory appears.
+    segment_pattern : str
+        Shell-style pattern matched against run segment file names.
+    journal : RunJournal
+        Persistent journal of seen and triggered run directories.
+    backfill_limit : int
+        Maximum number of concurrent flow launches for backfilled runs.
+    pool : LaunchPool
+        Worker pool which launches the segment and run callbacks.
+    detector : CompletionDetector
+        Decides when a run directory has finished copying in.
+    batch_window : float
+        Seconds a ready run is held so that runs becoming ready together 
+        are launched together.
+    idle_timeout : float
+        Seconds after which a pending run directory whose contents have not 
+        changed, but which is not complete, no longer counts as busy.
 
     Methods
     -------
     run
         Run the watcher and handle events.
-    flow_thread
-        Waits for data to copy in and runs a flow from within a daemon thread.
+    scan
+        Return paths of run directories which appeared since the last scan.
+    found
+        Run the on_new callback for a newly found run directory.
+    schedule
+        Queue a run directory for a readiness check.
+    backfill
+        Queue runs which were missed or left in flight while stopped.
+    check_pending
+        Check pending run directories which are due and trigger ready runs.
+    stream_segments
+        Launch the segment callback for each newly finished run segment.
+    trigger
+        Queue a flow launch in the launch pool.
+    submit
+        Queue a flow launch and journal the outcome of its flow run.
+    finished
+        Record the final state of a flow run in the journal.
+    flush_batch
+        Queue the held flow launches once the batching window closes.
+    copying_in
+        Return the number of run directories still copying in.
+    busy
+        Return True while more runs are known to be on their way.
+    list_files
+        Return the size and mtime of each file in a run directory.
+    forget
+        Drop the readiness and streaming state of a run directory.
 
     """
 
-    def __init__(self, watch_dir, delay, FlowRunner=None):
+    def __init__(
+            self, watch_dir, delay, FlowRunner=None, patterns=("run*",),
+            interval=5, rescan=300, max_backoff=60, SegmentRunner=None,
+            segment_pattern="run-*-*.evt", journal=None, backfill_limit=2,
+            pool=None, marker=None, batch_window=0, on_new=None,
+            idle_timeout=3600
+    ):
         """Constructor.
 
         Parameters
         ----------
-        watch_dir : str
-            The directory to watch for the appearence of a trigger file.
+        watch_dir : str | Iterable[str]
+            The directory or directories to watch for the appearence of new 
+            run directories.
         delay : int
-            Flow run start delay to account for copy-in to DTN. The pipeline 
-            input data directory and its contents must have a modification 
-            time older than the input delay.
+            Flow run start delay to account for copy-in to DTN. The sizes 
+            and mtimes of the files in the pipeline input data directory, 
+            and the directory mtime, must be unchanged for this many seconds 
+            with no rsync temporary files present.
         FlowRunner : function
             Callback function to run when the observer sees an event 
             (default=None).
+        patterns : Iterable[str]
+            Shell-style patterns a directory name must match to be treated 
+            as a run directory (default=("run*",)).
+        interval : float
+            Seconds between checks of the watch directory mtimes 
+            (default=5).
+        rescan : float
+            Seconds between forced full rescans of each watch directory, 
+            guarding against coarse or lagging directory mtimes on network 
+            filesystems (default=300).
+        max_backoff : float
+            Upper limit on the readiness polling interval of a pending run 
+            directory which is still copying in (default=60).
+        SegmentRunner : function
+            Callback function to run with the path of each finished run 
+            segment. If set, segments are streamed into the pipeline as they 
+            finish copying in and FlowRunner is called once the whole run 
+            has copied in and every segment callback has returned 
+            (default=None).
+        segment_pattern : str
+            Shell-style pattern a file name must match to be treated as a 
+            run segment in streaming mode (default="run-*-*.evt").
+        journal : RunJournal
+            Persistent journal of run directory states. If set, runs which 
+            appeared or were in flight while the watcher was stopped are 
+            triggered on startup (default=None).
+        backfill_limit : int
+            Maximum number of flow launches for backfilled runs which may 
+            be in progress at once (default=2).
+        pool : LaunchPool
+            Worker pool used to launch the segment and run callbacks. If 
+            None, a pool with the default limits is created (default=None).
+        marker : str
+            Name of a marker file which, once present in a run directory 
+            with no rsync temporary files, marks the run as complete without 
+            waiting for the delay (default=None).
+        batch_window : float
+            Seconds a ready run is held before its flow is launched while 
+            other run directories are still copying in, so that runs which 
+            become ready close together are launched together and their 
+            tasks share the endpoint blocks started for them. Held runs are 
+            launched as soon as no other run is pending. If 0, runs are 
+            launched as soon as they are ready (default=0).
+        on_new : function
+            Callback function run with the path of each new or backfilled 
+            run directory as soon as it is found, long before the run has 
+            copied in, e.g. to pre-warm the compute endpoints. It must not 
+            block the watcher; errors are logged and ignored 
+            (default=None).
+        idle_timeout : float
+            Seconds after which a pending run directory whose contents have 
+            not changed, but which is not complete, e.g. an empty directory 
+            or one with a leftover rsync temporary file, is treated as 
+            stalled. A stalled directory is still checked, and is triggered 
+            if it completes, but no longer counts as busy or holds a batch 
+            (default=3600).
 
         """
-        self.watch_dir = watch_dir
+        if isinstance(watch_dir, str):
+            watch_dir = [watch_dir]
+        self.watch_dirs = [os.path.abspath(d) for d in watch_dir]
         self.delay = delay
         self.FlowRunner = FlowRunner
+        self.patterns = list(patterns)
+        self.interval = interval
+        self.rescan = rescan
+        self.max_backoff = max_backoff
+        self.SegmentRunner = SegmentRunner
+        self.segment_pattern = segment_pattern
+        self.journal = journal
+        self.backfill_limit = backfill_limit
+        self.pool = pool if pool else LaunchPool()
+        self.detector = CompletionDetector(settle=delay, marker=marker)
+        self.batch_window = batch_window
+        self.on_new = on_new
+        self.idle_timeout = idle_timeout
+
+        # Per-root scan state: last seen directory mtime, time of the last 
+        # full listing and the set of run directories in that listing:
+        self._mtimes = {}
+        self._scanned = {}
+        self._seen = {}
+
+        # Readiness queue of pending run directories as (due, path) tuples 
+        # and the current polling interval of each pending directory:
+        self._pending = []
+        self._backoff = {}
+        self._stalled = set()
+
+        # Streaming mode state for each pending run directory: file sizes 
+        # and mtimes from the previous check, names of segments already 
+        # launched and the futures of their launches:
+        self._files = {}
+        self._streamed = {}
+        self._launches = {}
+
+        # Runs queued by backfill, whose launches share backfill_limit slots
+        # in the launch pool:
+        self._backfill = set()
+        self.pool.limit("backfill", backfill_limit)
+
+        # Flow launches held in the batching window, as (launch, priority, 
+        # after, group) tuples, and the time the window closes:
+        self._batch = []
+        self._batch_due = None
+
+        # Guards the pending, stalled and batch state, which busy reads
+        # from the endpoint warmer's thread:
+        self._lock = threading.RLock()
 
         
     def run(self):
-        """Monitor the watchdir and wait for events. New directories are found 
-        using the XOR of previously seen and current directory lists. When a 
-        new directory is found, a daemon thread is created to launch the flow. 
-        The thread waits for all the data to be copied into the directory by 
-        monitoring the modification times of the directory and its contents.
-        Directory status is checked every 5 minutes (300 seconds) by default.
+        """Monitor the watch directories and wait for events. Each watch 
+        directory's mtime is checked every `interval` seconds and the 
+        directory is only listed again when its mtime changes (or after 
+        `rescan` seconds). When a new run directory is found it is added 
+        to a single readiness queue. Pending directories are checked from 
+        this loop, with a polling interval which backs off while data is 
+        still copying in, and the flow launch is queued once the directory 
+        has finished copying in.
 
         """        
         logging.root.info("Watcher Started\n")
@@ -80,40 +263,323 @@ class DirectoryTrigger:
             logging.root.info("Using system print()")
             self.FlowRunner = print
 
-        if not os.path.isdir(self.watch_dir):
-            logging.root.error("ERROR: Watch directory does not exist!")
-            sys.exit(1)
+        for watch_dir in self.watch_dirs:
+            if not os.path.isdir(watch_dir):
+                logging.root.error(
+                    f"ERROR: Watch directory {watch_dir} does not exist!"
+                )
+                sys.exit(1)
 
         logging.root.info(
-            f"Monitoring: {self.watch_dir} with delay {self.delay}s\n"
+            f"Monitoring: {', '.join(self.watch_dirs)} for "
+            f"{', '.join(self.patterns)} with delay {self.delay}s, "
+            f"check interval {self.interval}s\n"
         )
+        if self.SegmentRunner:
+            logging.root.info(
+                f"Streaming segments matching {self.segment_pattern}\n"
+            )
 
-        # What's in the directory to begin with:
-        seen = {d for d in os.listdir(self.watch_dir) if d.startswith("run")}
+        # What's in the directories to begin with:
+        self.scan()
+        if self.journal:
+            self.backfill()
         
         # Look for new directories and start a flow run when a new directory
         # has copied in all its data:
         try:
             while True:
-                current = {
-                    d for d in os.listdir(self.watch_dir) if d.startswith("run")
-                }
-                new = seen ^ current # XOR
-                logging.root.debug(f"seen {seen} current {current} new {new}")
-                {threading.Thread(target=self.flow_thread,
-                                  args=(os.path.join(self.watch_dir, n),),
-                                  daemon=True).start() for n in new
-                 } if new else None
-                seen = current
-                time.sleep(300) # Check interval.
+                now = time.monotonic()
+                wait = self.interval
+                if self._pending:
+                    wait = min(wait, max(self._pending[0][0] - now, 0))
+                if self._batch:
+                    wait = min(wait, max(self._batch_due - now, 0))
+                time.sleep(wait) # Check interval.
+                for n in self.scan():
+                    logging.root.info(
+                        f"New run directory: {os.path.abspath(n)}, flow "
+                        f"will trigger when unchanged for {self.delay}s..."
+                    )
+                    if self.journal:
+                        self.journal.record(n, "seen")
+                    self.found(n)
+                    self.schedule(n)
+                self.check_pending()
+                self.flush_batch()
         except Exception as e:
             logging.root.error(f"ERROR: {e}")
         except:
             logging.root.info("Watcher stopped.")
 
+
+    def scan(self):
+        """Check each watch directory and return any run directories which 
+        have appeared since the previous call. A directory is only listed 
+        when its mtime has changed or its last full listing is older than 
+        `rescan` seconds, so an idle watch directory costs a single stat() 
+        per call.
+
+        Returns
+        -------
+        list of str
+            Paths of the new run directories, sorted by name.
+
+        """
+        new = []
+        now = time.monotonic()
+        for watch_dir in self.watch_dirs:
+            try:
+                mtime = os.stat(watch_dir).st_mtime_ns
+            except OSError as e:
+                logging.root.warning(f"Cannot stat {watch_dir}: {e}")
+                continue
+            
+            if (
+                    mtime == self._mtimes.get(watch_dir)
+                    and now - self._scanned.get(watch_dir, 0) < self.rescan
+            ):
+                continue
+
+            with os.scandir(watch_dir) as it:
+                current = {
+                    e.path for e in it if e.is_dir() and self.match(e.name)
+                }
+                
+            if watch_dir in self._seen:
+                new.extend(current - self._seen[watch_dir])
+            logging.root.debug(f"Rescanned {watch_dir}: {len(current)} runs")
+            
+            self._mtimes[watch_dir] = mtime
+            self._scanned[watch_dir] = now
+            self._seen[watch_dir] = current
+
+        return sorted(new)
+
+
+    def backfill(self):
+        """Queue run directories which appeared while the watcher was stopped, 
+        or which were pending or in flight when it stopped, according to the 
+        journal. Their flow launches are limited to `backfill_limit` at a 
+        time. If the journal is new, the current run directories are 
+        recorded as skipped instead.
+
+        """
+        current = sorted(set().union(*self._seen.values()))
+        if self.journal.is_empty():
+            logging.root.info(
+                f"New journal {self.journal.path}, skipping {len(current)} "
+                "existing run directories"
+            )
+            for path in current:
+                self.journal.record(path, "skipped")
+            return
+
+        states = self.journal.states()
+        for path in current:
+            state = states.get(path)
+            # A launched run has a flow run, which is not started again:
+            if state in ("launched", "completed", "skipped"):
+                continue
+            logging.root.info(
+                f"Backfilling run directory: {path} (state: {state})"
+            )
+            if state is None:
+                self.journal.record(path, "seen")
+            self._backfill.add(path)
+            self.found(path)
+            self.schedule(path)
+
+            
+    def match(self, name):
+        """Return True if a directory name matches any of the run patterns.
+
+        Parameters
+        ----------
+        name : str
+            Directory name.
+
+        Returns
+        -------
+        bool
+            True if the name matches one of the watched patterns.
+
+        """
+        return any(fnmatch.fnmatch(name, p) for p in self.patterns)
+
+            
+    def found(self, path):
+        """Run the on_new callback for a newly found run directory.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing the data files.
+
+        """
+        if not self.on_new:
+            return
+        try:
+            self.on_new(os.path.abspath(path))
+        except Exception as e:
+            logging.root.warning(f"New run callback failed for {path}: {e}")
+
+            
+    def schedule(self, path, wait=0):
+        """Queue a run directory for a readiness check.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing the data files.
+        wait : float
+            Seconds from now until the directory is checked (default=0).
+
+        """
+        with self._lock:
+            self._backoff.setdefault(path, self.interval)
+            heapq.heappush(self._pending, (time.monotonic() + wait, path))
+
+
+    def check_pending(self):
+        """Check every pending run directory which is due. Directories which 
+        the completion detector reports as complete are triggered; the rest 
+        are re-queued for when they could next be complete, doubling their 
+        polling interval up to `max_backoff` seconds each time. In streaming 
+        mode, finished segments of pending directories are launched as they 
+        are found. The lock is held throughout, so that busy does not see a 
+        directory as gone while it is being checked.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._pending and self._pending[0][0] <= now:
+                _, path = heapq.heappop(self._pending)
+                try:
+                    files = self.list_files(path)
+                    remaining = self.detector.check(
+                        path, files, os.stat(path).st_mtime
+                    )
+                except FileNotFoundError:
+                    logging.root.warning(
+                        f"{path} was removed before triggering"
+                    )
+                    self.forget(path)
+                    continue
+
+                ready = remaining == 0
+                if self.SegmentRunner and self.stream_segments(
+                        path, files, ready
+                ):
+                    self._backoff[path] = self.interval
+
+                if ready:
+                    self.trigger(path)
+                    self.forget(path)
+                    continue
+
+                idle = self.detector.idle(path)
+                if idle >= self.idle_timeout and path not in self._stalled:
+                    logging.root.warning(
+                        f"{path} unchanged for {idle:.0f}s but incomplete, "
+                        "no longer waiting on it"
+                    )
+                    self._stalled.add(path)
+                elif idle < self.idle_timeout and path in self._stalled:
+                    logging.root.info(f"{path} changed, waiting on it again")
+                    self._stalled.discard(path)
+
+                backoff = self._backoff[path]
+                logging.root.debug(
+                    f"{path} incomplete, wait for copy in, next check in "
+                    f"{max(remaining, backoff)}s..."
+                )
+                self.schedule(path, max(remaining, backoff))
+                self._backoff[path] = min(2*backoff, self.max_backoff)
+
+
+    def forget(self, path):
+        """Drop the readiness and streaming state of a run directory.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing the data files.
+
+        """
+        for state in (
+                self._backoff, self._files, self._streamed, self._launches
+        ):
+            state.pop(path, None)
+        self._backfill.discard(path)
+        self._stalled.discard(path)
+        self.detector.forget(path)
+        
+
+    def stream_segments(self, path, files, final=False):
+        """Queue the segment callback in the launch pool for each segment in a 
+        run directory which has finished copying in. A segment is 
+        finished when rsync has renamed its hidden temporary file to the 
+        segment name and its size and mtime are unchanged since the previous 
+        check.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing the data files.
+        files : dict
+            Current (size, mtime) of each file in the directory, keyed by name.
+        final : bool
+            The whole directory has copied in, so every segment is finished 
+            (default=False).
+
+        Returns
+        -------
+        bool
+            True if any segments were launched.
+
+        """
+        previous = self._files.get(path, {})
+        streamed = self._streamed.setdefault(path, set())
+        copying = self.detector.copying(files)
+        self._files[path] = files
+        
+        launched = False
+        for name in sorted(files):
+            if name in streamed:
+                continue
+            if not fnmatch.fnmatch(name, self.segment_pattern):
+                continue
+            if name in copying:
+                continue # rsync is still writing a new copy.
+            if not final and files[name] != previous.get(name):
+                continue # Size or mtime changed since the last check.
+            
+            segment = os.path.join(os.path.abspath(path), name)
+            logging.root.info(f"Segment finished: {segment}")
+            future = self.pool.submit(self.SegmentRunner, segment)
+            self._launches.setdefault(path, []).append(
+                self.pool.finished(future)
+            )
+            streamed.add(name)
+            launched = True
+
+        return launched
+
             
-    def flow_thread(self, path):
-        """Run a flow from within a daemon thread.
+    def trigger(self, path):
+        """Queue a flow launch in the launch pool. In streaming mode the 
+        launch is held in the queue until the run's segment flow runs have 
+        finished. 
+        Backfilled runs are queued behind runs found while watching, and 
+        only backfill_limit of them are dispatched at once, so a waiting 
+        backfilled run does not hold a pool worker. With a batching window, 
+        the launch is held until flush_batch.
+
+        The journal records the run as "triggered" when its launch starts 
+        and "launched", with the flow run ID, when the launch returns. Once 
+        the pool sees the flow run finish, it is recorded as "completed" if 
+        it succeeded and "failed" otherwise, see finished.
         
         Parameters
         ----------
@@ -121,25 +587,148 @@ class DirectoryTrigger:
             Path to the directory containing the data files.
 
         """
-        last_mtime = self.get_last_mtime(path)
-        logging.root.info(
-            f"New run directory: {os.path.abspath(path)} with mtime: "
-            f"{last_mtime}, flow will trigger when mtime > {self.delay}..."
+        logging.root.info(f"Triggered: {os.path.abspath(path)}")
+        launches = self._launches.pop(path, [])
+        backfill = path in self._backfill
+        self._backfill.discard(path)
+        
+        def run_flow():
+            if self.journal:
+                self.journal.record(path, "triggered")
+            try:
+                run_id = self.FlowRunner(os.path.abspath(path)) # Runs the flow
+            except:
+                if self.journal:
+                    self.journal.record(path, "failed")
+                raise
+            else:
+                if self.journal:
+                    self.journal.record(
+                        path, "launched",
+                        run_id if isinstance(run_id, str) else None
+                    )
+                    
+            return run_id
+            
+        group = "backfill" if backfill else None
+        if self.batch_window > 0:
+            if not self._batch:
+                self._batch_due = time.monotonic() + self.batch_window
+            self._batch.append(
+                (path, run_flow, int(backfill), launches, group)
+            )
+            return
+        
+        self.submit(path, run_flow, int(backfill), launches, group)
+
+
+    def submit(self, path, run_flow, priority, launches, group):
+        """Queue a flow launch in the launch pool, and have the journal 
+        record the outcome of its flow run once the run has finished.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing the data files.
+        run_flow : function
+            Launch callback.
+        priority : int
+            Launch priority, see LaunchPool.submit.
+        launches : list of concurrent.futures.Future
+            Futures which must be done before the launch is dispatched.
+        group : str
+            Launch group, see LaunchPool.submit.
+
+        """
+        future = self.pool.submit(
+            run_flow, priority=priority, after=launches, group=group
         )
-        while last_mtime < self.delay:
-            logging.root.debug(
-                f"last mtime: {last_mtime} < {self.delay}, wait for copy in..."
+        if self.journal:
+            self.pool.finished(future).add_done_callback(
+                lambda f: self.finished(path, future, f.result())
+            )
+
+
+    def finished(self, path, launch, status):
+        """Record the final state of a flow run in the journal. Runs whose 
+        launch failed were recorded when it raised. Without a flow run 
+        status, e.g. for a --dry-run or when the pool does not track flow 
+        runs, the run stays "launched".
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing the data files.
+        launch : concurrent.futures.Future
+            Future of the flow launch.
+        status : str
+            Final status of the flow run, or None if it is not known.
+
+        """
+        if launch.cancelled() or launch.exception() or status is None:
+            return
+
+        if status == "SUCCEEDED":
+            self.journal.record(path, "completed")
+        else:
+            logging.root.warning(f"Flow run for {path} ended {status}")
+            self.journal.record(path, "failed")
+
+
+    def flush_batch(self):
+        """Queue the flow launches held in the batching window once the 
+        window has closed, or as soon as no other run directory is still 
+        copying in, as nothing more is expected to join the batch.
+
+        """
+        with self._lock:
+            if not self._batch:
+                return
+            if self.copying_in() and time.monotonic() < self._batch_due:
+                return
+
+            logging.root.info(f"Launching {len(self._batch)} batched run(s)")
+            for path, run_flow, priority, launches, group in self._batch:
+                self.submit(path, run_flow, priority, launches, group)
+            self._batch = []
+            self._batch_due = None
+
+
+    def copying_in(self):
+        """Return the number of pending run directories which are not 
+        stalled.
+
+        Returns
+        -------
+        int
+            Number of run directories still copying in.
+
+        """
+        with self._lock:
+            return len({p for _, p in self._pending} - self._stalled)
+
+
+    def busy(self):
+        """Return True while more runs are known to be on their way: run 
+        directories are still copying in, or flow launches are held or 
+        queued. Stalled directories are not counted. Used to keep the 
+        compute endpoints warm.
+
+        Returns
+        -------
+        bool
+            True if any runs are copying in, held or queued.
+
+        """
+        with self._lock:
+            return bool(
+                self.copying_in() or self._batch or self.pool.queued()
             )
-            time.sleep(5)
-            last_mtime = self.get_last_mtime(path)
-        logging.root.info(f"Triggered: {os.path.abspath(path)}")
-        self.FlowRunner(os.path.abspath(path)) # Runs the flow
 
 
-    def get_last_mtime(self, path):
-        """Get the latest modification time for the directory specified by the 
-        path and and all files contained within it. This assumes that data is 
-        copied onto the DTN using rsync.
+    def list_files(self, path):
+        """Return the size and mtime of each file in a run directory. This 
+        assumes that data is copied onto the DTN using rsync.
 
         Parameters
         ----------
@@ -148,27 +737,424 @@ class DirectoryTrigger:
 
         Returns
         -------
-        float
-            Last mtime of the path: min of directory mtime and file(s) mtime.
+        dict
+            (st_size, st_mtime) tuples keyed by file name.
 
         """
         # The sych'd files are renamed, which may happen as we try to get
-        # their mtime, resulting in a FileNotFoundErrror. Catch it, log a
-        # warning and move on:
-        fmtimes = []
-        for f in os.scandir(path):
-            if f.is_file():
+        # their mtime, resulting in a FileNotFoundErrror. Expected for rsync
+        # temporary files, otherwise log a warning and move on. The DirEntry
+        # caches its stat() result so each file is stat'd only once per scan:
+        files = {}
+        with os.scandir(path) as it:
+            for f in it:
+                if f.is_file():
+                    try:
+                        st = f.stat()
+                    except FileNotFoundError as e:
+                        if not RSYNC_TEMP.match(f.name):
+                            logging.root.warning(f"{f.path} does not exist!")
+                    else:
+                        files[f.name] = (st.st_size, st.st_mtime)
+
+        return files
+
+
+class LaunchPool:
+    """Bounded pool of worker threads which launch flow runs. Launches are 
+    taken from a priority queue, first in first out within a priority, and 
+    dispatch pauses while the number of flow runs in flight reaches the 
+    limit. A launch is in flight while its callback is running and, if the 
+    callback returns a flow run ID and a status function is provided, until 
+    that flow run is no longer active. Each launch has a second future which 
+    is done once it is no longer in flight, so that a later launch can 
+    depend on earlier flow runs finishing without a worker waiting for 
+    them. Launches may belong to a group whose 
+    running callbacks are limited; a launch whose group is full is passed 
+    over at dispatch rather than holding a worker.
+
+    Attributes
+    ----------
+    max_inflight : int
+        Maximum number of flow runs in flight.
+    workers : int
+        Number of worker threads running launch callbacks.
+    run_statuses : function
+        Function returning the status of a list of flow run IDs.
+    poll : float
+        Seconds between checks of the in-flight flow runs.
+
+    Methods
+    -------
+    submit
+        Queue a launch callback.
+    finished
+        Return a future which is done once a launch is no longer in flight.
+    limit
+        Limit the number of running callbacks of a group.
+    inflight
+        Return the number of flow runs in flight.
+    queued
+        Return the number of launches waiting to be dispatched.
+
+    """
+
+    def __init__(self, max_inflight=4, workers=2, run_statuses=None, poll=60):
+        """Constructor. Starts the worker threads.
+
+        Parameters
+        ----------
+        max_inflight : int
+            Maximum number of flow runs in flight (default=4).
+        workers : int
+            Number of worker threads running launch callbacks (default=2).
+        run_statuses : function
+            Function which takes a list of flow run IDs and returns their 
+            status keyed by ID. If None, a launch is in flight only while 
+            its callback runs (default=None).
+        poll : float
+            Seconds between checks of the in-flight flow runs (default=60).
+
+        """
+        self.max_inflight = max_inflight
+        self.workers = workers
+        self.run_statuses = run_statuses
+        self.poll = poll
+        
+        self._cv = threading.Condition()
+        self._queue = [] # (priority, seq, fn, args, after, future, group)
+        self._seq = itertools.count()
+        self._running = 0
+        self._runs = {} # Finished future of each flow run in flight.
+        self._finished = weakref.WeakKeyDictionary()
+        self._limits = {}
+        self._groups = collections.Counter() # Running callbacks per group.
+
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        if run_statuses:
+            threading.Thread(target=self._track, daemon=True).start()
+
+            
+    def submit(self, fn, *args, priority=0, after=(), group=None):
+        """Queue a launch callback.
+
+        Parameters
+        ----------
+        fn : function
+            Launch callback, called as fn(*args).
+        priority : int
+            Launches with lower values are dispatched first (default=0).
+        after : Iterable[concurrent.futures.Future]
+            Futures which must be done before the launch is dispatched 
+            (default=()).
+        group : str
+            Group of the launch, see limit (default=None).
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future holding the return value of the callback.
+
+        """
+        future = concurrent.futures.Future()
+        self._finished[future] = concurrent.futures.Future()
+        after = tuple(after)
+        with self._cv:
+            heapq.heappush(
+                self._queue,
+                (priority, next(self._seq), fn, args, after, future, group)
+            )
+            self._cv.notify_all()
+        for f in after:
+            f.add_done_callback(self._wake)
+
+        return future
+
+
+    def finished(self, future):
+        """Return a future which is done once a launch is no longer in 
+        flight: its callback has returned and any flow run it launched is 
+        no longer active. Pass it as a dependency of a later launch to hold 
+        that launch until the flow run has finished.
+
+        Parameters
+        ----------
+        future : concurrent.futures.Future
+            Future returned by submit for the launch.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future holding the final status of the flow run, or None if the 
+            callback did not launch one, raised, or no status function is 
+            provided.
+
+        """
+        return self._finished[future]
+
+
+    def limit(self, group, n):
+        """Limit the number of running callbacks of a group. Queued launches 
+        of a full group wait in the queue, and launches behind them are 
+        dispatched first.
+
+        Parameters
+        ----------
+        group : str
+            Launch group.
+        n : int
+            Maximum number of callbacks of the group running at once.
+
+        """
+        with self._cv:
+            self._limits[group] = n
+            self._cv.notify_all()
+
+
+    def inflight(self):
+        """Return the number of flow runs in flight.
+
+        Returns
+        -------
+        int
+            Number of running launch callbacks and active flow runs.
+
+        """
+        with self._cv:
+            return self._running + len(self._runs)
+
+
+    def queued(self):
+        """Return the number of launches waiting to be dispatched.
+
+        Returns
+        -------
+        int
+            Number of queued launch callbacks.
+
+        """
+        with self._cv:
+            return len(self._queue)
+    
+        
+    def _wake(self, future=None):
+        """Wake the workers to re-check the queue."""
+        with self._cv:
+            self._cv.notify_all()
+
+            
+    def _next(self):
+        """Wait for a free slot and pop the first queued launch whose 
+        dependencies are done. Must be called with the condition held.
+
+        """
+        while True:
+            if self._running + len(self._runs) < self.max_inflight:
+                for item in sorted(self._queue, key=lambda i: i[:2]):
+                    group = item[6]
+                    if (
+                            group is not None
+                            and self._groups[group]
+                            >= self._limits.get(group, float("inf"))
+                    ):
+                        continue
+                    if all(f.done() for f in item[4]):
+                        self._queue.remove(item)
+                        heapq.heapify(self._queue)
+                        return item
+            self._cv.wait()
+
+            
+    def _work(self):
+        """Worker thread: run queued launch callbacks."""
+        while True:
+            with self._cv:
+                _, _, fn, args, _, future, group = self._next()
+                self._running += 1
+                self._groups[group] += 1
+            
+            result = None
+            if future.set_running_or_notify_cancel():
                 try:
-                    mtime = os.path.getmtime(f)
-                except FileNotFoundError as e:
-                    logging.root.warning(
-                        f"{f} does not exist! If it is a hidden file, "
-                        "ignore this warning as it likely has been renamed"
-                    )
+                    result = fn(*args)
+                except BaseException as e:
+                    logging.root.error(f"ERROR: Flow launch failed: {e}")
+                    future.set_exception(e)
                 else:
-                    fmtimes.append(mtime)
-        # The smallest of these is the latest mod time:
-        fmtime = min([time.time() - t for t in fmtimes]) if fmtimes else 0
-        dmtime = time.time() - os.path.getmtime(path)
+                    future.set_result(result)
+
+            finished = self._finished[future]
+            with self._cv:
+                self._running -= 1
+                self._groups[group] -= 1
+                if self.run_statuses and isinstance(result, str):
+                    self._runs[result] = finished
+                    finished = None
+                self._cv.notify_all()
+            if finished:
+                finished.set_result(None)
+
+                
+    def _track(self):
+        """Tracker thread: release slots of flow runs which have finished."""
+        while True:
+            time.sleep(self.poll)
+            with self._cv:
+                runs = list(self._runs)
+            if not runs:
+                continue
+            try:
+                statuses = self.run_statuses(runs)
+            except Exception as e:
+                logging.root.warning(f"Cannot check flow run status: {e}")
+                continue
+            done = {
+                r: statuses.get(r) for r in runs
+                if statuses.get(r) not in ("ACTIVE", "INACTIVE")
+            }
+            with self._cv:
+                finished = [(self._runs.pop(r), s) for r, s in done.items()]
+                logging.root.debug(
+                    f"{len(self._runs)} flow runs in flight, "
+                    f"{len(self._queue)} queued"
+                )
+                self._cv.notify_all()
+            for future, status in finished:
+                future.set_result(status)
+
+
+class CompletionDetector:
+    """Decide when a run directory has finished copying in. The size and 
+    mtime of every file, and the directory mtime, are fingerprinted at each 
+    check. A directory is complete once its fingerprint has been unchanged 
+    for the settle time with no rsync temporary files present, or as soon 
+    as the optional marker file exists with no rsync temporary files 
+    present. File mtime ages are not used, as rsync preserves source mtimes 
+    and files which are still being appended can look old.
+
+    Attributes
+    ----------
+    settle : float
+        Seconds a directory fingerprint must be unchanged.
+    marker : str
+        Name of a marker file which marks a directory as complete.
+
+    Methods
+    -------
+    check
+        Return the seconds until a directory could be complete.
+    idle
+        Return the seconds since a directory last changed.
+    copying
+        Return the names of files which rsync is still writing.
+    forget
+        Drop the fingerprint of a directory.
+
+    """
+
+    def __init__(self, settle=30, marker=None):
+        """Constructor.
 
-        return min(dmtime, fmtime)
+        Parameters
+        ----------
+        settle : float
+            Seconds a directory fingerprint must be unchanged (default=30).
+        marker : str
+            Name of a marker file which marks a directory as complete 
+            (default=None).
+
+        """
+        self.settle = settle
+        self.marker = marker
+        self._seen = {} # path: (fingerprint, first seen)
+
+
+    def check(self, path, files, dir_mtime):
+        """Update the fingerprint of a directory and return the number of 
+        seconds until it could be complete.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing data files.
+        files : dict
+            Current (size, mtime) of each file in the directory, keyed by name.
+        dir_mtime : float
+            Current directory mtime.
+
+        Returns
+        -------
+        float
+            0 if the directory is complete, otherwise the time remaining 
+            before it could be, assuming it does not change.
+
+        """
+        now = time.monotonic()
+        fingerprint = (dir_mtime, frozenset(files.items()))
+        previous, since = self._seen.get(path, (None, now))
+        if fingerprint != previous:
+            since = now
+        self._seen[path] = (fingerprint, since)
+        
+        data = [n for n in files if not n.startswith(".") and n != self.marker]
+        if not data or self.copying(files):
+            return self.settle
+
+        if self.marker and self.marker in files:
+            logging.root.info(f"Found marker {self.marker} in {path}")
+            return 0
+        
+        return max(since + self.settle - now, 0)
+
+
+    def idle(self, path):
+        """Return the seconds since the fingerprint of a directory last 
+        changed, or 0 if it has not been checked.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing data files.
+
+        Returns
+        -------
+        float
+            Seconds since the directory last changed.
+
+        """
+        if path not in self._seen:
+            return 0
+
+        return time.monotonic() - self._seen[path][1]
+
+
+    def copying(self, files):
+        """Return the names of files which rsync is still writing.
+
+        Parameters
+        ----------
+        files : Iterable[str]
+            File names in a directory.
+
+        Returns
+        -------
+        set of str
+            Names of the files with an rsync temporary file present.
+
+        """
+        return {
+            m.group("name") for m in map(RSYNC_TEMP.match, files) if m
+        }
+
+
+    def forget(self, path):
+        """Drop the fingerprint of a directory.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory containing data files.
+
+        """
+        self._seen.pop(path, None)
@@ -19,7 +19,7 @@ from globus_compute_sdk import Client
 # Registered as: 42e3e64f-4d1e-4681-9a3e-cc9533d7933e
 
 
-def callback(input_path, output_path, run, seg):
+def callback(input_path, output_path, run, seg, warm=False):
     """Callback function to run using the Executor.
         
     Parameters
@@ -28,28 +28,114 @@ def callback(input_path, output_path, run, seg):
         Path to input raw data files, mounted at /input in the image.
     output_path : str
         Path to output fitted files, mounted at /output in the image.
+    run : int
+        Run number to analyze.
+    seg : int or list of int
+        Segment number to analyze. If a list, the segments are fitted in 
+        turn, copying the next segment to node-local /tmp while the current 
+        one is fitted.
+    warm : bool
+        Run the job script in this block's warm container worker, starting 
+        it if necessary, rather than in a new shifter container 
+        (default=False).
+    
+    Returns
+    -------
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
+        
+    """
+    segs = seg if isinstance(seg, list) else [seg]
+    if warm:
+        import sys
+        sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+        from container_worker import run_warm
+        return run_warm(
+            "fit", "/global/homes/c/chester/globus_flows/run_compute_fit_mpi.sh",
+            [run] + segs,
+            {"INPUT_DIR": input_path, "OUTPUT_DIR": output_path}
+        )
+    
+    import time
+    import subprocess
+    start = time.time()
+    p = subprocess.run(
+        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=500G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_fit_mpi.sh {run}".split() + [str(s) for s in segs],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    
+    return (
+        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8"),
+        time.time() - start
+    )
+
+
+def callback_fit_convert(
+        input_path, output_path, converted_path, run, seg, warm=False
+):
+    """Callback function to fit and then convert a segment to ROOT format on 
+    the same node, using the fit output staged in node-local /tmp.
+        
+    Parameters
+    ----------
+    input_path : str
+        Path to input raw data files, mounted at /input in the image.
+    output_path : str
+        Path to output fitted files, mounted at /output in the image.
+    converted_path : str
+        Path to output converted files, mounted at /converted in the image.
     run, seg : int, int
         Run and segment number to analyze.
+    warm : bool
+        Run the job script in this block's warm container worker, starting 
+        it if necessary, rather than in a new shifter container 
+        (default=False).
     
     Returns
     -------
-    tuple : int, str, str
-        (returncode, stdout, stderr). (0, "", "") if success.
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
         
     """
+    if warm:
+        import sys
+        sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+        from container_worker import run_warm
+        return run_warm(
+            "fitconvert",
+            "/global/homes/c/chester/globus_flows/run_compute_fit_convert.sh",
+            [run, seg],
+            {
+                "INPUT_DIR": input_path,
+                "OUTPUT_DIR": output_path,
+                "CONVERTED_DIR": converted_path
+            }
+        )
+
+    import time
     import subprocess
+    start = time.time()
     p = subprocess.run(
-        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=500G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_fit_mpi.sh {run} {seg}".split(),
+        f"shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;{input_path}:/input;{output_path}:/output;{converted_path}:/converted;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size=500G --module=none --env-file=/global/homes/c/chester/shifter.env /global/homes/c/chester/globus_flows/run_compute_fit_convert.sh {run} {seg}".split(),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE
     )
     
     return (
-        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8")
+        p.returncode, p.stdout.decode("UTF-8"), p.stderr.decode("UTF-8"),
+        time.time() - start
     )
 
 
-def fit_mpi(endpoint_id, input_path, output_path):
+def fit_mpi(
+        endpoint_id, input_path, output_path, segments=None,
+        converted_path=None, max_attempts=3, retry_delay=30, force=False,
+        warm=False, segments_per_task=1, fused_callback_id=None,
+        callback_id=None
+):
     """Registered function to fit trace data.
 
     Parameters
@@ -60,60 +146,150 @@ def fit_mpi(endpoint_id, input_path, output_path):
         Input data path contining the files to fit.
     output_path : str
         Output path for fitted data.
+    segments : list of int
+        Segment numbers to fit. If None, fit every segment in the input 
+        path; if empty, there is nothing to fit (default=None).
+    converted_path : str
+        Output path for converted data. If given, each segment is converted 
+        to ROOT format on the node which fitted it, and the separate 
+        conversion step can be skipped (default=None).
+    max_attempts : int
+        Maximum attempts for each segment. A failed segment is resubmitted 
+        on its own, e.g. after a node failure or walltime kill (default=3).
+    retry_delay : float
+        Seconds before a failed segment is first resubmitted, doubling for 
+        each further attempt (default=30).
+    force : bool
+        Fit every segment, even if its output is current in the manifest 
+        of the output path (default=False).
+    warm : bool
+        Run each segment in a warm container worker on its node, which 
+        sets up the container and environment once per block rather than 
+        once per segment. Requires callback_id (default=False).
+    segments_per_task : int
+        Number of segments fitted in turn by each task, copying the next 
+        segment's input to the node while the current one is fitted. 
+        Requires callback_id. Ignored for fused fitting and conversion 
+        (default=1).
+    fused_callback_id : str
+        UUID of the fused fit and convert callback, callback_fit_convert, 
+        registered with --register-fused-callback. Required with 
+        converted_path (default=None).
+    callback_id : str
+        UUID of the fitting callback, registered with --register-callback. 
+        The original registration, used if None, takes neither the warm 
+        keyword nor a list of segments (default=None).
     
     Throws
     ------
     RuntimeError
-        No datafiles found in the input path.
+        No datafiles found in the input path, a segment failed on every 
+        attempt or converted_path is given without fused_callback_id.
 
     Returns
     -------
     dict
-        A dict of tuple objects returned from the callback function, keyed 
-        by task ID: (returncode, stdout, stderr). (0, "", "") if success.
+        A dict of task results, keyed by task ID. Each holds the tuple 
+        returned from the callback function under "result": (returncode, 
+        stdout, stderr), (0, "", "") if success, the task's queue and run 
+        times under "timing", the tuple of its segment numbers under 
+        "task", its position in the largest-first submission order under 
+        "order" and the attempts made under "attempts". Empty if every 
+        segment is current.
     
     """
     import os
+    import sys
     import fnmatch
-    import time
-    from globus_compute_sdk import Client
-    import concurrent.futures
+
+    # Shared helpers installed with the job scripts:
+    sys.path.insert(0, "/global/homes/c/chester/globus_flows")
+    from batch_results import (
+        run_batch, largest_first, chunk_tasks, failed_segments
+    )
+    from globus_api import compute_client
+    from manifest import Manifest, tool_version
     
     # Configure the job:
     
     run = os.path.basename(input_path).replace("run", "")
-    segments = len(fnmatch.filter(os.listdir(input_path), "*.evt"))
+    if segments is None:
+        nevt = len(fnmatch.filter(os.listdir(input_path), "*.evt"))
+        if nevt == 0:
+            raise RuntimeError(f"No event files in {input_path}!")
+        segments = range(nevt)
+    elif len(segments) == 0:
+        return {} # Nothing to do for this flow run.
 
-    if segments == 0:
-        raise RuntimeError(f"No event files in {input_path}!")
+    gcc = compute_client()
+    function_id = callback_id or "0b1491e9-564a-4464-98be-c42eab8f12d9"
+    args = (input_path, output_path)
+    
+    if converted_path:
+        if not fused_callback_id:
+            raise RuntimeError("No fused fit and convert callback UUID given!")
+        function_id = fused_callback_id
+        args = (input_path, output_path, converted_path)
+        os.makedirs(converted_path, exist_ok=True) # Must exist to mount it.
 
-    gcc = Client()
-    function_id = "0b1491e9-564a-4464-98be-c42eab8f12d9" # callback
-    batch = gcc.create_batch()
-    for s in range(segments):
-        batch.add(
-            function_id=function_id, args=(input_path, output_path, run, s)
-        )
+    # The (input, output) of each segment for each stage manifest. Fused
+    # fitting also produces the converted output from the fitted file:
+    manifests = [Manifest(output_path, tool_version("fit"))]
+    if converted_path:
+        manifests.append(Manifest(converted_path, tool_version("convert")))
+    files = {}
+    for s in segments:
+        name = f"run-{int(run):04}-{s:02}"
+        fitted = os.path.join(output_path, f"{name}-fitted.evt")
+        files[s] = [(os.path.join(input_path, f"{name}.evt"), fitted)]
+        if converted_path:
+            files[s].append(
+                (fitted, os.path.join(converted_path, f"{name}-fitted.root"))
+            )
+
+    # Fit only the segments whose outputs are missing or out of date:
+    if not force:
+        segments = [
+            s for s in segments
+            if any(m.stale(s, [i], o) for m, (i, o) in zip(manifests, files[s]))
+        ]
+        if not segments:
+            return {} # Every segment is current.
+
+    # Start the largest segments first to shorten the tail of the batch, and
+    # group them into chunks fitted in turn by one task each:
+    segments = largest_first({s: files[s][0][0] for s in segments})
+    chunks = chunk_tasks(segments, 1 if converted_path else segments_per_task)
 
-    batch_res = gcc.batch_run(endpoint_id=endpoint_id, batch=batch)
-    results = gcc.get_batch_result(batch_res["tasks"][function_id])
+    # The job script reports the failed segments of a chunk, so the rest
+    # are recorded and only the failed ones retried:
+    def task_args(c):
+        return args + (run, list(c) if len(c) > 1 else c[0])
+
+    # Record each task's outputs as soon as it succeeds, so that they are
+    # kept even if another segment fails on every attempt:
+    def record(v):
+        # The runtime timed by the callback, or the poll-derived run time
+        # for callbacks which do not time the job script:
+        run_s = v["timing"]["task_s"]
+        if run_s is None:
+            run_s = v["timing"]["run_s"]
+        for s in v["task"]:
+            runtime = run_s/len(v["task"]) if run_s else None
+            for m, (i, o) in zip(manifests, files[s]):
+                m.record(s, [i], o, runtime=runtime)
+        for m in manifests:
+            m.save()
         
-    def check_status(res):
-        for k, v in res.items():
-            if not "completion_t" in v:
-                return False
-        return True
-            
-    while not check_status(results):
-        time.sleep(30)
-        results = gcc.get_batch_result(batch_res["tasks"][function_id])
+    results = run_batch(
+        gcc, endpoint_id, function_id, {c: task_args(c) for c in chunks},
+        max_attempts=max_attempts, retry_delay=retry_delay,
+        kwargs={"warm": True} if warm else None,
+        split=failed_segments, task_args=task_args, on_result=record
+    )
 
     if not results:
         raise RuntimeError("Batch results dictionary is empty!")
-        
-    for k, v in results.items():
-        if v["result"][0] != 0:
-            raise RuntimeError(f"ERROR: {v['result']}")
     
     return results
 
@@ -146,6 +322,22 @@ def register_callback():
     return uuid
 
 
+def register_fused_callback():
+    """Register the fused fit and convert callback function and return its 
+    UUID.
+
+    """
+    gcc = Client()
+    uuid = gcc.register_function(
+        callback_fit_convert, function_name="callback_fit_convert_mpi",
+        description="Callback to fit traces in an analysis pipeline with the "
+        "FRIBDAQ EventEditor using MPI parallelism and convert the fitted "
+        "data to ROOT format on the same node"
+    )
+    
+    return uuid
+
+
 def parse_args():
     """Parse arguments and return an argparse.Namespace.
 
@@ -164,6 +356,12 @@ def parse_args():
         action="store_true",
         help="(Optional) Re-register the callback function."
     )
+    parser.add_argument(
+        "--register-fused-callback",
+        action="store_true",
+        help="(Optional) Re-register the fused fit and convert callback "
+        "function."
+    )
 
     return parser.parse_args()
 
@@ -179,3 +377,6 @@ if __name__ == "__main__":
     if args.register_callback:
         uuid = register_callback()
         print(f"Callback function UUID: {uuid}")
+    if args.register_fused_callback:
+        uuid = register_fused_callback()
+        print(f"Fused callback function UUID: {uuid}")
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+##
+# @file:  flow_definition.py
+# @brief: Generate the FRIB-NERSC-Analysis-Pipeline flow definition from a
+# description of the pipeline. The output directories are made by the flow
+# driver, which creates each one once per process and caches it, rather than
+# by directory lookup and mkdir action states run by every flow run.
+#
+
+import json
+import argparse
+
+
+DEFINITION = "transfer_compute/definition.json"
+
+TRANSFER_URL = "https://actions.automate.globus.org/transfer/transfer"
+COMPUTE_URL = "https://compute.actions.globus.org/"
+
+ERRORS = ["ActionUnableToRun", "ActionFailedException", "ActionTimeout"]
+
+# Stages of the pipeline in order. Each stage reads its parameters from the
+# input document key of the same name as its "input":
+PIPELINE = [
+    {
+        "state": "CheckTransfer",
+        "type": "skip",
+        "input": "rawdata",
+        "comment": "Skip to the analysis for flows analyzing a run whose "
+        "segments have already been processed",
+        "skip_to": "CheckAnalyze"
+    },
+    {
+        "state": "TransferRawData",
+        "type": "transfer",
+        "input": "rawdata",
+        "comment": "Transfer raw data file(s)",
+        "filter_rules": True,
+        "wait": 3600
+    },
+    {
+        "state": "FitData",
+        "type": "compute",
+        "input": "fit",
+        "comment": "Fit data using Globus compute",
+        "wait": 3600
+    },
+    {
+        "state": "ConvertData",
+        "type": "compute",
+        "input": "convert",
+        "comment": "Convert data to ROOT using Globus compute",
+        "wait": 3600
+    },
+    {
+        "state": "CheckAnalyze",
+        "type": "skip",
+        "input": "analyze",
+        "comment": "Skip the analysis for flows processing only some "
+        "segments of a run"
+    },
+    {
+        "state": "AnalyzeData",
+        "type": "compute",
+        "input": "analyze",
+        "comment": "Analyze data using betasort",
+        "wait": 14400
+    },
+    {
+        "state": "TransferPipelineOutput",
+        "type": "transfer",
+        "input": "pipeline_output",
+        "comment": "Transfer analysis output to its final destination",
+        "filter_rules": False,
+        "wait": 3600
+    }
+]
+
+def transfer_state(stage, next_state):
+    """Return a transfer action state."""
+    key = stage["input"]
+    parameters = {
+        "source_endpoint.$": f"$.{key}.source.id",
+        "destination_endpoint.$": f"$.{key}.destination.id",
+        "DATA": [
+            {
+                "source_path.$": f"$.{key}.source.path",
+                "destination_path.$": f"$.{key}.destination.path",
+                "recursive.$": f"$.{key}.recursive_tx"
+            }
+        ]
+    }
+    if stage.get("filter_rules"):
+        parameters["filter_rules.$"] = f"$.{key}.filter_rules"
+    for option in (
+            "sync_level", "notify_on_succeeded", "notify_on_failed",
+            "notify_on_inactive"
+    ):
+        parameters[f"{option}.$"] = f"$.{key}.{option}"
+
+    return {
+        "Comment": stage["comment"],
+        "Type": "Action",
+        "ActionUrl": TRANSFER_URL,
+        "Parameters": parameters,
+        "ResultPath": f"$.{stage['state']}",
+        "WaitTime": stage["wait"],
+        "Next": next_state
+    }
+
+
+def compute_state(stage, next_state):
+    """Return a Globus Compute action state. Failures are reported by the
+    ComputeFailureHandler.
+
+    """
+    key = stage["input"]
+
+    return {
+        "Comment": stage["comment"],
+        "Type": "Action",
+        "ActionUrl": COMPUTE_URL,
+        "Parameters": {
+            "endpoint.$": f"$.{key}.endpoint",
+            "function.$": f"$.{key}.function",
+            "kwargs.$": f"$.{key}.kwargs"
+        },
+        "Catch": [
+            {
+                "Next": "ComputeFailureHandler",
+                "ResultPath": "$.ComputeErrorResult",
+                "ErrorEquals": ERRORS
+            }
+        ],
+        "ResultPath": f"$.{stage['state']}",
+        "WaitTime": stage["wait"],
+        "Next": next_state
+    }
+
+
+def skip_state(stage, next_state):
+    """Return a choice state which skips to the stage's skip_to state, or
+    ends the flow, if the skip flag of its input is set. Inputs without the
+    flag fall through to the stage.
+
+    """
+    flag = f"$.{stage['input']}.skip"
+
+    return {
+        "Comment": stage["comment"],
+        "Type": "Choice",
+        "Choices": [
+            {
+                "And": [
+                    {"Variable": flag, "IsPresent": True},
+                    {"Variable": flag, "BooleanEquals": True}
+                ],
+                "Next": stage.get("skip_to", "EndFlow")
+            }
+        ],
+        "Default": next_state
+    }
+
+
+STATES = {
+    "transfer": transfer_state,
+    "compute": compute_state,
+    "skip": skip_state
+}
+
+
+def build_definition(pipeline=PIPELINE):
+    """Build the flow definition.
+
+    Parameters
+    ----------
+    pipeline : list of dict
+        Stages of the pipeline in order (default=PIPELINE).
+
+    Returns
+    -------
+    dict
+        The flow definition.
+
+    """
+    names = [stage["state"] for stage in pipeline] + ["EndFlow"]
+
+    states = {}
+    for stage, name, next_state in zip(pipeline, names, names[1:]):
+        states[name] = STATES[stage["type"]](stage, next_state)
+    states["EndFlow"] = {
+        "End": True,
+        "Type": "Pass"
+    }
+    states["ComputeFailureHandler"] = {
+        "Type": "Fail",
+        "Cause": "ComputeFailue",
+        "Error": "See state in $.ComputeErrorResult of the run output",
+        "Comment": "Report the error and end the flow execution"
+    }
+
+    return {
+        "Comment": "Mediated transfer and analysis pipeline for FRIB data",
+        "StartAt": names[0],
+        "States": states
+    }
+
+
+def parse_args():
+    """Parse arguments and return an argparse.Namespace.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate the analysis pipeline flow definition"
+    )
+    parser.add_argument(
+        "--definition",
+        type=str,
+        default=DEFINITION,
+        help=f"Flow definition file to write [default={DEFINITION}]."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """The main: Write the flow definition.
+
+    """
+    args = parse_args()
+
+    definition = build_definition()
+    with open(args.definition, "w") as f:
+        json.dump(definition, f, indent=4)
+        f.write("\n")
+    print(
+        f"Wrote {args.definition} with {len(definition['States'])} states"
+    )
@@ -6,15 +6,17 @@
 
 import os
 import sys
+import threading
 
 import globus_sdk
 from globus_sdk.scopes import GCSCollectionScopeBuilder, MutableScope
 from globus_sdk.tokenstorage import SimpleJSONFileAdapter
 
+from globus_flows.globus_api import RateLimited
+
 # Tokens and refresh tokens will be stored in this file; secure it!!
-TOKEN_FILE_ADAPTER = SimpleJSONFileAdapter(
-    os.path.expanduser("~/.globus-flows-tokens.json")
-)
+TOKEN_FILE = os.path.expanduser("~/.globus-flows-tokens.json")
+TOKEN_FILE_ADAPTER = SimpleJSONFileAdapter(TOKEN_FILE)
 
 SERVICE_SCOPES = [
     globus_sdk.FlowsClient.scopes.manage_flows,
@@ -35,6 +37,71 @@ TRANSFER_ACTION_PROVIDER_SCOPE_STRING = (
     "https://auth.globus.org/scopes/actions.globus.org/transfer/transfer"
 )
 
+# Authorizers and clients shared by every thread in the process, keyed by
+# flow ID and the set of collection IDs. The lock serialises logins, token
+# refreshes and access to the token file:
+TOKEN_LOCK = threading.RLock()
+AUTHORIZERS = {}
+CLIENTS = {}
+
+
+class LockedRefreshTokenAuthorizer(globus_sdk.RefreshTokenAuthorizer):
+    """RefreshTokenAuthorizer which refreshes its access token under 
+    TOKEN_LOCK, so that threads sharing it refresh the token once and do 
+    not race on the token file.
+
+    """
+
+    def get_authorization_header(self):
+        with TOKEN_LOCK:
+            return super().get_authorization_header()
+
+
+def on_refresh(response):
+    """Store refreshed tokens in the token file under TOKEN_LOCK.
+
+    Parameters
+    ----------
+    response : globus_sdk.OAuthTokenResponse
+        Response from the token refresh.
+
+    """
+    with TOKEN_LOCK:
+        TOKEN_FILE_ADAPTER.on_refresh(response)
+
+
+def cache_key(flow_id=None, collection_ids=None):
+    """Return the key of an authorizer or client in the process caches.
+
+    Parameters
+    ----------
+    flow_id : str
+        Flow UUID.
+    collection_ids : str | Iterable[str]
+        Collection UUID(s).
+
+    Returns
+    -------
+    tuple : str, frozenset
+        (flow_id, collection_ids)
+
+    """
+    if isinstance(collection_ids, str):
+        collection_ids = [collection_ids]
+
+    return (flow_id, frozenset(collection_ids or ()))
+
+
+def interactive():
+    """Return True if a login can prompt for an authorization code, i.e. 
+    this is the main thread and stdin is a terminal.
+
+    """
+    return (
+        threading.current_thread() is threading.main_thread()
+        and sys.stdin is not None and sys.stdin.isatty()
+    )
+
 
 def get_tokens(scopes=None):
     """Get new tokens for the flow and return them.
@@ -44,12 +111,27 @@ def get_tokens(scopes=None):
     scopes : str | MutableScope | Iterable[str | MutableScope]
         The desired OAuth2 scopes.
 
+    Throws
+    ------
+    RuntimeError
+        If the login cannot prompt for the authorization code, see 
+        interactive.
+
     Returns
     ------
     globus_sdk.OAuthTokenResponse
         Responses for OAuth2 code for token exchange.
 
     """
+    # A prompt from a worker thread or a job without a terminal would wait
+    # for input forever, holding TOKEN_LOCK:
+    if not interactive():
+        raise RuntimeError(
+            f"ERROR: No saved tokens in {TOKEN_FILE} for the requested "
+            "scopes and cannot log in without a terminal. Log in first "
+            "from a terminal, e.g. with transfer_compute_mpi.py --login"
+        )
+
     # Initiate login flow
     CLIENT.oauth2_start_flow(
         requested_scopes=scopes, refresh_tokens=True
@@ -66,7 +148,9 @@ def get_tokens(scopes=None):
 
 def get_authorizer(flow_id=None, collection_ids=None):
     """Pre-authorize access to our mapped collections, set scope(s), get or 
-    load tokens and return a RefreshTokenAuthorizer.
+    load tokens and return a RefreshTokenAuthorizer. The authorizer is 
+    created once per process for each flow and set of collections and 
+    shared by later calls.
 
     Parameters
     ----------
@@ -80,6 +164,19 @@ def get_authorizer(flow_id=None, collection_ids=None):
     globus_sdk.RefreshTokenAuthorizer
         The authorizer using a Refresh Token to fetch Access Tokens.
 
+    """
+    key = cache_key(flow_id, collection_ids)
+    with TOKEN_LOCK:
+        if key not in AUTHORIZERS:
+            AUTHORIZERS[key] = _new_authorizer(flow_id, sorted(key[1]))
+
+        return AUTHORIZERS[key]
+
+
+def _new_authorizer(flow_id, collection_ids):
+    """Build the scopes, get or load tokens and return a new authorizer. 
+    Must be called with TOKEN_LOCK held.
+
     """
     if flow_id:
         scopes = globus_sdk.SpecificFlowClient(flow_id).scopes
@@ -106,7 +203,17 @@ def get_authorizer(flow_id=None, collection_ids=None):
 
         transfer_action_provider_scope.add_dependency(transfer_scope)
         scopes.add_dependency(transfer_action_provider_scope)
-        
+
+    return _load_authorizer(scopes, resource_server)
+
+
+def _load_authorizer(scopes, resource_server):
+    """Load the saved tokens for a resource server, logging in if there are
+    none, and return a new authorizer. Must be called with TOKEN_LOCK held.
+    Raises RuntimeError if there are no tokens and the login cannot prompt,
+    see get_tokens.
+
+    """
     # Try to load saved tokens
     if TOKEN_FILE_ADAPTER.file_exists():
         tokens = TOKEN_FILE_ADAPTER.get_token_data(resource_server)
@@ -120,18 +227,21 @@ def get_authorizer(flow_id=None, collection_ids=None):
         TOKEN_FILE_ADAPTER.store(response)
         tokens = response.by_resource_server[resource_server]
         
-    return globus_sdk.RefreshTokenAuthorizer(
+    return LockedRefreshTokenAuthorizer(
         tokens["refresh_token"],
         CLIENT,
         access_token=tokens["access_token"],
         expires_at=tokens["expires_at_seconds"],
-        on_refresh=TOKEN_FILE_ADAPTER.on_refresh,
+        on_refresh=on_refresh,
     )
 
 
 def create_flows_client(flow_id=None, collection_ids=None):
     """Create the flow client. If a flow ID is provided, returns a 
-    SpecificFlowClient associated with that UUID.
+    SpecificFlowClient associated with that UUID. The client is created 
+    once per process for each flow and set of collections and shared by 
+    later calls, and its API calls are rate limited and retried by 
+    globus_api.RateLimited.
 
     Parameters
     ----------
@@ -146,8 +256,56 @@ def create_flows_client(flow_id=None, collection_ids=None):
         The Flows client.
 
     """
-    authorizer = get_authorizer(flow_id, collection_ids=collection_ids)    
-    if flow_id:
-        return globus_sdk.SpecificFlowClient(flow_id, authorizer=authorizer)
-    else:
-        return globus_sdk.FlowsClient(authorizer=authorizer)
+    key = cache_key(flow_id, collection_ids)
+    with TOKEN_LOCK:
+        if key not in CLIENTS:
+            authorizer = get_authorizer(flow_id, collection_ids=key[1])
+            if flow_id:
+                CLIENTS[key] = RateLimited(
+                    globus_sdk.SpecificFlowClient(
+                        flow_id, authorizer=authorizer
+                    )
+                )
+            else:
+                CLIENTS[key] = RateLimited(
+                    globus_sdk.FlowsClient(authorizer=authorizer)
+                )
+
+        return CLIENTS[key]
+
+
+def create_transfer_client(collection_ids):
+    """Create a Transfer client with data access to our mapped collections,
+    used by the flow driver to make the output directories. The client is
+    created once per process for each set of collections and its API calls
+    are rate limited and retried by globus_api.RateLimited.
+
+    Parameters
+    ----------
+    collection_ids : str | Iterable[str]
+        Collection UUID(s).
+
+    Returns
+    -------
+    TransferClient
+        The Transfer client.
+
+    """
+    key = ("transfer",) + cache_key(None, collection_ids)[1:]
+    with TOKEN_LOCK:
+        if key not in CLIENTS:
+            scopes = globus_sdk.TransferClient.scopes.make_mutable("all")
+            for collection_id in sorted(key[1]):
+                scopes.add_dependency(
+                    GCSCollectionScopeBuilder(collection_id).make_mutable(
+                        "data_access", optional=True
+                    )
+                )
+            authorizer = _load_authorizer(
+                scopes, globus_sdk.TransferClient.resource_server
+            )
+            CLIENTS[key] = RateLimited(
+                globus_sdk.TransferClient(authorizer=authorizer)
+            )
+
+        return CLIENTS[key]
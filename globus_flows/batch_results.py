@@ -0,0 +1,379 @@
+##
+# @file batch_results.py
+# @brief Collect Globus Compute batch results as the tasks complete. Used by
+# the registered fit and convert functions, which import it from the
+# globus_flows directory installed at NERSC, and by test_fit_mpi.py.
+#
+
+import os
+import math
+import time
+import heapq
+import logging
+
+
+def poll_batch(gcc, pending, started, submitted):
+    """Poll the status of pending batch tasks once and return those which
+    have completed. Each completed result is the dict returned by
+    Client.get_batch_result for the task, with an added "timing" dict
+    holding the time in seconds the task spent queued ("queue_s") and
+    running ("run_s"), and the time its job script ran for ("task_s"), see
+    task_time. The queue and run times are measured from the status seen at
+    each poll, so are accurate to the polling interval, and are None if the
+    task was never seen running.
+
+    Parameters
+    ----------
+    gcc : globus_compute_sdk.Client
+        Globus Compute client used to submit the batch.
+    pending : list of str
+        Task UUIDs which have not yet completed.
+    started : dict
+        Time each task was first seen running, keyed by task ID. Updated
+        in place.
+    submitted : dict
+        Time each task was submitted, keyed by task ID.
+
+    Returns
+    -------
+    list of tuple : str, dict
+        (task_id, result) for each completed task.
+
+    """
+    results = gcc.get_batch_result(pending)
+    now = time.time()
+    done = []
+    for k, v in results.items():
+        if v.get("status") == "running":
+            started.setdefault(k, now)
+        if not "completion_t" in v:
+            continue
+
+        start = started.get(k)
+        v["timing"] = {
+            "queue_s": start - submitted[k] if start else None,
+            "run_s": now - start if start else None,
+            "task_s": task_time(v)
+        }
+        done.append((k, v))
+
+    return done
+
+
+def task_time(result):
+    """Return the time in seconds the job script of a completed task ran
+    for, as timed by the callback, which returns it after the return code,
+    stdout and stderr.
+
+    Parameters
+    ----------
+    result : dict
+        Completed task result from get_batch_result.
+
+    Returns
+    -------
+    float
+        Job script runtime, or None if the task raised or its callback
+        does not time the job script.
+
+    """
+    r = result.get("result")
+    if isinstance(r, (list, tuple)) and len(r) > 3:
+        return r[3]
+
+    return None
+
+
+def succeeded(result):
+    """Return True if a completed task returned a zero return code.
+
+    Parameters
+    ----------
+    result : dict
+        Completed task result from get_batch_result.
+
+    Returns
+    -------
+    bool
+        True if the task returned (0, stdout, stderr).
+
+    """
+    return "result" in result and result["result"][0] == 0
+
+
+def iter_batch_results(
+        gcc, task_ids, interval=5, max_interval=60, backoff=2, submitted=None
+):
+    """Yield batch task results as the tasks complete. Only the results of
+    tasks which are still pending are requested at each poll. The polling
+    interval is multiplied by the backoff factor after each poll where no
+    task completes, up to the maximum interval, and reset when a task
+    completes.
+
+    Parameters
+    ----------
+    gcc : globus_compute_sdk.Client
+        Globus Compute client used to submit the batch.
+    task_ids : Iterable[str]
+        Task UUIDs to collect.
+    interval : float
+        Initial polling interval in seconds (default=5).
+    max_interval : float
+        Maximum polling interval in seconds (default=60).
+    backoff : float
+        Polling interval multiplier applied when no task completes
+        (default=2).
+    submitted : float
+        Time the batch was submitted, from time.time(). If None, the time
+        of the call is used (default=None).
+
+    Yields
+    ------
+    tuple : str, dict
+        (task_id, result) for each task as it completes, see poll_batch.
+
+    """
+    pending = list(task_ids)
+    submitted = dict.fromkeys(pending, submitted if submitted else time.time())
+    started = {}
+    wait = interval
+
+    while pending:
+        done = poll_batch(gcc, pending, started, submitted)
+        yield from done
+
+        pending = [k for k in pending if k not in dict(done)]
+        if pending:
+            wait = interval if done else min(wait*backoff, max_interval)
+            time.sleep(wait)
+
+
+def failed_segments(result):
+    """Return the segments which a job script processing several segments
+    in turn reported as failed, from the "Failed segments:" line it writes
+    to stdout.
+
+    Parameters
+    ----------
+    result : dict
+        Completed task result from get_batch_result.
+
+    Returns
+    -------
+    list of int
+        Failed segment numbers, or None if the task did not report them,
+        e.g. because it raised or was killed.
+
+    """
+    if "result" not in result:
+        return None
+    for line in result["result"][1].splitlines():
+        if line.startswith("Failed segments:"):
+            return [int(s) for s in line.split(":", 1)[1].split()]
+
+    return None
+
+
+def largest_first(inputs):
+    """Return task names ordered by the size of their input files, largest
+    first, so that the longest tasks start first and a large segment does
+    not start last and stretch the batch makespan (longest processing time
+    first scheduling). Tasks with equal sizes keep their original order, and
+    missing inputs sort last.
+
+    Parameters
+    ----------
+    inputs : dict
+        Input file paths keyed by task name.
+
+    Returns
+    -------
+    list
+        Task names, largest input first.
+
+    """
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return -1
+
+    return sorted(inputs, key=lambda k: size(inputs[k]), reverse=True)
+
+
+def chunk_tasks(names, size):
+    """Group task names into chunks of at most size names, for tasks which
+    process several segments in turn. Names are dealt to the chunks in
+    turn, so that names ordered largest first give chunks of similar total
+    size, and the chunks are in order of decreasing size.
+
+    Parameters
+    ----------
+    names : list
+        Task names, e.g. segment numbers ordered by largest_first.
+    size : int
+        Maximum number of names in a chunk.
+
+    Returns
+    -------
+    list of tuple
+        Chunks of task names.
+
+    """
+    n = math.ceil(len(names)/max(size, 1))
+    return [tuple(names[i::n]) for i in range(n)]
+
+
+def run_batch(
+        gcc, endpoint_id, function_id, tasks, max_attempts=3, retry_delay=30,
+        interval=5, max_interval=60, backoff=2, kwargs=None, split=None,
+        task_args=None, on_result=None
+):
+    """Submit a batch of tasks and collect their results, resubmitting only
+    the tasks which fail. A failed task is resubmitted on its own after
+    retry_delay seconds, doubling for each further attempt, until it has
+    been attempted max_attempts times. Results are collected as the tasks
+    complete, as for iter_batch_results.
+
+    Tasks named by a tuple, e.g. a chunk of segments processed in turn,
+    may fail in part. If split reports which members of a failed task
+    failed, the rest are returned as done and only the failed members are
+    resubmitted, as one task named by their tuple, whose arguments are given
+    by task_args. It counts the attempts of the task it was split from.
+
+    Parameters
+    ----------
+    gcc : globus_compute_sdk.Client
+        Globus Compute client.
+    endpoint_id : str
+        Endpoint UUID where the tasks are run.
+    function_id : str
+        Registered function UUID.
+    tasks : dict
+        Function argument tuples keyed by a task name, e.g. segment number.
+        Tasks are submitted in the order of the dict.
+    max_attempts : int
+        Maximum number of attempts for each task (default=3).
+    retry_delay : float
+        Seconds before a failed task is first resubmitted (default=30).
+    interval, max_interval, backoff : float, float, float
+        Polling options, see iter_batch_results.
+    kwargs : dict
+        Keyword arguments passed to every task (default=None).
+    split : function
+        Function taking a failed result and returning the failed members of
+        its task, e.g. failed_segments, or None if unknown (default=None).
+    task_args : function
+        Function taking a task name and returning its function arguments.
+        Required with split (default=None).
+    on_result : function
+        Function called with each result which is returned, including those
+        which succeeded in part, as soon as it completes. Results returned
+        before a task fails max_attempts times are passed to it even though
+        run_batch raises, e.g. to record their outputs (default=None).
+
+    Throws
+    ------
+    RuntimeError
+        If any task fails max_attempts times.
+
+    Returns
+    -------
+    dict
+        Task results keyed by the ID of the successful task, see
+        poll_batch, with the task name under "task", its position in the
+        submission order under "order" and the number of attempts made
+        under "attempts". The result of a task which failed in part holds
+        its members which succeeded under "task" and the failed members
+        under "failed".
+
+    """
+    tasks = dict(tasks)
+    names = {}      # task_id: task name
+    attempts = {}   # task name: attempts submitted
+    submitted = {}  # task_id: submission time
+    started = {}
+    retries = []    # (due, task name)
+    results = {}
+    order = {key: n for n, key in enumerate(tasks)}
+
+    def submit(keys):
+        batch = gcc.create_batch()
+        for key in keys:
+            batch.add(
+                function_id=function_id, args=tasks[key], kwargs=kwargs or {}
+            )
+        res = gcc.batch_run(endpoint_id=endpoint_id, batch=batch)
+        now = time.time()
+        task_ids = res["tasks"][function_id]
+        for key, task_id in zip(keys, task_ids):
+            names[task_id] = key
+            attempts[key] = attempts.get(key, 0) + 1
+            submitted[task_id] = now
+        return list(task_ids)
+
+    pending = submit(list(tasks))
+    wait = interval
+
+    while pending or retries:
+        done = poll_batch(gcc, pending, started, submitted) if pending else []
+        for k, v in done:
+            key = names[k]
+            if succeeded(v):
+                v["task"] = key
+                v["order"] = order[key]
+                v["attempts"] = attempts[key]
+                results[k] = v
+                logging.root.info(f"Task {key} done: {v['timing']}")
+                if on_result:
+                    on_result(v)
+                continue
+
+            error = v.get("result", v.get("exception"))
+            failed = split(v) if split and isinstance(key, tuple) else None
+            if failed and set(failed) < set(key):
+                done_part = tuple(n for n in key if n not in failed)
+                key = tuple(n for n in key if n in failed)
+                tasks[key] = task_args(key)
+                attempts[key] = attempts[names[k]]
+                order[key] = order[names[k]]
+                v["task"] = done_part
+                v["failed"] = key
+                v["order"] = order[key]
+                v["attempts"] = attempts[key]
+                results[k] = v
+                logging.root.info(
+                    f"Task {names[k]} done in part, {key} failed: "
+                    f"{v['timing']}"
+                )
+                if on_result:
+                    on_result(v)
+
+            if attempts[key] >= max_attempts:
+                raise RuntimeError(
+                    f"ERROR: {key} failed after {attempts[key]} attempts: "
+                    f"{error}"
+                )
+            delay = retry_delay*2**(attempts[key] - 1)
+            logging.root.warning(
+                f"Task {key} attempt {attempts[key]} failed, resubmitting in "
+                f"{delay}s: {error}"
+            )
+            heapq.heappush(retries, (time.time() + delay, key))
+
+        pending = [k for k in pending if k not in dict(done)]
+
+        due = []
+        while retries and retries[0][0] <= time.time():
+            due.append(heapq.heappop(retries)[1])
+        if due:
+            pending += submit(due)
+
+        if pending or retries:
+            wait = interval if done else min(wait*backoff, max_interval)
+            sleep = wait if pending else max_interval
+            if retries:
+                sleep = min(sleep, max(retries[0][0] - time.time(), 0))
+            time.sleep(sleep)
+
+    return results
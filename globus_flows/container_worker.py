@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+##
+# @file container_worker.py
+# @brief Long-lived worker which runs the job scripts inside a single
+# shifter container per Slurm block, so that the container start-up and the
+# environment setup are paid once per block rather than once per segment.
+# Run inside the container as the worker, and imported by the callbacks on
+# the host to submit jobs to it. Must remain compatible with the Python 3.7
+# in the fribdaq/frib-buster image.
+#
+
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+import socketserver
+
+
+SCRIPT_DIR = "/global/homes/c/chester/globus_flows"
+WORKER = f"{SCRIPT_DIR}/container_worker.py"
+LOG_DIR = "/global/homes/c/chester/globus_flows/flow_logs"
+SHIFTER = (
+    "shifter --image=fribdaq/frib-buster:v4.2 --volume=/global/cfs/cdirs/m4386/opt-buster:/usr/opt;/global/cscratch1/sd/chester/tmpfiles:/tmp:perNodeCache=size={cache} --module=none --env-file=/global/homes/c/chester/shifter.env"
+)
+
+# Environment setup sourced once by each worker, matching the job scripts,
+# and the size of its node-local /tmp cache:
+DAQ_SETUP = (
+    "source /usr/opt/daq/12.0-013/daqsetup.bash; "
+    "export PATH=$MPI_ROOT/bin:$PATH; "
+    "export LD_LIBRARY_PATH=$MPI_ROOT/lib:$LD_LIBRARY_PATH"
+)
+ROOT_SETUP = "source /usr/opt/root/root-6.24.06/bin/thisroot.sh"
+ROLES = {
+    "fit": (DAQ_SETUP, "500G"),
+    "fitconvert": (f"{DAQ_SETUP}; {ROOT_SETUP}", "500G"),
+    "convert": (ROOT_SETUP, "1000G"),
+    "analyze": ("true", "1000G"),
+    "merge": (ROOT_SETUP, "1000G")
+}
+
+
+def address(role):
+    """Return the socket address of the worker for a role in this block.
+    Sockets are in the abstract namespace, which is shared by the host and
+    the container, so no path needs to be visible to both.
+
+    Parameters
+    ----------
+    role : str
+        Worker role, one of the keys of ROLES.
+
+    Returns
+    -------
+    str
+        Abstract unix socket address.
+
+    """
+    job = os.environ.get("SLURM_JOB_ID", "local")
+    return f"\0frib-worker-{role}-{job}"
+
+
+def peer_uid(sock):
+    """Return the uid of the process at the other end of a connected unix
+    socket. Abstract sockets have no file permissions, so any user on the
+    node can connect to, or bind, a worker address; each end checks that
+    the other is running as the same user.
+
+    Parameters
+    ----------
+    sock : socket.socket
+        Connected unix socket.
+
+    Returns
+    -------
+    int
+        uid of the peer process.
+
+    """
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", creds)[1]
+
+
+def allowed(script):
+    """Return True if a job script is one of the pipeline's own scripts in
+    SCRIPT_DIR, which only the pipeline account can write to.
+
+    """
+    path = os.path.realpath(script)
+    return os.path.dirname(path) == SCRIPT_DIR and path.endswith(".sh")
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Run one job script per connection. The request is a JSON line
+    holding the script path, its arguments and environment overrides; the
+    reply is a JSON line holding [returncode, stdout, stderr, seconds the
+    script ran for].
+
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return # Connection probe, no job.
+        job = json.loads(line.decode("UTF-8"))
+        if not allowed(job["script"]):
+            reply = [1, "", f"Refused to run {job['script']}", 0.0]
+            self.wfile.write(json.dumps(reply).encode("UTF-8") + b"\n")
+            return
+        self.server.busy(1)
+        start = time.time()
+        try:
+            p = subprocess.run(
+                ["/bin/bash", job["script"]] + [str(a) for a in job["args"]],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=dict(os.environ, **job.get("env", {}))
+            )
+            reply = [
+                p.returncode,
+                p.stdout.decode("UTF-8", "replace"),
+                p.stderr.decode("UTF-8", "replace"),
+                time.time() - start
+            ]
+        except OSError as e:
+            reply = [1, "", f"Failed to run {job['script']}: {e}", 0.0]
+        finally:
+            self.server.busy(-1)
+
+        self.wfile.write(json.dumps(reply).encode("UTF-8") + b"\n")
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded unix socket server which runs jobs concurrently, up to the
+    number of workers the endpoint runs on the node, and shuts down after
+    an idle period.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, role, idle):
+        super().__init__(address(role), JobHandler)
+        self.idle = idle
+        self._active = 0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+
+    def verify_request(self, request, client_address):
+        """Only accept connections from processes of the same user, as the
+        jobs run as the pipeline account.
+
+        """
+        uid = peer_uid(request)
+        if uid != os.getuid():
+            print(f"Refused connection from uid {uid}", flush=True)
+            return False
+
+        return True
+
+
+    def busy(self, n):
+        """Count a job starting (n=1) or finishing (n=-1).
+
+        """
+        with self._lock:
+            self._active += n
+            self._last = time.time()
+
+
+    def watch_idle(self):
+        """Shut the server down once no jobs have run for the idle period.
+
+        """
+        while True:
+            time.sleep(min(self.idle, 10))
+            with self._lock:
+                idle = not self._active and time.time() - self._last > self.idle
+            if idle:
+                self.shutdown()
+                return
+
+
+def serve(role, idle):
+    """Run the worker until it is idle. Called inside the container after
+    the environment for the role has been set up.
+
+    Parameters
+    ----------
+    role : str
+        Worker role, one of the keys of ROLES.
+    idle : float
+        Seconds without a job after which the worker exits.
+
+    """
+    server = WorkerServer(role, idle)
+    threading.Thread(target=server.watch_idle, daemon=True).start()
+    print(f"Worker {role} serving jobs for block "
+          f"{os.environ.get('SLURM_JOB_ID')}", flush=True)
+    server.serve_forever()
+    server.server_close()
+    print(f"Worker {role} idle for {idle} s, exiting", flush=True)
+
+
+def connect(role):
+    """Connect to the worker for a role, or return None if none is running.
+
+    Throws
+    ------
+    RuntimeError
+        If the worker address is held by another user's process.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address(role))
+    except (ConnectionRefusedError, FileNotFoundError):
+        sock.close()
+        return None
+
+    # Another user may have bound the address first to receive our jobs:
+    uid = peer_uid(sock)
+    if uid != os.getuid():
+        sock.close()
+        raise RuntimeError(f"Worker {role} address is held by uid {uid}")
+
+    return sock
+
+
+def spawn(role, idle=600, timeout=300):
+    """Start the worker for a role in a new shifter container and return a
+    connection to it once it is accepting jobs.
+
+    Parameters
+    ----------
+    role : str
+        Worker role, one of the keys of ROLES.
+    idle : float
+        Seconds without a job after which the worker exits (default=600).
+    timeout : float
+        Seconds to wait for the worker to start (default=300).
+
+    Throws
+    ------
+    RuntimeError
+        If the worker exits or does not start within the timeout.
+
+    Returns
+    -------
+    socket.socket
+        Connection to the worker.
+
+    """
+    setup, cache = ROLES[role]
+    job = os.environ.get("SLURM_JOB_ID", "local")
+    logfile = (
+        f"{LOG_DIR}/worker-{role}-{job}-{os.environ.get('SLURMD_NODENAME')}.out"
+    )
+    with open(logfile, "a") as log:
+        p = subprocess.Popen(
+            SHIFTER.format(cache=cache).split() + [
+                "/bin/bash", "-c",
+                f"{setup}; export FRIB_ENV_READY=1; "
+                f"exec python3 {WORKER} --role {role} --idle {idle}"
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True # Outlive the task which started it.
+        )
+
+    start = time.time()
+    while time.time() - start < timeout:
+        sock = connect(role)
+        if sock:
+            return sock
+        if p.poll() is not None:
+            raise RuntimeError(
+                f"Worker {role} exited with status {p.returncode}, "
+                f"see {logfile}"
+            )
+        time.sleep(1)
+
+    p.kill()
+    raise RuntimeError(f"Worker {role} did not start within {timeout} s")
+
+
+def run_warm(role, script, args, env=None):
+    """Run a job script in the warm worker for a role on this node, starting
+    the worker if it is not running. The worker is started under a lock so
+    that concurrent tasks on the node share one worker.
+
+    Parameters
+    ----------
+    role : str
+        Worker role, one of the keys of ROLES.
+    script : str
+        Path to the job script, as seen in the container.
+    args : list
+        Job script arguments.
+    env : dict
+        Environment overrides for the job script, e.g. INPUT_DIR
+        (default=None).
+
+    Returns
+    -------
+    tuple : int, str, str, float
+        (returncode, stdout, stderr, seconds the job script ran for). 
+        Returncode 0 if success.
+
+    """
+    job = os.environ.get("SLURM_JOB_ID", "local")
+    with open(f"/tmp/frib-worker-{role}-{job}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        sock = connect(role) or spawn(role)
+
+    with sock:
+        request = {"script": script, "args": list(args), "env": env or {}}
+        sock.sendall(json.dumps(request).encode("UTF-8") + b"\n")
+        line = sock.makefile("rb").readline()
+
+    if not line:
+        return (1, "", f"Worker {role} exited before the job finished", 0.0)
+
+    return tuple(json.loads(line.decode("UTF-8")))
+
+
+def parse_args():
+    """Parse arguments and return an argparse.Namespace.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Warm container worker for the analysis pipeline"
+    )
+    parser.add_argument(
+        "--role",
+        type=str,
+        choices=list(ROLES),
+        required=True,
+        help="Worker role, which determines the environment set up by the "
+        "command which starts the worker."
+    )
+    parser.add_argument(
+        "--idle",
+        type=float,
+        default=600,
+        help="Seconds without a job after which the worker exits "
+        "[default=600]."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """The main: Serve jobs inside the container.
+
+    """
+    args = parse_args()
+    if not os.environ.get("FRIB_ENV_READY"):
+        sys.exit("The worker must be started by spawn() with its environment")
+    serve(args.role, args.idle)
@@ -1,7 +1,7 @@
 #!/bin/sh
 
 gce=$HOME/globus_flows/globus_compute_venv/bin/globus-compute-endpoint
-endpoints=("frib-fit-mpi" "frib-convert" "frib-analysis")
+endpoints=("frib-fit-mpi" "frib-convert" "frib-analysis" "frib-coordinator")
 
 for ep in ${endpoints[@]}
 do
@@ -1,4 +1,18 @@
+##
+# @file:  monitor.py
+# @brief: Supervise the compute endpoints, restarting any which are offline.
+# Endpoints are checked and restarted concurrently, with an exponential
+# backoff between restarts of each endpoint and a flap detector, and uptime
+# and restart-latency statistics are written to a JSON file.
+#
+
+import os
 import sys
+import json
+import time
+import argparse
+import statistics
+import collections
 import logging
 logging.basicConfig(
     format="%(asctime)s %(message)s",
@@ -7,49 +21,409 @@ logging.basicConfig(
     level=logging.INFO
 )
 import subprocess
-import time
+import threading
+import concurrent.futures
+
+# The rate-limited API client is installed with the job scripts:
+EP_LAUNCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(EP_LAUNCH))
+from globus_api import compute_client
+
+
+GCE = "/global/homes/c/chester/globus_flows/globus_compute_venv/bin/globus-compute-endpoint"
+STATS = "/global/homes/c/chester/globus_flows/flow_logs/monitor-stats.json"
+
+
+class EndpointState:
+    """Health, restart and uptime state of one endpoint. Only the check of
+    its own endpoint updates a state, and no endpoint is checked twice at
+    once.
+
+    """
+
+    def __init__(self, uuid, name, hostname):
+        self.uuid = uuid
+        self.name = name
+        self.hostname = hostname
+        self.status = None
+        self.checked = None         # Time of the last check.
+        self.next_check = 0         # Time the next check is due.
+        self.checks = 0
+        self.online_s = 0.0
+        self.offline_s = 0.0
+        self.down_since = None      # Time the current outage was detected.
+        self.next_restart = 0       # Earliest time of the next restart.
+        self.backoff = None         # Current delay between restarts.
+        self.restarts = 0
+        self.failed_restarts = 0    # Restarts followed by another restart.
+        self.outage_restarts = 0    # Restarts during the current outage.
+        self.latencies = []         # Outage detection to online, seconds.
+        self.outages = collections.deque()
+        self.flapping = False
+
+
+    def stats(self):
+        """Return the statistics written to the stats file."""
+        total = self.online_s + self.offline_s
+        latencies = sorted(self.latencies)
+        return {
+            "uuid": self.uuid,
+            "name": self.name,
+            "hostname": self.hostname,
+            "status": self.status,
+            "checks": self.checks,
+            "online_s": self.online_s,
+            "offline_s": self.offline_s,
+            "uptime": self.online_s/total if total else None,
+            "restarts": self.restarts,
+            "failed_restarts": self.failed_restarts,
+            "outages_in_window": len(self.outages),
+            "flapping": self.flapping,
+            "restart_latency_s": {
+                "count": len(latencies),
+                "last": self.latencies[-1] if latencies else None,
+                "median": statistics.median(latencies) if latencies else None,
+                "max": latencies[-1] if latencies else None
+            }
+        }
+
+
+class Supervisor:
+    """Check every endpoint on a thread pool and restart those which are
+    offline, so that one broken endpoint does not delay the checks of the
+    others. Healthy endpoints are checked every interval; an endpoint which
+    is offline is checked every fast_interval until it is back online, and
+    restarted with a delay which doubles after each restart that does not
+    bring it back, up to max_backoff. An endpoint which goes offline
+    flap_count times within flap_window is flapping: it is logged as an
+    error and only restarted every max_backoff until it has been stable for
+    the window.
+
+    Attributes
+    ----------
+    client : globus_api.RateLimited
+        Rate-limited Globus Compute client shared by the checks.
+    states : dict
+        EndpointState keyed by endpoint UUID.
+
+    Methods
+    -------
+    run
+        Supervise the endpoints until interrupted.
+    refresh
+        Update the supervised endpoints from the service.
+    check
+        Check one endpoint and restart it if necessary.
+    restart
+        Restart one endpoint.
+    write_stats
+        Write the endpoint statistics to the stats file.
+
+    """
+
+    def __init__(self, args):
+        """Constructor.
+
+        Parameters
+        ----------
+        args : argparse.Namespace
+            Supervisor options, see parse_args.
+
+        """
+        self.args = args
+        self.client = compute_client()
+        self.states = {}
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(args.workers)
+        self._running = {}
+
+
+    def run(self):
+        """Supervise the endpoints until interrupted. Due checks are
+        submitted to the pool from this loop, the endpoint list is refreshed
+        every interval, and the statistics are written once a minute.
+
+        """
+        refreshed = written = 0
+        while True:
+            now = time.time()
+            if now - refreshed >= self.args.interval:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logging.error(f"ERROR: Cannot list endpoints: {e}")
+                refreshed = now
+
+            for uuid, future in list(self._running.items()):
+                if future.done():
+                    del self._running[uuid]
+                    if future.exception():
+                        logging.error(
+                            f"ERROR: Check of endpoint {uuid} failed: "
+                            f"{future.exception()}"
+                        )
+                        self.states[uuid].next_check = (
+                            now + self.args.fast_interval
+                        )
+
+            for uuid, state in self.states.items():
+                if uuid not in self._running and state.next_check <= now:
+                    self._running[uuid] = self._pool.submit(self.check, state)
+
+            if now - written >= 60:
+                self.write_stats()
+                written = now
+
+            time.sleep(1)
+
+
+    def refresh(self):
+        """Add endpoints which are new to the service and drop those which
+        have been deleted. Metadata is fetched once per endpoint.
+
+        """
+        endpoints = self.client.get_endpoints() # They're all at NERSC
+        uuids = {ep["uuid"] for ep in endpoints}
+        for uuid in uuids - set(self.states):
+            metadata = self.client.get_endpoint_metadata(uuid)
+            with self._lock:
+                self.states[uuid] = EndpointState(
+                    uuid, metadata["name"], metadata["hostname"]
+                )
+        with self._lock:
+            for uuid in set(self.states) - uuids - set(self._running):
+                del self.states[uuid]
+
 
-from globus_compute_sdk import Client
-
-while True:
-    client = Client()
-    endpoints = client.get_endpoints() # They're all at NERSC so this is fine
-    
-    for ep in endpoints:
-        uuid = ep["uuid"]
-        name = client.get_endpoint_metadata(uuid)["name"]
-        hostname = client.get_endpoint_metadata(uuid)["hostname"]
-        status = client.get_endpoint_status(uuid)["status"]
-        
+    def check(self, state):
+        """Check one endpoint, account its uptime and restart it if it is
+        offline and its restart backoff has expired.
+
+        Parameters
+        ----------
+        state : EndpointState
+            State of the endpoint to check.
+
+        """
+        status = self.client.get_endpoint_status(state.uuid)["status"]
+        now = time.time()
+        a = self.args
+
+        with self._lock:
+            if state.checked is not None:
+                if state.status == "online":
+                    state.online_s += now - state.checked
+                else:
+                    state.offline_s += now - state.checked
+            state.checked = now
+            state.checks += 1
+            previous, state.status = state.status, status
+
+            # Forget outages which have left the flap window:
+            while state.outages and now - state.outages[0] > a.flap_window:
+                state.outages.popleft()
+            if state.flapping and len(state.outages) < a.flap_count:
+                state.flapping = False
+                logging.info(f"Endpoint {state.name} is no longer flapping")
+
+        if status == "online":
+            if state.down_since is not None:
+                latency = now - state.down_since
+                with self._lock:
+                    state.latencies.append(latency)
+                    state.down_since = None
+                    state.backoff = None
+                    state.outage_restarts = 0
+                logging.info(
+                    f"Endpoint {state.name} on {state.hostname} with UUID "
+                    f"{state.uuid} back online after {latency:.0f} s"
+                )
+            elif previous != "online":
+                logging.info(
+                    f"Endpoint {state.name} on {state.hostname} with UUID "
+                    f"{state.uuid} status: '{status}'"
+                )
+            state.next_check = now + a.interval
+            return
+
+        # Offline. Record the start of a new outage:
+        if state.down_since is None:
+            with self._lock:
+                state.down_since = now
+                state.next_restart = now
+                state.backoff = a.backoff
+                state.outages.append(now)
+                if len(state.outages) >= a.flap_count and not state.flapping:
+                    state.flapping = True
+                    logging.error(
+                        f"ERROR: Endpoint {state.name} is flapping, "
+                        f"{len(state.outages)} outages in "
+                        f"{a.flap_window:.0f} s; restarting at most every "
+                        f"{a.max_backoff:.0f} s"
+                    )
+            logging.info(
+                f"Endpoint {state.name} on {state.hostname} with UUID "
+                f"{state.uuid} status: '{status}'"
+            )
+
+        if now >= state.next_restart:
+            if self.restart(state):
+                delay = a.max_backoff if state.flapping else state.backoff
+                with self._lock:
+                    state.next_restart = now + delay
+                    state.backoff = min(2*state.backoff, a.max_backoff)
+            else:
+                with self._lock:
+                    state.next_restart = now + a.max_backoff
+
+        state.next_check = now + a.fast_interval
+
+
+    def restart(self, state):
+        """Restart one endpoint.
+
+        Parameters
+        ----------
+        state : EndpointState
+            State of the endpoint to restart.
+
+        Returns
+        -------
+        bool
+            True if the restart command succeeded within the restart
+            timeout.
+
+        """
         logging.info(
-            f"Endpoint {name} on {hostname} with UUID {uuid} status: '{status}'"
+            f"Attempting restart of endpoint {state.name} {state.uuid}..."
         )
-        
-        tries = 0
-        restart = False
-        while status != "online" and tries < 10:
-            restart = True if not restart else None
-            logging.info(f"Attempting restart of endpoint {name} {uuid}...")
-            subprocess.run(
-                f"/global/homes/c/chester/globus_flows/globus_compute_venv/bin/globus-compute-endpoint restart {name}".split(),
+        with self._lock:
+            # The previous restart in this outage did not bring it back:
+            state.failed_restarts += state.outage_restarts > 0
+            state.outage_restarts += 1
+            state.restarts += 1
+        try:
+            p = subprocess.run(
+                f"{GCE} restart {state.name}".split(),
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+                stderr=subprocess.PIPE,
+                timeout=self.args.restart_timeout
+            )
+        except subprocess.TimeoutExpired:
+            # A hung restart must not hold a worker for good:
+            logging.error(
+                f"ERROR: Failed to restart endpoint {state.name} on "
+                f"{state.hostname} with UUID {state.uuid}: no response "
+                f"after {self.args.restart_timeout:.0f} s"
             )
+            return False
+        if p.returncode != 0:
+            logging.error(
+                f"ERROR: Failed to restart endpoint {state.name} on "
+                f"{state.hostname} with UUID {state.uuid}: "
+                f"{p.stderr.decode('UTF-8', 'replace').strip()}"
+            )
+            return False
 
-            # Wait a few seconds and poll the status:
-            time.sleep(10)
-            status = client.get_endpoint_status(uuid)["status"]            
-            tries = tries + 1
+        return True
 
-        # Report if we've tried to restart the endpoints:
-        if restart:
-            if status == "online":
-                logging.info(
-                    f"Restarted endpoint {name} on {hostname} with UUID {uuid} status: '{status}'"
-                )
-            else:
-                logging.error(f"ERROR: Failed to restart endpoint {name} on {hostname} with UUID {uuid}!")
 
-    # Monitoring interval:
-    time.sleep(300)
-                
+    def write_stats(self):
+        """Write the endpoint statistics to the stats file, replacing it
+        atomically.
+
+        """
+        if not self.args.stats:
+            return
+        with self._lock:
+            stats = {
+                "time": time.time(),
+                "endpoints": [s.stats() for s in self.states.values()]
+            }
+        tmp = f"{self.args.stats}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(stats, f, indent=4)
+            os.replace(tmp, self.args.stats)
+        except OSError as e:
+            logging.warning(f"Cannot write {self.args.stats}: {e}")
+
+
+def parse_args():
+    """Parse arguments and return an argparse.Namespace.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Supervise the compute endpoints and restart any which "
+        "are offline"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="Seconds between checks of a healthy endpoint [default=60]."
+    )
+    parser.add_argument(
+        "--fast-interval",
+        type=float,
+        default=10,
+        help="Seconds between checks of an offline endpoint [default=10]."
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=30,
+        help="Seconds after a restart before the endpoint is restarted "
+        "again if it is still offline, doubling for each further restart "
+        "[default=30]."
+    )
+    parser.add_argument(
+        "--max-backoff",
+        type=float,
+        default=900,
+        help="Maximum seconds between restarts of an endpoint, and the "
+        "restart interval of a flapping endpoint [default=900]."
+    )
+    parser.add_argument(
+        "--flap-count",
+        type=int,
+        default=3,
+        help="Number of outages within --flap-window after which an "
+        "endpoint is flapping [default=3]."
+    )
+    parser.add_argument(
+        "--flap-window",
+        type=float,
+        default=3600,
+        help="Seconds over which outages are counted [default=3600]."
+    )
+    parser.add_argument(
+        "--restart-timeout",
+        type=float,
+        default=300,
+        help="Seconds after which a restart command which has not finished "
+        "is killed and the restart counted as failed [default=300]."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of endpoints checked or restarted at once [default=8]."
+    )
+    parser.add_argument(
+        "--stats",
+        type=str,
+        default=STATS,
+        help=f"JSON file to which uptime and restart-latency statistics are "
+        f"written every minute [default={STATS}]. Pass an empty string to "
+        "disable."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """The main: Supervise the endpoints.
+
+    """
+    Supervisor(parse_args()).run()
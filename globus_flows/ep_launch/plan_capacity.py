@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+##
+# @file:  plan_capacity.py
+# @brief: Fit a runtime-vs-input-size model to the task history recorded in
+# the stage manifests and recommend endpoint block counts and walltimes.
+#
+
+import os
+import re
+import sys
+import glob
+import json
+import math
+import argparse
+import statistics
+import logging
+logging.basicConfig(
+    format="%(asctime)s %(message)s",
+    datefmt="%m/%d/%Y %I:%M:%S %p",
+    stream=sys.stdout,
+    level=logging.INFO
+)
+
+# The manifests are written by the registered functions using manifest.py:
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CONFIG_DIR))
+from manifest import MANIFEST
+
+
+TOPLEVEL = "/global/cfs/cdirs/m4386/e21062_flows"
+
+# Stage output directory, endpoint configuration and whether the stage runs
+# one task per segment or one task per run:
+STAGES = {
+    "fit": ("fitted", "config-frib-fit-mpi.yaml", True),
+    "convert": ("converted", "config-frib-convert.yaml", True),
+    "analyze": ("analyzed", "config-frib-analysis.yaml", False)
+}
+
+
+def read_history(stage_dir, per_segment=True):
+    """Read the task history recorded in the manifests of a stage. The
+    per-segment stages keep a manifest in each run directory, keyed by
+    segment; the analysis keeps one manifest in the stage directory, keyed
+    by run.
+
+    Parameters
+    ----------
+    stage_dir : str
+        Top-level stage directory.
+    per_segment : bool
+        The stage runs one task per segment (default=True).
+
+    Returns
+    -------
+    list of tuple : float, float, str
+        (input size in GB, runtime in seconds, run) for each task with a
+        recorded runtime.
+
+    """
+    if per_segment:
+        paths = glob.glob(os.path.join(stage_dir, "run*", MANIFEST))
+    else:
+        paths = [os.path.join(stage_dir, MANIFEST)]
+
+    history = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping unreadable manifest {path}: {e}")
+            continue
+
+        # Runs are named by the directory of a per-segment manifest and by
+        # the entry key of the analysis manifest:
+        run_dir = os.path.basename(os.path.dirname(path))
+        for key, entry in entries.items():
+            run = run_dir if per_segment else key
+            sizes = [fp[0] for fp in entry["inputs"].values() if fp]
+            if entry.get("runtime") is not None and sizes:
+                history.append((sum(sizes)/1e9, entry["runtime"], run))
+
+    return history
+
+
+def read_config(path):
+    """Read the provisioning settings from an endpoint configuration.
+
+    Parameters
+    ----------
+    path : str
+        Path to the config-*.yaml file.
+
+    Returns
+    -------
+    dict
+        max_blocks, nodes_per_block, max_workers_per_node and walltime in
+        seconds. Settings which are not found are None.
+
+    """
+    with open(path) as f:
+        text = f.read()
+
+    config = {}
+    for key in ("max_blocks", "nodes_per_block", "max_workers_per_node"):
+        m = re.search(rf"^\s*{key}:\s*(\d+)", text, re.MULTILINE)
+        config[key] = int(m.group(1)) if m else None
+
+    m = re.search(r"^\s*walltime:\s*(\d+):(\d+):(\d+)", text, re.MULTILINE)
+    config["walltime"] = (
+        int(m.group(1))*3600 + int(m.group(2))*60 + int(m.group(3))
+        if m else None
+    )
+
+    return config
+
+
+def fit_model(history):
+    """Fit a linear runtime-vs-input-size model to the task history.
+
+    Parameters
+    ----------
+    history : list of tuple
+        (input size in GB, runtime in seconds, run) for each task.
+
+    Returns
+    -------
+    tuple : float, float, float
+        (intercept in seconds, slope in seconds per GB, standard deviation
+        of the residuals in seconds).
+
+    """
+    sizes = [h[0] for h in history]
+    runtimes = [h[1] for h in history]
+    if len(set(sizes)) < 2:
+        # Cannot fit a slope, assume runtime is proportional to size:
+        slope = statistics.fmean(runtimes)/max(statistics.fmean(sizes), 1e-9)
+        intercept = 0.0
+    else:
+        slope, intercept = statistics.linear_regression(sizes, runtimes)
+
+    residuals = [t - (intercept + slope*s) for s, t in zip(sizes, runtimes)]
+    sigma = statistics.stdev(residuals) if len(residuals) > 1 else 0.0
+
+    return intercept, slope, sigma
+
+
+def plan_stage(name, history, config, args):
+    """Recommend the block count and walltime for a stage and log the plan.
+
+    Parameters
+    ----------
+    name : str
+        Stage name.
+    history : list of tuple
+        (input size in GB, runtime in seconds, run) for each task.
+    config : dict
+        Current endpoint configuration, from read_config.
+    args : argparse.Namespace
+        Planning targets.
+
+    Returns
+    -------
+    dict
+        The model, predicted runtime and recommended settings.
+
+    """
+    per_segment = STAGES[name][2]
+    intercept, slope, sigma = fit_model(history)
+
+    # Expected work per run:
+    runs = {h[2] for h in history}
+    segments = args.segments or max(round(len(history)/len(runs)), 1)
+    size = args.segment_size or statistics.median(h[0] for h in history)
+    tasks, task_size = (segments, size) if per_segment else (1, segments*size)
+
+    # Runtime for most tasks, allowing for the spread about the model:
+    runtime = intercept + slope*task_size
+    runtime_p95 = runtime + 1.645*sigma
+
+    # Workers to keep up with the data rate, and to finish each run within
+    # the target turnaround given the number of task waves it needs:
+    workers = (
+        (config["max_workers_per_node"] or 1)*(config["nodes_per_block"] or 1)
+    )
+    task_rate = args.rate/(segments*size)*tasks/3600 # tasks per second
+    sustained = task_rate*runtime_p95
+    waves = max(math.floor(args.turnaround/runtime_p95), 1)
+    parallel = math.ceil(tasks/waves)
+    blocks = max(math.ceil(max(sustained, parallel)/workers), 1)
+
+    # Walltime rounded up to 15 minutes, long enough that few tasks are
+    # started too close to the end of a block to finish:
+    walltime = math.ceil(args.walltime_factor*runtime_p95/900)*900
+
+    plan = {
+        "stage": name,
+        "samples": len(history),
+        "intercept_s": intercept,
+        "slope_s_per_gb": slope,
+        "sigma_s": sigma,
+        "task_size_gb": task_size,
+        "runtime_s": runtime,
+        "runtime_p95_s": runtime_p95,
+        "max_blocks": config["max_blocks"],
+        "walltime_s": config["walltime"],
+        "recommended_max_blocks": blocks,
+        "recommended_walltime_s": walltime
+    }
+
+    logging.info(
+        f"{name}: {len(history)} tasks, runtime = {intercept:.0f} s + "
+        f"{slope:.1f} s/GB, sigma {sigma:.0f} s; {tasks} task(s) of "
+        f"{task_size:.2f} GB per run take {runtime:.0f} s "
+        f"(p95 {runtime_p95:.0f} s)"
+    )
+    logging.info(
+        f"{name}: max_blocks {config['max_blocks']} -> {blocks}, walltime "
+        f"{hms(config['walltime'])} -> {hms(walltime)}"
+    )
+    if config["walltime"] and runtime_p95 > args.margin*config["walltime"]:
+        logging.warning(
+            f"WARNING: {name} tasks are predicted to take up to "
+            f"{runtime_p95:.0f} s, close to the {hms(config['walltime'])} "
+            "block walltime; tasks may be killed when the block ends!"
+        )
+    if config["max_blocks"] and blocks > config["max_blocks"]:
+        logging.warning(
+            f"WARNING: {name} needs {blocks} blocks to meet the target, "
+            f"more than max_blocks {config['max_blocks']}."
+        )
+
+    return plan
+
+
+def hms(seconds):
+    """Format a duration in seconds as HH:MM:SS for the Slurm walltime.
+
+    """
+    if seconds is None:
+        return "unset"
+    seconds = int(seconds)
+    return f"{seconds//3600:02}:{seconds%3600//60:02}:{seconds%60:02}"
+
+
+def parse_args():
+    """Parse arguments and return an argparse.Namespace.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Recommend endpoint block counts and walltimes from "
+        "the task history in the stage manifests"
+    )
+    parser.add_argument(
+        "--toplevel",
+        type=str,
+        default=TOPLEVEL,
+        help=f"Top-level directory containing the fitted, converted and "
+        f"analyzed stage directories [default={TOPLEVEL}]."
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to plan [default=all]."
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        required=True,
+        help="Expected data rate in GB per hour."
+    )
+    parser.add_argument(
+        "--turnaround",
+        type=float,
+        default=3600,
+        help="Target time in seconds for a stage to process a run "
+        "[default=3600]."
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        help="(Optional) Expected segments per run. By default, the mean "
+        "number of segments per run in the history."
+    )
+    parser.add_argument(
+        "--segment-size",
+        type=float,
+        help="(Optional) Expected segment size in GB. By default, the "
+        "median segment size in the history."
+    )
+    parser.add_argument(
+        "--walltime-factor",
+        type=float,
+        default=4,
+        help="Recommended block walltime as a multiple of the p95 task "
+        "runtime [default=4]."
+    )
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.8,
+        help="Warn when the p95 task runtime exceeds this fraction of the "
+        "configured block walltime [default=0.8]."
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        help="(Optional) Write the plan for each stage to this JSON file."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """The main: Plan the capacity of each stage with a task history.
+
+    """
+    args = parse_args()
+
+    plans = []
+    for name in args.stages:
+        stage_dir, config_file, per_segment = STAGES[name]
+        history = read_history(
+            os.path.join(args.toplevel, stage_dir), per_segment
+        )
+        if not history:
+            logging.warning(f"No task history for {name}, skipping")
+            continue
+        config = read_config(os.path.join(CONFIG_DIR, config_file))
+        plans.append(plan_stage(name, history, config, args))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(plans, f, indent=4)
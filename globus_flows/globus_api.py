@@ -0,0 +1,268 @@
+##
+# @file globus_api.py
+# @brief Shared, rate-limited access to the Globus Compute and Flows APIs.
+# Every call made through a RateLimited client takes a token from a
+# process-wide token bucket and is retried with jittered exponential backoff
+# on throttling (429), server errors (5xx) and network errors. Calls are
+# counted per method. Installed alongside the job scripts for the
+# registered functions and imported as globus_flows.globus_api on the DTN.
+#
+
+import time
+import random
+import logging
+import functools
+import threading
+import collections
+
+import globus_sdk
+
+
+RATE = 10           # Sustained API calls per second for the process.
+BURST = 20          # Calls which may be made at once after an idle period.
+MAX_RETRIES = 5
+BASE_DELAY = 1      # Seconds, doubled for each retry.
+MAX_DELAY = 60
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Calls which create something, e.g. a flow run or a batch of tasks, are only
+# retried when throttled, as a server or network error does not show whether
+# the request was carried out:
+NON_IDEMPOTENT = (
+    "run_flow", "batch_run", "run", "register_function", "create_flow",
+    "update_flow"
+)
+
+# Client methods which do not call the API:
+LOCAL = ("create_batch",)
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter.
+
+    Attributes
+    ----------
+    rate : float
+        Tokens added per second.
+    burst : float
+        Maximum number of tokens held.
+
+    Methods
+    -------
+    acquire
+        Take a token, waiting until one is available.
+
+    """
+
+    def __init__(self, rate=RATE, burst=BURST):
+        """Constructor.
+
+        Parameters
+        ----------
+        rate : float
+            Tokens added per second (default=RATE).
+        burst : float
+            Maximum number of tokens held (default=BURST).
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        """Take a token, waiting until one is available.
+
+        Returns
+        -------
+        float
+            Seconds waited.
+
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated)*self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens)/self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+# Limiter, counters and clients shared by every thread in the process:
+BUCKET = TokenBucket()
+COUNTERS = collections.defaultdict(collections.Counter)
+COUNTERS_LOCK = threading.Lock()
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def count(method, key, n=1):
+    """Add to a per-method counter."""
+    with COUNTERS_LOCK:
+        COUNTERS[method][key] += n
+
+
+def stats():
+    """Return the API call counters.
+
+    Returns
+    -------
+    dict
+        Counts of "calls", "retries", "throttled", "errors" and the seconds
+        spent waiting for the rate limiter, "limited_s", keyed by method
+        name.
+
+    """
+    with COUNTERS_LOCK:
+        return {method: dict(c) for method, c in COUNTERS.items()}
+
+
+def retryable(error, method):
+    """Return True if a failed call may be retried.
+
+    Parameters
+    ----------
+    error : Exception
+        Exception raised by the call.
+    method : str
+        Name of the client method.
+
+    Returns
+    -------
+    bool
+        True for throttling, and for server and network errors of calls
+        which are safe to repeat.
+
+    """
+    status = getattr(error, "http_status", None)
+    if status == 429:
+        return True
+    if method in NON_IDEMPOTENT:
+        return False
+
+    return status in RETRY_STATUS or isinstance(error, globus_sdk.NetworkError)
+
+
+class RateLimited:
+    """Wrap a Globus SDK or Globus Compute client so that its API calls are
+    rate limited by the process-wide token bucket, retried with jitter and
+    counted. Attributes which are not methods, e.g. paginators, are passed
+    through unchanged. Note that the SDK transport makes its own retries
+    before an error reaches the wrapper.
+
+    Attributes
+    ----------
+    client : object
+        The wrapped client.
+    bucket : TokenBucket
+        Rate limiter shared by the wrapped clients.
+    max_retries : int
+        Maximum retries of each call.
+
+    """
+
+    def __init__(self, client, bucket=None, max_retries=MAX_RETRIES):
+        """Constructor.
+
+        Parameters
+        ----------
+        client : object
+            Client to wrap.
+        bucket : TokenBucket
+            Rate limiter. If None, the process-wide BUCKET (default=None).
+        max_retries : int
+            Maximum retries of each call (default=MAX_RETRIES).
+
+        """
+        self.client = client
+        self.bucket = bucket or BUCKET
+        self.max_retries = max_retries
+
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or name in LOCAL or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+
+        return call
+
+
+    def call(self, name, fn, *args, **kwargs):
+        """Make a rate-limited API call, retrying it with full jitter: the
+        n-th retry waits a random time up to BASE_DELAY*2**n seconds, capped
+        at MAX_DELAY, or the Retry-After time if the service sets one.
+
+        Parameters
+        ----------
+        name : str
+            Method name, for the counters.
+        fn : function
+            Bound client method.
+        *args, **kwargs
+            Method arguments.
+
+        Returns
+        -------
+        object
+            Return value of the method.
+
+        """
+        attempt = 0
+        while True:
+            count(name, "limited_s", self.bucket.acquire())
+            count(name, "calls")
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = getattr(e, "http_status", None)
+                if status == 429:
+                    count(name, "throttled")
+                if attempt >= self.max_retries or not retryable(e, name):
+                    count(name, "errors")
+                    raise
+
+                delay = random.uniform(
+                    0, min(MAX_DELAY, BASE_DELAY*2**attempt)
+                )
+                headers = getattr(e, "headers", None) or {}
+                if headers.get("Retry-After", "").isdigit():
+                    delay = max(delay, int(headers["Retry-After"]))
+                attempt += 1
+                count(name, "retries")
+                logging.warning(
+                    f"{name} failed ({status or type(e).__name__}), retry "
+                    f"{attempt}/{self.max_retries} in {delay:.1f} s"
+                )
+                time.sleep(delay)
+
+
+def compute_client():
+    """Return the rate-limited Globus Compute client shared by this process,
+    creating it on first use so that connections are reused.
+
+    Returns
+    -------
+    RateLimited
+        The shared globus_compute_sdk.Client.
+
+    """
+    with CLIENTS_LOCK:
+        if "compute" not in CLIENTS:
+            from globus_compute_sdk import Client
+            CLIENTS["compute"] = RateLimited(Client())
+
+        return CLIENTS["compute"]
@@ -0,0 +1,206 @@
+##
+# @file manifest.py
+# @brief Per-directory manifests of the outputs produced by each pipeline
+# stage, so that reprocessing a run only resubmits the segments whose inputs
+# or tools have changed. Used by the registered fit, convert and analyze
+# functions, which import it from the globus_flows directory installed at
+# NERSC.
+#
+
+import os
+import json
+import fcntl
+
+
+MANIFEST = ".manifest.json"
+
+# Container image and host paths of the tools run by each stage:
+IMAGE = "fribdaq/frib-buster:v4.2"
+OPT = "/global/cfs/cdirs/m4386/opt-buster"
+STAGE_TOOLS = {
+    "fit": (
+        f"{OPT}/daq/12.0-013/bin/EventEditor",
+        f"{OPT}/ddastoys/lib/libFitEditorAnalytic.so"
+    ),
+    "convert": (
+        f"{OPT}/ddastoys/bin/eeconverter",
+    ),
+    "analyze": (
+        "/global/cfs/cdirs/m4386/e21062_flows/software/betasort/betasort",
+    )
+}
+
+
+def fingerprint(path):
+    """Return the fingerprint of a file, or None if it does not exist.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    list : int, float
+        [size, mtime] of the file.
+
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return [st.st_size, st.st_mtime]
+
+
+def tool_version(stage, image=IMAGE):
+    """Return the version of the tools used by a pipeline stage: the
+    container image tag and the fingerprints of the executables and
+    libraries it runs, as seen from the host.
+
+    Parameters
+    ----------
+    stage : str
+        Pipeline stage, one of "fit", "convert" or "analyze".
+    image : str
+        Shifter image tag (default=IMAGE).
+
+    Returns
+    -------
+    dict
+        Tool version, comparable with the version stored in a manifest.
+
+    """
+    return {
+        "image": image,
+        "tools": {t: fingerprint(t) for t in STAGE_TOOLS[stage]}
+    }
+
+
+class Manifest:
+    """Manifest of the outputs in a stage directory. Each entry records the
+    fingerprints of the inputs used to produce an output, the tool version
+    and the task runtime. An output is stale if it is missing, has no entry,
+    or its inputs or the tool version have changed since it was produced.
+
+    Attributes
+    ----------
+    directory : str
+        Stage output directory holding the manifest.
+    version : dict
+        Current tool version, from tool_version.
+    entries : dict
+        Manifest entries keyed by segment.
+
+    Methods
+    -------
+    stale
+        Return True if an output must be (re)produced.
+    record
+        Record a newly produced output.
+    save
+        Merge the recorded entries into the manifest on disk.
+
+    """
+
+    def __init__(self, directory, version):
+        """Constructor. Loads the manifest if it exists.
+
+        Parameters
+        ----------
+        directory : str
+            Stage output directory holding the manifest.
+        version : dict
+            Current tool version, from tool_version.
+
+        """
+        self.directory = directory
+        self.version = version
+        self.entries = self._load()
+        self._updates = {}
+
+
+    def stale(self, key, inputs, output):
+        """Return True if an output must be (re)produced.
+
+        Parameters
+        ----------
+        key : str
+            Manifest entry key, e.g. the segment number.
+        inputs : list of str
+            Paths to the input files used to produce the output.
+        output : str
+            Path to the output file.
+
+        Returns
+        -------
+        bool
+            True if the output is stale.
+
+        """
+        entry = self.entries.get(str(key))
+        return (
+            entry is None
+            or not os.path.exists(output)
+            or entry["version"] != self.version
+            or entry["inputs"] != self._fingerprints(inputs)
+        )
+
+
+    def record(self, key, inputs, output, runtime=None):
+        """Record a newly produced output. Entries are written by save.
+
+        Parameters
+        ----------
+        key : str
+            Manifest entry key, e.g. the segment number.
+        inputs : list of str
+            Paths to the input files used to produce the output.
+        output : str
+            Path to the output file.
+        runtime : float
+            Task runtime in seconds (default=None).
+
+        """
+        self._updates[str(key)] = {
+            "inputs": self._fingerprints(inputs),
+            "output": os.path.basename(output),
+            "version": self.version,
+            "runtime": runtime
+        }
+
+
+    def save(self):
+        """Merge the recorded entries into the manifest on disk. The
+        manifest is reloaded and replaced atomically under a lock, so that
+        flows processing different segments of the same run do not lose
+        each other's entries.
+
+        """
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.entries = self._load()
+            self.entries.update(self._updates)
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        self._updates = {}
+
+
+    def _load(self):
+        """Load the manifest entries from disk, empty if none exist.
+
+        """
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+
+    def _fingerprints(self, inputs):
+        """Return the fingerprints of input files keyed by file name.
+
+        """
+        return {os.path.basename(p): fingerprint(p) for p in inputs}
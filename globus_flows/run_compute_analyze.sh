@@ -9,13 +9,24 @@
 # @param 2 Number of segments. If 0 (zero), sort only the first segment.
 #
 
+# Stage files with stage.py, which copies large files as several byte ranges
+# in parallel and logs the throughput. Set STAGE_OPTS=--verify, e.g. in the
+# shifter env file, to checksum and verify every copy instead of using the
+# zero-copy in-kernel paths:
+
+stage() { python3 $HOME/globus_flows/stage.py $STAGE_OPTS "$@"; }
+
 # Format input:
 
 run=$1
 fmtrun=$(printf "%04d" $1)
 nsegs=$2
 
-# Set paths, copy input to the node for performant I/O:
+# Set paths, copy input to the node for performant I/O. The directories are
+# the container mounts unless overridden, e.g. by a warm worker:
+
+indir=${INPUT_DIR:-/input}
+outdir=${OUTPUT_DIR:-/output}
 
 tmpin=/tmp/tmprun$run-$SLURM_JOB_ID-$SLURMD_NODENAME
 tmpout=/tmp
@@ -27,23 +38,53 @@ cat <<EOF >> $logfile
 JobID   $SLURM_JOB_ID
 Time    $SLURM_JOB_START_TIME
 Node    $SLURMD_NODENAME
-DirIn  	/input/*.root
-DirOut  /output/run-$fmtrun-sorted.root
+DirIn  	$indir/*.root
+DirOut  $outdir/run-$fmtrun-sorted.root
 NSegs   $nsegs
 Image   $SHIFTER_IMAGEREQUEST
 
 EOF
 
+# Each step is checked; on failure the partial output is removed and the
+# script exits with the status of the failed step, so that an analysis of
+# missing segments is not reported as a success.
+
+sorted=run-$fmtrun-sorted.root
+
 echo "Copying input..." >> $logfile
-cp -rv /input $tmpin >> $logfile 2>&1
+stage $indir $tmpin >> $logfile 2>&1
+status=$?
+if [ $status -ne 0 ]
+then
+    echo "Copying input failed with status $status" >> $logfile
+    rm -vrf $tmpin/ >> $logfile 2>&1
+    exit $status
+fi
 echo "... Done\n" >> $logfile
 
 # Build all segments into the TChain for analysis. The trailing slashes
 # on the dirs are necessary... sigh...:
 /global/cfs/cdirs/m4386/e21062_flows/software/betasort/betasort \
     $tmpin/ $tmpout/ $run $nsegs >> $logfile 2>&1
+status=$?
 
 echo "Moving output and cleaing up..." >> $logfile
 rm -vrf $tmpin/ >> $logfile 2>&1
-mv -vf $tmpout/run-$fmtrun-sorted.root /output >> $logfile 2>&1
+if [ $status -ne 0 ]
+then
+    echo "Sorting failed with status $status" >> $logfile
+    rm -vf $tmpout/$sorted >> $logfile 2>&1
+    exit $status
+fi
+
+stage --move $tmpout/$sorted $outdir >> $logfile 2>&1
+status=$?
+if [ $status -ne 0 ]
+then
+    echo "Moving output failed with status $status" >> $logfile
+    rm -vf $tmpout/$sorted $outdir/$sorted >> $logfile 2>&1
+    exit $status
+fi
 echo "... All done" >> $logfile
+
+exit 0
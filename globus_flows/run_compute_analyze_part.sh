@@ -0,0 +1,85 @@
+#!/bin/bash
+
+##
+# @file run_compute_analyze_part.sh
+# @brief Run the Liddick group betasort code over a group of consecutive run
+# segments in a containerized environment, producing one part of the sorted
+# output which is merged with the others by run_compute_merge.sh. The
+# segments are staged in /tmp renumbered from 00 so that betasort sorts
+# exactly this group. Move the staged output to CFS on completion. Log the
+# output.
+# @param 1 Run number.
+# @param 2 Part number.
+# @param 3... Run segments in the part.
+#
+
+# Stage files with stage.py, which copies large files as several byte ranges
+# in parallel and logs the throughput. Set STAGE_OPTS=--verify, e.g. in the
+# shifter env file, to checksum and verify every copy instead of using the
+# zero-copy in-kernel paths:
+
+stage() { python3 $HOME/globus_flows/stage.py $STAGE_OPTS "$@"; }
+
+# Format input:
+
+run=$1
+fmtrun=$(printf "%04d" $1)
+part=$(printf "%02d" $2)
+shift 2
+segs=$(for s in "$@"; do printf "%02d " $s; done)
+
+# Set paths. The directories are the container mounts unless overridden,
+# e.g. by a warm worker. Each part sorts into its own /tmp directory, as
+# several parts may run on one node:
+
+indir=${INPUT_DIR:-/input}
+outdir=${OUTPUT_DIR:-/output}
+output=$outdir/run-$fmtrun-sorted-p$part.root
+
+tmpin=/tmp/tmprun$run-p$part-$SLURM_JOB_ID-$SLURMD_NODENAME
+tmpout=/tmp/tmpout$run-p$part-$SLURM_JOB_ID-$SLURMD_NODENAME
+#tmpin=$PSCRATCH/tmprun$run-p$part-$SLURM_JOB_ID-$SLURMD_NODENAME
+#tmpout=$PSCRATCH/tmpout$run-p$part-$SLURM_JOB_ID-$SLURMD_NODENAME
+
+logfile=$HOME/globus_flows/flow_logs/analysis-run$run-p$part-$SLURM_JOB_ID-$SLURMD_NODENAME.out
+cat <<EOF >> $logfile
+JobID    $SLURM_JOB_ID
+Time     $SLURM_JOB_START_TIME
+Node     $SLURMD_NODENAME
+Part     $part
+Segments $segs
+DirIn    $indir
+FileOut  $output
+Image    $SHIFTER_IMAGEREQUEST
+
+EOF
+
+echo "Copying input..." >> $logfile
+mkdir -p $tmpin $tmpout
+n=0
+for s in $segs
+do
+    stage $indir/run-$fmtrun-$s-fitted.root \
+	  $tmpin/run-$fmtrun-$(printf "%02d" $n)-fitted.root >> $logfile 2>&1 \
+	|| exit 1
+    n=$((n + 1))
+done
+echo "... Done" >> $logfile
+
+# Build the segments of this part into the TChain for analysis. The
+# trailing slashes on the dirs are necessary... sigh...:
+/global/cfs/cdirs/m4386/e21062_flows/software/betasort/betasort \
+    $tmpin/ $tmpout/ $run $n >> $logfile 2>&1
+status=$?
+
+echo "Moving output and cleaning up..." >> $logfile
+rm -vrf $tmpin/ >> $logfile 2>&1
+if [ $status -eq 0 ]
+then
+    stage --move $tmpout/run-$fmtrun-sorted.root $output >> $logfile 2>&1 \
+	|| status=$?
+fi
+rm -vrf $tmpout/ >> $logfile 2>&1
+echo "... All done" >> $logfile
+
+exit $status
@@ -4,53 +4,132 @@
 # @file run_compute_analyze.sh
 # @brief Convert EventEditor output too ROOT format in a containerized
 # environment. Stage I/O in /tmp space, move staged output to CFS on
-# completion. Log the output.
+# completion. Log the output. When several segments are given, the input of
+# the next segment is copied to /tmp while the current one is converted, and
+# each output is moved to CFS in the background.
 # @param 1 Run number.
-# @param 2 Number of segments. If 0 (zero), sort only the first segment.
+# @param 2... Run segments.
 #
 
-# Configure the runtime environment in the container:
+# Configure the runtime environment in the container, unless a warm worker
+# (container_worker.py) has already done so:
 
-source /usr/opt/root/root-6.24.06/bin/thisroot.sh
+if [ -z "$FRIB_ENV_READY" ]
+then
+    source /usr/opt/root/root-6.24.06/bin/thisroot.sh
+fi
+
+# Stage files with stage.py, which copies large files as several byte ranges
+# in parallel and logs the throughput. Set STAGE_OPTS=--verify, e.g. in the
+# shifter env file, to checksum and verify every copy instead of using the
+# zero-copy in-kernel paths:
+
+stage() { python3 $HOME/globus_flows/stage.py $STAGE_OPTS "$@"; }
 
 # Format input:
 
 run=$1
 fmtrun=$(printf "%04d" $1)
-seg=$(printf "%02d" $2)
+shift
+segs=$(for s in "$@"; do printf "%02d " $s; done)
 
-# Set paths, copy input to the node for performant I/O:
+# Set paths, copy input to the node for performant I/O. The directories are
+# the container mounts unless overridden, e.g. by a warm worker:
 
-input=/input/run-$fmtrun-$seg-fitted.evt
-output=/output/$(echo $input | cut -d '/' -f 3 | cut -d '.' -f 1).root
-tmpin=/tmp/tmpin-$SLURM_JOB_ID-run-$run-$seg.evt
-tmpout=/tmp/tmpout-$SLURM_JOB_ID-run-$run-$seg.root
-#tmpin=$PSCRATCH/tmpin-$SLURM_JOB_ID-run-$run-$seg.evt
-#tmpout=$PSCRATCH/tmpout-$SLURM_JOB_ID-run-$run-$seg.root
+input()  { echo ${INPUT_DIR:-/input}/run-$fmtrun-$1-fitted.evt; }
+output() { echo ${OUTPUT_DIR:-/output}/run-$fmtrun-$1-fitted.root; }
+tmpin()  { echo /tmp/tmpin-$SLURM_JOB_ID-run-$run-$1.evt; }
+tmpout() { echo /tmp/tmpout-$SLURM_JOB_ID-run-$run-$1.root; }
+#tmpin()  { echo $PSCRATCH/tmpin-$SLURM_JOB_ID-run-$run-$1.evt; }
+#tmpout() { echo $PSCRATCH/tmpout-$SLURM_JOB_ID-run-$run-$1.root; }
 
 # Using SLURM stdout and stderr redirection does not work for compute, as the
 # Globus manager is doing quite a lot of overhead work. Therefore, we define
 # our own log file and write to that one:
 
-logfile=$HOME/globus_flows/flow_logs/converted-run$run-$seg-$SLURM_JOB_ID-$SLURMD_NODENAME.out
+logfile=$HOME/globus_flows/flow_logs/converted-run$run-$(echo $segs | tr ' ' '-')-$SLURM_JOB_ID-$SLURMD_NODENAME.out
 cat <<EOF >> $logfile
-JobID   $SLURM_JOB_ID
-Time    $SLURM_JOB_START_TIME
-Node    $SLURMD_NODENAME
-FileIn  $input
-FileOut $output
-ROOT    $(which root)
-Image   $SHIFTER_IMAGEREQUEST
+JobID    $SLURM_JOB_ID
+Time     $SLURM_JOB_START_TIME
+Node     $SLURMD_NODENAME
+Segments $segs
+FileIn   $(for s in $segs; do input $s; done | tr "\n" " ")
+FileOut  $(for s in $segs; do output $s; done | tr "\n" " ")
+ROOT     $(which root)
+Image    $SHIFTER_IMAGEREQUEST
 
 EOF
 
-echo "Copying input..." >> $logfile
-cp -v $input $tmpin >> $logfile 2>&1
+# Segments which failed at any step are collected in $failed and reported
+# on stdout, which the callback returns, so that only they are retried:
+
+failed=""
+set -- $segs
+echo "Copying input for segment $1..." >> $logfile
+stage $(input $1) $(tmpin $1) >> $logfile 2>&1 || failed="$failed $1"
 echo "... Done" >> $logfile
 
-/usr/opt/ddastoys/bin/eeconverter -s file://$tmpin -f $tmpout >> $logfile 2>&1
+movers=""
+while [ $# -gt 0 ]
+do
+    seg=$1
+    next=$2
+    shift
+
+    # Prefetch the next segment while this one is converted:
+    if [ -n "$next" ]
+    then
+	echo "Prefetching input for segment $next..." >> $logfile
+	stage $(input $next) $(tmpin $next) >> $logfile 2>&1 &
+	prefetch=$!
+    fi
+
+    if [[ " $failed " == *" $seg "* ]]
+    then
+	echo "Staging input for segment $seg failed, skipping it" >> $logfile
+	rm -vf $(tmpin $seg) >> $logfile 2>&1
+	if [ -n "$next" ]
+	then
+	    wait $prefetch || failed="$failed $next"
+	fi
+	continue
+    fi
 
-echo "Moving output and cleaning up..." >> $logfile
-rm -vf $tmpin >> $logfile 2>&1
-mv -vf $tmpout $output >> $logfile 2>&1
+    echo "Converting segment $seg..." >> $logfile
+    /usr/opt/ddastoys/bin/eeconverter \
+	-s file://$(tmpin $seg) -f $(tmpout $seg) >> $logfile 2>&1
+    rc=$?
+    rm -vf $(tmpin $seg) >> $logfile 2>&1
+
+    # Move the output to CFS while the next segment is converted:
+    if [ $rc -eq 0 ]
+    then
+	echo "Moving output for segment $seg..." >> $logfile
+	stage --move $(tmpout $seg) $(output $seg) >> $logfile 2>&1 &
+	movers="$movers $!:$seg"
+    else
+	echo "Converting segment $seg failed with status $rc" >> $logfile
+	rm -vf $(tmpout $seg) >> $logfile 2>&1
+	failed="$failed $seg"
+    fi
+
+    if [ -n "$next" ]
+    then
+	wait $prefetch || failed="$failed $next"
+    fi
+done
+
+echo "Waiting for output to move and cleaning up..." >> $logfile
+for mover in $movers
+do
+    wait ${mover%:*} || failed="$failed ${mover#*:}"
+done
 echo "... All done" >> $logfile
+
+if [ -n "$failed" ]
+then
+    echo "Failed segments:$failed" | tee -a $logfile
+    exit 1
+fi
+
+exit 0
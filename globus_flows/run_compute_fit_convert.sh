@@ -0,0 +1,143 @@
+#!/bin/bash
+
+##
+# @file run_compute_fit_convert.sh
+# @brief Fit traces in an .evt file with the EventEditor using MPI
+# parallelism, then convert the fitted output to ROOT format on the same
+# node from in a containerized environment. Stage I/O in /tmp space, convert
+# the staged fit output directly and move only the fitted and converted
+# files to CFS on completion. Log the output.
+# @param 1 Run number.
+# @param 2 Run segment.
+#
+
+# Configure the runtime environment in the container, unless a warm worker
+# (container_worker.py) has already done so:
+
+if [ -z "$FRIB_ENV_READY" ]
+then
+    source /usr/opt/daq/12.0-013/daqsetup.bash
+    source /usr/opt/root/root-6.24.06/bin/thisroot.sh
+    export PATH=$MPI_ROOT/bin:$PATH
+    export LD_LIBRARY_PATH=$MPI_ROOT/lib:$LD_LIBRARY_PATH
+fi
+
+# Stage files with stage.py, which copies large files as several byte ranges
+# in parallel and logs the throughput. Set STAGE_OPTS=--verify, e.g. in the
+# shifter env file, to checksum and verify every copy instead of using the
+# zero-copy in-kernel paths:
+
+stage() { python3 $HOME/globus_flows/stage.py $STAGE_OPTS "$@"; }
+
+# Format input:
+
+run=$1
+fmtrun=$(printf "%04d" $1)
+seg=$(printf "%02d" $2)
+
+# Set paths, copy input to the node for performant I/O. The directories are
+# the container mounts unless overridden, e.g. by a warm worker:
+
+input=${INPUT_DIR:-/input}/run-$fmtrun-$seg.evt
+output=${OUTPUT_DIR:-/output}/run-$fmtrun-$seg-fitted.evt
+converted=${CONVERTED_DIR:-/converted}/run-$fmtrun-$seg-fitted.root
+tmpin=/tmp/tmpin-$SLURM_JOB_ID-run-$run-$seg.evt
+tmpout=/tmp/tmpout-$SLURM_JOB_ID-run-$run-$seg.evt
+tmproot=/tmp/tmpout-$SLURM_JOB_ID-run-$run-$seg.root
+
+tasks=$SLURM_CPUS_PER_TASK
+nworkers=`expr $tasks - 3` # 3 reserved for fan-in, fan-out, sort (MPI only!)
+
+# Using SLURM stdout and stderr redirection does not work for compute, as the
+# Globus manager is doing quite a lot of overhead work. Therefore, we define
+# our own log file and write to that one:
+
+logfile=$HOME/globus_flows/flow_logs/fitconvert-run$run-$seg-$SLURM_JOB_ID-$SLURMD_NODENAME.out
+cat <<EOL >> $logfile
+JobID     $SLURM_JOB_ID
+Time      $SLURM_JOB_START_TIME
+Node      $SLURMD_NODENAME
+Tasks     $tasks
+Workers   $nworkers
+FileIn    $input
+FileOut   $output
+Converted $converted
+DAQBIN    $DAQBIN
+MPI       $(which mpirun)
+ROOT      $(which root)
+Image     $SHIFTER_IMAGEREQUEST
+
+EOL
+
+# Each step is checked; on failure the partial output on the node is
+# removed and the script exits with the status of the failed step.
+
+echo "Copying input..." >> $logfile
+stage $input $tmpin >> $logfile 2>&1
+status=$?
+if [ $status -ne 0 ]
+then
+    echo "Copying input failed with status $status" >> $logfile
+    rm -vf $tmpin >> $logfile 2>&1
+    exit $status
+fi
+echo "... Done" >> $logfile
+
+# See run_compute_fit_mpi.sh for the mpirun options:
+
+echo "Fitting traces with mpirun -np $tasks $DAQBIN/EventEditor..." >> $logfile
+mpirun --use-hwthread-cpus --oversubscribe -np $tasks \
+     $DAQBIN/EventEditor \
+     -s file://$tmpin \
+     -S file://$tmpout \
+     -l /usr/opt/ddastoys/lib/libFitEditorAnalytic.so \
+     -n $nworkers \
+     -c 2000 \
+     -p mpi >> $logfile 2>&1
+status=$?
+rm -vf $tmpin >> $logfile 2>&1
+
+if [ $status -ne 0 ]
+then
+    echo "Fitting failed with status $status" >> $logfile
+    rm -vf $tmpout >> $logfile 2>&1
+    exit $status
+fi
+
+# Convert the fitted output while it is still on the node:
+
+echo "Converting $tmpout to ROOT format..." >> $logfile
+/usr/opt/ddastoys/bin/eeconverter -s file://$tmpout -f $tmproot >> $logfile 2>&1
+status=$?
+
+if [ $status -ne 0 ]
+then
+    echo "Converting failed with status $status" >> $logfile
+    rm -vf $tmpout $tmproot >> $logfile 2>&1
+    exit $status
+fi
+
+# The ROOT file is only moved once the fitted file it was converted from is
+# in place, and a partial copy left by a failed move is removed:
+
+echo "Moving output and cleaning up..." >> $logfile
+stage --move $tmpout $output >> $logfile 2>&1
+status=$?
+if [ $status -ne 0 ]
+then
+    echo "Moving fitted output failed with status $status" >> $logfile
+    rm -vf $tmpout $tmproot $output >> $logfile 2>&1
+    exit $status
+fi
+
+stage --move $tmproot $converted >> $logfile 2>&1
+status=$?
+if [ $status -ne 0 ]
+then
+    echo "Moving converted output failed with status $status" >> $logfile
+    rm -vf $tmproot $converted >> $logfile 2>&1
+    exit $status
+fi
+echo "... All done" >> $logfile
+
+exit 0
@@ -2,33 +2,49 @@
 
 ##
 # @file run_compute_fit_mpi.sh
-# @brief Run the EventEditor to fit traces in an .evt file using MPI
+# @brief Run the EventEditor to fit traces in .evt files using MPI
 # parallelism from in a containerized environment. Stage I/O in /tmp space,
-# move staged output to CFS on completion. Log the output.
+# move staged output to CFS on completion. Log the output. When several
+# segments are given, the input of the next segment is copied to /tmp while
+# the current one is fitted, and each output is moved to CFS in the
+# background.
 # @param 1 Run number.
-# @param 2 Run segment.
+# @param 2... Run segments.
 #
 
-# Configure the runtime environment in the container:
- 
-source /usr/opt/daq/12.0-013/daqsetup.bash
-export PATH=$MPI_ROOT/bin:$PATH
-export LD_LIBRARY_PATH=$MPI_ROOT/lib:$LD_LIBRARY_PATH
+# Configure the runtime environment in the container, unless a warm worker
+# (container_worker.py) has already done so:
+
+if [ -z "$FRIB_ENV_READY" ]
+then
+    source /usr/opt/daq/12.0-013/daqsetup.bash
+    export PATH=$MPI_ROOT/bin:$PATH
+    export LD_LIBRARY_PATH=$MPI_ROOT/lib:$LD_LIBRARY_PATH
+fi
+
+# Stage files with stage.py, which copies large files as several byte ranges
+# in parallel and logs the throughput. Set STAGE_OPTS=--verify, e.g. in the
+# shifter env file, to checksum and verify every copy instead of using the
+# zero-copy in-kernel paths:
+
+stage() { python3 $HOME/globus_flows/stage.py $STAGE_OPTS "$@"; }
 
 # Format input:
 
 run=$1
 fmtrun=$(printf "%04d" $1)
-seg=$(printf "%02d" $2)
+shift
+segs=$(for s in "$@"; do printf "%02d " $s; done)
 
-# Set paths, copy input to the node for performant I/O:
+# Set paths, copy input to the node for performant I/O. The directories are
+# the container mounts unless overridden, e.g. by a warm worker:
 
-input=/input/run-$fmtrun-$seg.evt
-output=/output/$(echo $input | cut -d '/' -f 3 | cut -d '.' -f 1)-fitted.evt
-tmpin=/tmp/tmpin-$SLURM_JOB_ID-run-$run-$seg.evt
-tmpout=/tmp/tmpout-$SLURM_JOB_ID-run-$run-$seg.evt
-#tmpin=$PSCRATCH/tmpin-$SLURM_JOB_ID-run-$run-$seg.evt
-#tmpout=$PSCRATCH/tmpout-$SLURM_JOB_ID-run-$run-$seg.evt
+input()  { echo ${INPUT_DIR:-/input}/run-$fmtrun-$1.evt; }
+output() { echo ${OUTPUT_DIR:-/output}/run-$fmtrun-$1-fitted.evt; }
+tmpin()  { echo /tmp/tmpin-$SLURM_JOB_ID-run-$run-$1.evt; }
+tmpout() { echo /tmp/tmpout-$SLURM_JOB_ID-run-$run-$1.evt; }
+#tmpin()  { echo $PSCRATCH/tmpin-$SLURM_JOB_ID-run-$run-$1.evt; }
+#tmpout() { echo $PSCRATCH/tmpout-$SLURM_JOB_ID-run-$run-$1.evt; }
 
 tasks=$SLURM_CPUS_PER_TASK
 nworkers=`expr $tasks - 3` # 3 reserved for fan-in, fan-out, sort (MPI only!)
@@ -37,42 +53,105 @@ nworkers=`expr $tasks - 3` # 3 reserved for fan-in, fan-out, sort (MPI only!)
 # Globus manager is doing quite a lot of overhead work. Therefore, we define
 # our own log file and write to that one:
 
-logfile=$HOME/globus_flows/flow_logs/fitoutput-run$run-$seg-$SLURM_JOB_ID-$SLURMD_NODENAME.out
+logfile=$HOME/globus_flows/flow_logs/fitoutput-run$run-$(echo $segs | tr ' ' '-')-$SLURM_JOB_ID-$SLURMD_NODENAME.out
 cat <<EOF >> $logfile
-JobID   $SLURM_JOB_ID
-Time    $SLURM_JOB_START_TIME
-Node    $SLURMD_NODENAME
-Tasks   $tasks
-Workers $nworkers
-FileIn  $input
-FileOut $output
-DAQBIN  $DAQBIN
-MPI     $(which mpirun)
-Image   $SHIFTER_IMAGEREQUEST
+JobID    $SLURM_JOB_ID
+Time     $SLURM_JOB_START_TIME
+Node     $SLURMD_NODENAME
+Tasks    $tasks
+Workers  $nworkers
+Segments $segs
+FileIn   $(for s in $segs; do input $s; done | tr "\n" " ")
+FileOut  $(for s in $segs; do output $s; done | tr "\n" " ")
+DAQBIN   $DAQBIN
+MPI      $(which mpirun)
+Image    $SHIFTER_IMAGEREQUEST
 
 EOF
 
-echo "Copying input..." >> $logfile
-cp -v $input $tmpin >> $logfile 2>&1
+# Segments which failed at any step are collected in $failed and reported
+# on stdout, which the callback returns, so that only they are retried:
+
+failed=""
+set -- $segs
+echo "Copying input for segment $1..." >> $logfile
+stage $(input $1) $(tmpin $1) >> $logfile 2>&1 || failed="$failed $1"
 echo "... Done" >> $logfile
 
-# Run the fitter and write to our log. mpirun's --use-hwthread-cpus and
-# --oversubscribe options are some chicanery which allows us to run multiple
-# Parsl-managed fitting tasks on a single node each using the number of 'CPUs'
-# specified by the SBATCH --cpus-per-task option. A little unexpected compared
-# to specifiying --ntasks-per-node but the resource usage looks OK, so:
-
-echo "Fitting traces with mpirun -np $tasks $DAQBIN/EventEditor..." >> $logfile
-mpirun --use-hwthread-cpus --oversubscribe -np $tasks \
-     $DAQBIN/EventEditor \
-     -s file://$tmpin \
-     -S file://$tmpout \
-     -l /usr/opt/ddastoys/lib/libFitEditorAnalytic.so \
-     -n $nworkers \
-     -c 2000 \
-     -p mpi >> $logfile 2>&1
-
-echo "Moving output and cleaning up..." >> $logfile
-rm -vf $tmpin >> $logfile 2>&1 
-mv -vf $tmpout $output >> $logfile  2>&1
+movers=""
+while [ $# -gt 0 ]
+do
+    seg=$1
+    next=$2
+    shift
+
+    # Prefetch the next segment while this one is fitted:
+    if [ -n "$next" ]
+    then
+	echo "Prefetching input for segment $next..." >> $logfile
+	stage $(input $next) $(tmpin $next) >> $logfile 2>&1 &
+	prefetch=$!
+    fi
+
+    if [[ " $failed " == *" $seg "* ]]
+    then
+	echo "Staging input for segment $seg failed, skipping it" >> $logfile
+	rm -vf $(tmpin $seg) >> $logfile 2>&1
+	if [ -n "$next" ]
+	then
+	    wait $prefetch || failed="$failed $next"
+	fi
+	continue
+    fi
+
+    # Run the fitter and write to our log. mpirun's --use-hwthread-cpus and
+    # --oversubscribe options are some chicanery which allows us to run
+    # multiple Parsl-managed fitting tasks on a single node each using the
+    # number of 'CPUs' specified by the SBATCH --cpus-per-task option. A
+    # little unexpected compared to specifiying --ntasks-per-node but the
+    # resource usage looks OK, so:
+
+    echo "Fitting segment $seg with mpirun -np $tasks $DAQBIN/EventEditor..." >> $logfile
+    mpirun --use-hwthread-cpus --oversubscribe -np $tasks \
+	 $DAQBIN/EventEditor \
+	 -s file://$(tmpin $seg) \
+	 -S file://$(tmpout $seg) \
+	 -l /usr/opt/ddastoys/lib/libFitEditorAnalytic.so \
+	 -n $nworkers \
+	 -c 2000 \
+	 -p mpi >> $logfile 2>&1
+    rc=$?
+    rm -vf $(tmpin $seg) >> $logfile 2>&1
+
+    # Move the output to CFS while the next segment is fitted:
+    if [ $rc -eq 0 ]
+    then
+	echo "Moving output for segment $seg..." >> $logfile
+	stage --move $(tmpout $seg) $(output $seg) >> $logfile 2>&1 &
+	movers="$movers $!:$seg"
+    else
+	echo "Fitting segment $seg failed with status $rc" >> $logfile
+	rm -vf $(tmpout $seg) >> $logfile 2>&1
+	failed="$failed $seg"
+    fi
+
+    if [ -n "$next" ]
+    then
+	wait $prefetch || failed="$failed $next"
+    fi
+done
+
+echo "Waiting for output to move and cleaning up..." >> $logfile
+for mover in $movers
+do
+    wait ${mover%:*} || failed="$failed ${mover#*:}"
+done
 echo "... All done" >> $logfile
+
+if [ -n "$failed" ]
+then
+    echo "Failed segments:$failed" | tee -a $logfile
+    exit 1
+fi
+
+exit 0
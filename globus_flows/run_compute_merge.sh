@@ -0,0 +1,69 @@
+#!/bin/bash
+
+##
+# @file run_compute_merge.sh
+# @brief Merge the parts of a run's sorted output written by
+# run_compute_analyze_part.sh into a single sorted file with ROOT's hadd, in
+# a containerized environment. Stage I/O in /tmp space, move staged output to
+# CFS on completion. Log the output.
+# @param 1 Run number.
+#
+
+# Configure the runtime environment in the container, unless a warm worker
+# (container_worker.py) has already done so:
+
+if [ -z "$FRIB_ENV_READY" ]
+then
+    source /usr/opt/root/root-6.24.06/bin/thisroot.sh
+fi
+
+# Stage files with stage.py, which copies large files as several byte ranges
+# in parallel and logs the throughput. Set STAGE_OPTS=--verify, e.g. in the
+# shifter env file, to checksum and verify every copy instead of using the
+# zero-copy in-kernel paths:
+
+stage() { python3 $HOME/globus_flows/stage.py $STAGE_OPTS "$@"; }
+
+# Format input:
+
+run=$1
+fmtrun=$(printf "%04d" $1)
+
+# Set paths. The directories are the container mounts unless overridden,
+# e.g. by a warm worker:
+
+indir=${INPUT_DIR:-/input}
+outdir=${OUTPUT_DIR:-/output}
+parts=$(ls $indir/run-$fmtrun-sorted-p*.root | sort)
+
+tmpout=/tmp/tmpout-$SLURM_JOB_ID-run-$run-sorted.root
+#tmpout=$PSCRATCH/tmpout-$SLURM_JOB_ID-run-$run-sorted.root
+
+logfile=$HOME/globus_flows/flow_logs/merge-run$run-$SLURM_JOB_ID-$SLURMD_NODENAME.out
+cat <<EOF >> $logfile
+JobID   $SLURM_JOB_ID
+Time    $SLURM_JOB_START_TIME
+Node    $SLURMD_NODENAME
+FileIn  $(echo $parts)
+FileOut $outdir/run-$fmtrun-sorted.root
+ROOT    $(which root)
+Image   $SHIFTER_IMAGEREQUEST
+
+EOF
+
+# The parts are read in segment order, so the merged trees are in the same
+# order as a serial analysis:
+echo "Merging $(echo $parts | wc -w) parts..." >> $logfile
+hadd -f $tmpout $parts >> $logfile 2>&1
+status=$?
+
+echo "Moving output and cleaning up..." >> $logfile
+if [ $status -eq 0 ]
+then
+    stage --move $tmpout $outdir/run-$fmtrun-sorted.root >> $logfile 2>&1 \
+	|| status=$?
+fi
+rm -vf $tmpout >> $logfile 2>&1
+echo "... All done" >> $logfile
+
+exit $status
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+##
+# @file stage.py
+# @brief Stage files and directories between CFS and node-local /tmp for the
+# job scripts. Large files are copied as several byte ranges in parallel
+# using in-kernel copies where possible, optionally with a checksum, and the
+# bytes copied and throughput are logged. Must remain compatible with the
+# Python 3.7 in the fribdaq/frib-buster image.
+#
+
+import os
+import sys
+import time
+import errno
+import shutil
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+
+
+CHUNK_SIZE = 64 << 20 # Bytes per parallel range.
+
+# Errors on which an in-kernel copy method is not supported for a pair of
+# files, e.g. copy_file_range across filesystems on older kernels:
+UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+def _copy_file_range(fin, fout, offset, count):
+    return os.copy_file_range(fin, fout, count, offset, offset)
+
+
+def _sendfile(fin, fout, offset, count):
+    os.lseek(fout, offset, os.SEEK_SET)
+    return os.sendfile(fout, fin, offset, count)
+
+
+def _pread_pwrite(fin, fout, offset, count):
+    data = os.pread(fin, min(count, 8 << 20), offset)
+    return os.pwrite(fout, data, offset)
+
+
+# Copy methods in order of preference. copy_file_range is new in Python 3.8:
+METHODS = [
+    (name, fn) for name, fn in (
+        ("copy_file_range", _copy_file_range),
+        ("sendfile", _sendfile),
+        ("read/write", _pread_pwrite)
+    ) if name != "copy_file_range" or hasattr(os, "copy_file_range")
+]
+
+
+class Stager:
+    """Copy files as parallel byte ranges. Without a checksum, each range is
+    copied in the kernel with copy_file_range or sendfile, falling back to
+    read/write where these are not supported. The in-kernel copies never
+    bring the data into user space, so they cannot hash it in the same
+    pass; with a checksum, ranges are copied with pread/pwrite instead and
+    each range is hashed as it is copied. The file checksum is the SHA-256
+    of the concatenated range digests, which depends on the chunk size.
+
+    Attributes
+    ----------
+    threads : int
+        Number of ranges copied in parallel.
+    chunk_size : int
+        Bytes per range.
+    checksum : bool
+        Hash the data as it is copied.
+    verify : bool
+        Re-read each copied file and compare its checksum. Implies
+        checksum.
+    nbytes : int
+        Bytes copied.
+    methods : set
+        Copy methods used.
+    checksums : dict
+        Checksums of the copied files, keyed by destination path.
+
+    Methods
+    -------
+    copy
+        Copy a file or directory.
+    move
+        Move a file or directory, copying it if it is on another filesystem.
+
+    """
+
+    def __init__(
+            self, threads=8, chunk_size=CHUNK_SIZE, checksum=False, verify=False
+    ):
+        """Constructor.
+
+        Parameters
+        ----------
+        threads : int
+            Number of ranges copied in parallel (default=8).
+        chunk_size : int
+            Bytes per range (default=CHUNK_SIZE).
+        checksum : bool
+            Hash the data as it is copied (default=False).
+        verify : bool
+            Re-read each copied file and compare its checksum. Implies
+            checksum (default=False).
+
+        """
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.checksum = checksum or verify
+        self.verify = verify
+        self.nbytes = 0
+        self.methods = set()
+        self.checksums = {}
+        self._lock = threading.Lock()
+
+
+    def copy(self, src, dst):
+        """Copy a file or directory. As for cp -r, a directory copied to an
+        existing directory is copied into it.
+
+        Parameters
+        ----------
+        src : str
+            Source file or directory.
+        dst : str
+            Destination path.
+
+        Returns
+        -------
+        str
+            Path of the copy.
+
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(os.path.normpath(src)))
+
+        files = []
+        if os.path.isdir(src):
+            for root, _, names in os.walk(src):
+                target = os.path.normpath(
+                    os.path.join(dst, os.path.relpath(root, src))
+                )
+                os.makedirs(target, exist_ok=True)
+                files += [
+                    (os.path.join(root, n), os.path.join(target, n))
+                    for n in names
+                ]
+        else:
+            files.append((src, dst))
+
+        # Every range of every file is copied from one pool, so that many
+        # small files are copied in parallel as well as large ones:
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            jobs = {}
+            for s, d in files:
+                size = os.path.getsize(s)
+                fd = os.open(d, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.ftruncate(fd, size)
+                os.close(fd)
+                shutil.copymode(s, d)
+                offsets = range(0, size, self.chunk_size)
+                jobs[(s, d)] = [
+                    pool.submit(self._copy_range, s, d, o) for o in offsets
+                ]
+
+            for (s, d), futures in jobs.items():
+                digests = [f.result() for f in futures]
+                if self.checksum:
+                    self.checksums[d] = self._tree(digests)
+
+            if self.verify:
+                for s, d in files:
+                    offsets = range(0, os.path.getsize(d), self.chunk_size)
+                    digests = [
+                        f.result() for f in
+                        [pool.submit(self._hash_range, d, o) for o in offsets]
+                    ]
+                    if self._tree(digests) != self.checksums[d]:
+                        os.remove(d)
+                        raise IOError(f"Checksum mismatch copying {s} to {d}")
+
+        return dst
+
+
+    def move(self, src, dst):
+        """Move a file or directory, copying it if it is on another
+        filesystem.
+
+        Parameters
+        ----------
+        src : str
+            Source file or directory.
+        dst : str
+            Destination path.
+
+        Returns
+        -------
+        str
+            Path of the moved file or directory.
+
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(os.path.normpath(src)))
+        try:
+            os.rename(src, dst)
+            self.methods.add("rename")
+            return dst
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        dst = self.copy(src, dst)
+        if os.path.isdir(src):
+            shutil.rmtree(src)
+        else:
+            os.remove(src)
+
+        return dst
+
+
+    def _copy_range(self, src, dst, offset):
+        """Copy one range of a file, returning its digest if checksumming.
+
+        """
+        count = min(self.chunk_size, os.path.getsize(src) - offset)
+        end = offset + count
+        fin = os.open(src, os.O_RDONLY)
+        fout = os.open(dst, os.O_WRONLY)
+        try:
+            if self.checksum:
+                h = hashlib.sha256()
+                while offset < end:
+                    data = os.pread(fin, min(end - offset, 8 << 20), offset)
+                    if not data:
+                        raise IOError(f"{src} truncated while copying")
+                    h.update(data)
+                    view = memoryview(data)
+                    while view:
+                        n = os.pwrite(fout, view, offset)
+                        view = view[n:]
+                        offset += n
+                self._count(count, "read/write")
+                return h.digest()
+
+            methods = list(METHODS)
+            while offset < end:
+                name, fn = methods[0]
+                try:
+                    n = fn(fin, fout, offset, end - offset)
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED or len(methods) == 1:
+                        raise
+                    methods.pop(0)
+                    continue
+                if n == 0:
+                    raise IOError(f"{src} truncated while copying")
+                offset += n
+            self._count(count, methods[0][0])
+        finally:
+            os.close(fin)
+            os.close(fout)
+
+
+    def _hash_range(self, path, offset):
+        """Return the digest of one range of a file.
+
+        """
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            f.seek(offset)
+            h.update(f.read(self.chunk_size))
+
+        return h.digest()
+
+
+    def _tree(self, digests):
+        """Return the file checksum from its range digests.
+
+        """
+        return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+    def _count(self, n, method):
+        with self._lock:
+            self.nbytes += n
+            self.methods.add(method)
+
+
+def parse_args():
+    """Parse arguments and return an argparse.Namespace.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Stage files between CFS and node-local storage"
+    )
+    parser.add_argument(
+        "src",
+        type=str,
+        help="Source file or directory."
+    )
+    parser.add_argument(
+        "dst",
+        type=str,
+        help="Destination path. A directory copied to an existing directory "
+        "is copied into it."
+    )
+    parser.add_argument(
+        "-m", "--move",
+        action="store_true",
+        help="Move rather than copy, removing the source."
+    )
+    parser.add_argument(
+        "-t", "--threads",
+        type=int,
+        default=8,
+        help="Number of byte ranges copied in parallel [default=8]."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE >> 20,
+        help=f"Size of each byte range in MB [default={CHUNK_SIZE >> 20}]."
+    )
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="Checksum the data as it is copied. Uses read/write rather "
+        "than in-kernel copies."
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Re-read the copy and compare its checksum. Implies --checksum."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """The main: Stage the source to the destination and log the throughput.
+
+    """
+    args = parse_args()
+    stager = Stager(
+        args.threads, args.chunk_size << 20, args.checksum, args.verify
+    )
+
+    start = time.time()
+    try:
+        dst = (stager.move if args.move else stager.copy)(args.src, args.dst)
+    except OSError as e:
+        sys.exit(f"ERROR: Failed to stage {args.src} to {args.dst}: {e}")
+    elapsed = max(time.time() - start, 1e-6)
+
+    if stager.methods == {"rename"}:
+        print(f"renamed '{args.src}' -> '{dst}'")
+    else:
+        print(
+            f"'{args.src}' -> '{dst}': {stager.nbytes} bytes in "
+            f"{elapsed:.2f} s ({stager.nbytes/elapsed/1e6:.1f} MB/s, "
+            f"{', '.join(sorted(stager.methods))})"
+        )
+    for path, checksum in sorted(stager.checksums.items()):
+        print(f"sha256-tree:{checksum}  {path}")
@@ -20,9 +20,9 @@ logging.basicConfig(
 )
 import os
 import fnmatch
-import time
 
 from globus_compute_sdk import Client
+from batch_results import iter_batch_results
 
 
 def parse_args():
@@ -126,18 +126,13 @@ for s in args.segments:
     )
     
 batch_res = gcc.batch_run(endpoint_id=args.endpoint_id, batch=batch)
-r = gcc.get_batch_result(batch_res["tasks"][str(function_id)])
+task_ids = batch_res["tasks"][str(function_id)]
 
-print(f"INIT: {r}")
+print(f"INIT: {task_ids}")
 
-def check_status(res):
-    for k, v in res.items():
-        if not "completion_t" in v:
-            return False
-    return True
-
-while not check_status(r):
-    time.sleep(5)
-    r = gcc.get_batch_result(batch_res["tasks"][str(function_id)])
+r = {}
+for k, v in iter_batch_results(gcc, task_ids):
+    print(f"TASK: {k} {v}")
+    r[k] = v
 
 print(f"DONE: {r}")
@@ -0,0 +1,127 @@
+##
+# @file:  journal.py
+# @brief: Persistent journal of the run directories seen and triggered by the
+# DirectoryTrigger, so that the watcher can pick up where it left off after
+# a restart.
+#
+
+import time
+import sqlite3
+import threading
+
+
+class RunJournal:
+    """SQLite-backed journal of run directory states. Each run directory
+    moves through the states "seen" (found by the watcher), "triggered"
+    (flow launch started), "launched" (flow run started), and then
+    "completed" (flow run succeeded) or "failed" (flow launch raised or
+    flow run did not succeed). Directories present when the journal is first
+    created are recorded as "skipped" so that history is not reprocessed.
+
+    Attributes
+    ----------
+    path : str
+        Path to the SQLite database file.
+
+    Methods
+    -------
+    is_empty
+        Return True if no run directories have been recorded.
+    record
+        Record the new state of a run directory.
+    states
+        Return the state of every recorded run directory.
+
+    """
+
+    def __init__(self, path):
+        """Constructor. Opens the journal, creating it if necessary.
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database file.
+
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "path TEXT PRIMARY KEY, "
+                "state TEXT NOT NULL, "
+                "run_id TEXT, "
+                "seen_t REAL, "
+                "triggered_t REAL, "
+                "completed_t REAL)"
+            )
+
+
+    def is_empty(self):
+        """Return True if no run directories have been recorded.
+
+        Returns
+        -------
+        bool
+            True if the journal is empty.
+
+        """
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM runs LIMIT 1").fetchone()
+
+        return row is None
+
+
+    def record(self, path, state, run_id=None):
+        """Record the new state of a run directory.
+
+        Parameters
+        ----------
+        path : str
+            Path to the run directory.
+        state : str
+            One of "skipped", "seen", "triggered", "launched", "completed"
+            or "failed".
+        run_id : str
+            Flow run UUID for launched runs (default=None).
+
+        """
+        column = {
+            "seen": "seen_t",
+            "triggered": "triggered_t",
+            "completed": "completed_t",
+            "failed": "completed_t"
+        }.get(state)
+        now = time.time()
+
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO runs (path, state) VALUES (?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state=excluded.state",
+                (path, state)
+            )
+            if column:
+                self._db.execute(
+                    f"UPDATE runs SET {column}=? WHERE path=?", (now, path)
+                )
+            if run_id:
+                self._db.execute(
+                    "UPDATE runs SET run_id=? WHERE path=?", (run_id, path)
+                )
+
+
+    def states(self):
+        """Return the state of every recorded run directory.
+
+        Returns
+        -------
+        dict
+            Run directory states keyed by path.
+
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT path, state FROM runs").fetchall()
+
+        return dict(rows)
@@ -0,0 +1,14 @@
+##
+# @file conftest.py
+# @brief Make the top-level scripts, the helpers installed with the job
+# scripts and the endpoint tools importable by the tests, as the registered
+# functions import the helpers from the globus_flows directory at NERSC.
+#
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "globus_flows"))
+sys.path.insert(0, os.path.join(ROOT, "globus_flows", "ep_launch"))
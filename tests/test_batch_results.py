@@ -0,0 +1,142 @@
+##
+# @file test_batch_results.py
+# @brief Tests of batch task ordering, chunking and partial retries.
+#
+
+import itertools
+
+import pytest
+
+from batch_results import (
+    largest_first, chunk_tasks, failed_segments, run_batch, task_time
+)
+
+
+class FakeBatch:
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, function_id, args, kwargs):
+        self.tasks.append(args)
+
+
+class FakeClient:
+    """Globus Compute client running each task at once with a function of
+    its arguments returning (returncode, stdout, stderr).
+
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.ids = itertools.count()
+        self.results = {}
+        self.submitted = []
+
+    def create_batch(self):
+        return FakeBatch()
+
+    def batch_run(self, endpoint_id, batch):
+        task_ids = []
+        for args in batch.tasks:
+            task_id = f"task{next(self.ids)}"
+            self.submitted.append(args)
+            self.results[task_id] = {
+                "result": self.run(*args), "completion_t": "0"
+            }
+            task_ids.append(task_id)
+
+        return {"tasks": {"function": task_ids}}
+
+    def get_batch_result(self, task_ids):
+        return {k: dict(self.results[k]) for k in task_ids}
+
+
+def test_largest_first(tmp_path):
+    inputs = {}
+    for name, size in ((0, 10), (1, 30), (2, 20), (3, 30)):
+        path = tmp_path / f"{name}.evt"
+        path.write_bytes(b"x"*size)
+        inputs[name] = str(path)
+    inputs[4] = str(tmp_path / "missing.evt")
+
+    assert largest_first(inputs) == [1, 3, 2, 0, 4]
+
+
+def test_chunk_tasks():
+    assert chunk_tasks([5, 4, 3, 2, 1], 2) == [(5, 2), (4, 1), (3,)]
+    assert chunk_tasks([5, 4], 1) == [(5,), (4,)]
+    assert chunk_tasks([5, 4], 0) == [(5,), (4,)]
+    assert chunk_tasks([], 2) == []
+
+
+def test_failed_segments():
+    result = {"result": (1, "x\nFailed segments: 1 03\n", "")}
+    assert failed_segments(result) == [1, 3]
+    assert failed_segments({"result": (1, "x\n", "")}) is None
+    assert failed_segments({"exception": "killed"}) is None
+
+
+def test_task_time():
+    # Callbacks which time the job script return it after the output:
+    assert task_time({"result": (0, "out", "", 12.5)}) == 12.5
+    assert task_time({"result": [0, "out", ""]}) is None
+    assert task_time({"exception": "boom"}) is None
+
+
+def test_failed_task_is_retried():
+    attempts = []
+
+    def run(seg):
+        attempts.append(seg)
+        return (1 if attempts.count(seg) == 1 else 0, "", "")
+
+    gcc = FakeClient(run)
+    results = run_batch(
+        gcc, "endpoint", "function", {0: (0,), 1: (1,)},
+        retry_delay=0, interval=0
+    )
+
+    assert sorted(v["task"] for v in results.values()) == [0, 1]
+    assert all(v["attempts"] == 2 for v in results.values())
+
+
+def test_task_fails_after_max_attempts():
+    gcc = FakeClient(lambda seg: (1, "", "error"))
+    with pytest.raises(RuntimeError):
+        run_batch(
+            gcc, "endpoint", "function", {0: (0,)}, max_attempts=2,
+            retry_delay=0, interval=0
+        )
+    assert len(gcc.submitted) == 2
+
+
+def test_only_failed_segments_are_retried():
+    def run(segs):
+        if 3 in segs and len(segs) > 1:
+            return (1, "Failed segments: 3\n", "")
+        return (0, "", "")
+
+    gcc = FakeClient(run)
+    tasks = {(1, 2, 3): ((1, 2, 3),)}
+    results = run_batch(
+        gcc, "endpoint", "function", tasks, retry_delay=0, interval=0,
+        split=failed_segments, task_args=lambda c: (c,)
+    )
+
+    assert gcc.submitted == [((1, 2, 3),), ((3,),)]
+    assert sorted(v["task"] for v in results.values()) == [(1, 2), (3,)]
+    partial = [v for v in results.values() if "failed" in v]
+    assert partial[0]["failed"] == (3,)
+    assert tasks == {(1, 2, 3): ((1, 2, 3),)}
+
+
+def test_results_are_passed_on_before_a_task_fails():
+    gcc = FakeClient(lambda seg: (0 if seg == 0 else 1, "", ""))
+    recorded = []
+    with pytest.raises(RuntimeError):
+        run_batch(
+            gcc, "endpoint", "function", {0: (0,), 1: (1,)}, max_attempts=2,
+            retry_delay=0, interval=0,
+            on_result=lambda v: recorded.append(v["task"])
+        )
+    assert recorded == [0]
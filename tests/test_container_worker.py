@@ -0,0 +1,42 @@
+##
+# @file test_container_worker.py
+# @brief Tests of the warm container worker's checks on its peers and jobs.
+#
+
+import os
+import json
+import socket
+import threading
+
+from container_worker import (
+    SCRIPT_DIR, WorkerServer, allowed, connect, peer_uid
+)
+
+
+def test_peer_uid():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with a, b:
+        assert peer_uid(a) == os.getuid()
+
+
+def test_allowed():
+    assert allowed(f"{SCRIPT_DIR}/run_compute_fit_mpi.sh")
+    assert not allowed(f"{SCRIPT_DIR}/../evil.sh")
+    assert not allowed("/tmp/run_compute_fit_mpi.sh")
+    assert not allowed(f"{SCRIPT_DIR}/container_worker.py")
+
+
+def test_worker_refuses_other_scripts(monkeypatch):
+    monkeypatch.setenv("SLURM_JOB_ID", f"test-{os.getpid()}")
+    server = WorkerServer("fit", idle=60)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with connect("fit") as sock:
+            request = {"script": "/tmp/evil.sh", "args": [], "env": {}}
+            sock.sendall(json.dumps(request).encode("UTF-8") + b"\n")
+            reply = json.loads(sock.makefile("rb").readline())
+        assert reply[0] == 1
+        assert "Refused" in reply[2]
+    finally:
+        server.shutdown()
+        server.server_close()
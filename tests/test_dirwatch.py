@@ -0,0 +1,153 @@
+##
+# @file test_dirwatch.py
+# @brief Tests of the run directory completion detector and watcher state.
+#
+
+import os
+import time
+import threading
+
+from dirwatch import CompletionDetector, DirectoryTrigger, LaunchPool
+from journal import RunJournal
+
+
+def test_unchanged_directory_completes_after_settle():
+    d = CompletionDetector(settle=0.05)
+    files = {"run-0001-00.evt": (10, 1.0)}
+    assert d.check("run1", files, 1.0) > 0
+    time.sleep(0.06)
+    assert d.check("run1", files, 1.0) == 0
+
+
+def test_change_restarts_settle():
+    d = CompletionDetector(settle=0.05)
+    d.check("run1", {"run-0001-00.evt": (10, 1.0)}, 1.0)
+    time.sleep(0.06)
+    assert d.check("run1", {"run-0001-00.evt": (20, 2.0)}, 1.0) > 0
+
+
+def test_empty_or_copying_directory_is_not_complete():
+    d = CompletionDetector(settle=0.01)
+    files = {"run-0001-00.evt": (10, 1.0), ".run-0001-01.evt.Ab12Cd": (5, 1.0)}
+    assert d.copying(files) == {"run-0001-01.evt"}
+    d.check("run1", {}, 1.0)
+    d.check("run2", files, 1.0)
+    time.sleep(0.02)
+    assert d.check("run1", {}, 1.0) > 0
+    assert d.check("run2", files, 1.0) > 0
+
+
+def test_marker_completes_at_once():
+    d = CompletionDetector(settle=3600, marker="DONE")
+    files = {"run-0001-00.evt": (10, 1.0), "DONE": (0, 1.0)}
+    assert d.check("run1", files, 1.0) == 0
+
+
+def test_idle():
+    d = CompletionDetector(settle=30)
+    assert d.idle("run1") == 0
+    d.check("run1", {}, 1.0)
+    time.sleep(0.02)
+    assert d.idle("run1") >= 0.02
+    d.forget("run1")
+    assert d.idle("run1") == 0
+
+
+def test_stalled_directory_is_not_busy(tmp_path):
+    run = tmp_path / "run1"
+    run.mkdir()
+    (run / ".run-0001-00.evt.Ab12Cd").write_bytes(b"partial")
+    trigger = DirectoryTrigger(
+        str(tmp_path), delay=0.01, interval=0.01, max_backoff=0.01,
+        pool=LaunchPool(), idle_timeout=0.05
+    )
+    trigger.schedule(str(run))
+    trigger.check_pending()
+    assert trigger.busy()
+
+    time.sleep(0.06)
+    trigger.check_pending()
+    assert not trigger.busy()
+    assert trigger.copying_in() == 0
+
+    # Copying resumes:
+    os.rename(run / ".run-0001-00.evt.Ab12Cd", run / "run-0001-00.evt")
+    time.sleep(0.02)
+    trigger.check_pending()
+    assert trigger.busy()
+
+
+def test_pool_runs_in_priority_order():
+    pool = LaunchPool(max_inflight=1, workers=1)
+    gate = pool.submit(time.sleep, 0.05)
+    order = []
+    futures = [
+        pool.submit(order.append, name, priority=priority)
+        for name, priority in (("backfill", 1), ("live", 0))
+    ]
+    for f in [gate] + futures:
+        f.result(timeout=5)
+    assert order == ["live", "backfill"]
+
+
+def test_pool_runs_after_dependencies():
+    pool = LaunchPool(workers=2)
+    order = []
+    first = pool.submit(lambda: (time.sleep(0.05), order.append("first")))
+    pool.submit(order.append, "second", after=[first]).result(timeout=5)
+    assert order == ["first", "second"]
+
+
+def test_full_group_does_not_hold_a_worker():
+    # A backfilled launch waiting for a backfill slot must not block a live
+    # launch queued behind it:
+    pool = LaunchPool(max_inflight=4, workers=2)
+    pool.limit("backfill", 1)
+    release = threading.Event()
+    running = pool.submit(release.wait, 5, priority=1, group="backfill")
+    waiting = pool.submit(lambda: "backfill", priority=1, group="backfill")
+    time.sleep(0.05)
+    live = pool.submit(lambda: "live")
+    assert live.result(timeout=1) == "live"
+    assert not waiting.done()
+    release.set()
+    assert waiting.result(timeout=5) == "backfill"
+    assert running.result(timeout=5)
+
+
+def test_launch_waits_for_flow_runs_to_finish():
+    # A launch held until an earlier flow run finishes must not hold a
+    # worker while it waits:
+    statuses = {"run-1": "ACTIVE"}
+    pool = LaunchPool(
+        max_inflight=4, workers=1, run_statuses=lambda runs: statuses,
+        poll=0.01
+    )
+    segment = pool.submit(lambda: "run-1")
+    finished = pool.finished(segment)
+    analyze = pool.submit(lambda: "run-2", after=[finished])
+    assert pool.submit(lambda: "live").result(timeout=1) == "live"
+    assert not analyze.done()
+
+    statuses["run-1"] = "SUCCEEDED"
+    assert finished.result(timeout=5) == "SUCCEEDED"
+    assert analyze.result(timeout=5) == "run-2"
+    assert pool.finished(pool.submit(lambda: None)).result(timeout=5) is None
+
+
+def test_journal_completes_when_the_flow_run_succeeds(tmp_path):
+    statuses = {"run-1": "ACTIVE"}
+    pool = LaunchPool(run_statuses=lambda runs: statuses, poll=0.01)
+    journal = RunJournal(str(tmp_path / "journal.sqlite"))
+    trigger = DirectoryTrigger(
+        str(tmp_path), delay=0.01, FlowRunner=lambda path: "run-1",
+        journal=journal, pool=pool
+    )
+    run = str(tmp_path / "run1")
+    trigger.trigger(run)
+    time.sleep(0.05)
+    assert journal.states()[run] == "launched"
+
+    statuses["run-1"] = "SUCCEEDED"
+    time.sleep(0.05)
+    assert journal.states()[run] == "completed"
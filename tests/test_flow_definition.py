@@ -0,0 +1,55 @@
+##
+# @file test_flow_definition.py
+# @brief Tests of the generated flow definition and schema.
+#
+
+import json
+import os
+
+from flow_definition import DEFINITION, PIPELINE, build_definition
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load(path):
+    with open(os.path.join(ROOT, path)) as f:
+        return json.load(f)
+
+
+def test_states_are_chained_in_pipeline_order():
+    definition = build_definition()
+    states = definition["States"]
+    name = definition["StartAt"]
+    chain = []
+    while name != "EndFlow":
+        chain.append(name)
+        state = states[name]
+        name = state.get("Next", state.get("Default"))
+
+    assert chain == [stage["state"] for stage in PIPELINE]
+    for name, state in states.items():
+        targets = [state.get("Next"), state.get("Default")]
+        targets += [c["Next"] for c in state.get("Choices", [])]
+        targets += [c["Next"] for c in state.get("Catch", [])]
+        assert all(t in states for t in targets if t), name
+
+
+def test_skip_states():
+    states = build_definition()["States"]
+    transfer = states["CheckTransfer"]["Choices"][0]
+    assert [c["Variable"] for c in transfer["And"]] == ["$.rawdata.skip"] * 2
+    assert transfer["And"][0]["IsPresent"]
+    assert transfer["Next"] == "CheckAnalyze"
+    assert states["CheckAnalyze"]["Choices"][0]["Next"] == "EndFlow"
+
+
+def test_schema_requires_skip_flags():
+    schema = load("transfer_compute/schema.json")
+    for key in ("rawdata", "analyze"):
+        stage = schema["properties"][key]
+        assert "skip" in stage["required"]
+        assert stage["properties"]["skip"]["default"] is False
+
+
+def test_checked_in_files_are_current():
+    assert load(DEFINITION) == build_definition()
@@ -0,0 +1,23 @@
+##
+# @file test_flows_service.py
+# @brief Tests of the login guard of the Globus Flows utilities.
+#
+
+import concurrent.futures
+
+import pytest
+
+pytest.importorskip("globus_sdk")
+
+import flows_service
+
+
+def test_worker_thread_does_not_prompt(monkeypatch):
+    def prompt(*args):
+        raise AssertionError("prompted for a login")
+
+    monkeypatch.setattr("builtins.input", prompt)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        future = pool.submit(flows_service.get_tokens)
+        with pytest.raises(RuntimeError, match="--login"):
+            future.result(timeout=5)
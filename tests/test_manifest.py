@@ -0,0 +1,103 @@
+##
+# @file test_manifest.py
+# @brief Tests of the per-stage output manifests.
+#
+
+import os
+import json
+
+from manifest import MANIFEST, Manifest
+
+VERSION = {"image": "test", "tools": {}}
+
+
+def touch(path, data=b"data"):
+    with open(path, "wb") as f:
+        f.write(data)
+
+    return str(path)
+
+
+def test_missing_entry_is_stale(tmp_path):
+    i = touch(tmp_path / "in.evt")
+    o = touch(tmp_path / "out.evt")
+
+    assert Manifest(str(tmp_path), VERSION).stale(0, [i], o)
+
+
+def test_recorded_output_is_current(tmp_path):
+    i = touch(tmp_path / "in.evt")
+    o = touch(tmp_path / "out.evt")
+    m = Manifest(str(tmp_path), VERSION)
+    m.record(0, [i], o, runtime=1.5)
+    m.save()
+
+    m = Manifest(str(tmp_path), VERSION)
+    assert not m.stale(0, [i], o)
+    assert not m.stale("0", [i], o)
+    assert m.entries["0"]["runtime"] == 1.5
+
+
+def test_changed_input_is_stale(tmp_path):
+    i = touch(tmp_path / "in.evt")
+    o = touch(tmp_path / "out.evt")
+    m = Manifest(str(tmp_path), VERSION)
+    m.record(0, [i], o)
+    m.save()
+
+    touch(i, b"more data")
+    assert Manifest(str(tmp_path), VERSION).stale(0, [i], o)
+
+
+def test_missing_output_is_stale(tmp_path):
+    i = touch(tmp_path / "in.evt")
+    o = touch(tmp_path / "out.evt")
+    m = Manifest(str(tmp_path), VERSION)
+    m.record(0, [i], o)
+    m.save()
+
+    os.remove(o)
+    assert Manifest(str(tmp_path), VERSION).stale(0, [i], o)
+
+
+def test_changed_version_is_stale(tmp_path):
+    i = touch(tmp_path / "in.evt")
+    o = touch(tmp_path / "out.evt")
+    m = Manifest(str(tmp_path), VERSION)
+    m.record(0, [i], o)
+    m.save()
+
+    version = {"image": "other", "tools": {}}
+    assert Manifest(str(tmp_path), version).stale(0, [i], o)
+
+
+def test_save_merges_entries(tmp_path):
+    i = touch(tmp_path / "in.evt")
+    o = touch(tmp_path / "out.evt")
+    a = Manifest(str(tmp_path), VERSION)
+    b = Manifest(str(tmp_path), VERSION)
+    a.record(0, [i], o)
+    b.record(1, [i], o)
+    a.save()
+    b.save()
+
+    with open(tmp_path / MANIFEST) as f:
+        assert sorted(json.load(f)) == ["0", "1"]
+
+
+def test_runs_sharing_a_directory_keep_their_entries(tmp_path):
+    # The analyzed directory holds the output of every run, keyed per run:
+    runs = {}
+    for run in (1, 2):
+        d = tmp_path / f"run{run}"
+        d.mkdir()
+        inputs = [touch(d / f"run-{run:04}-00-fitted.root", b"x"*run)]
+        output = touch(tmp_path / f"run-{run:04}-sorted.root")
+        runs[f"run{run:04}"] = (inputs, output)
+        m = Manifest(str(tmp_path), VERSION)
+        m.record(f"run{run:04}", inputs, output)
+        m.save()
+
+    m = Manifest(str(tmp_path), VERSION)
+    for key, (inputs, output) in runs.items():
+        assert not m.stale(key, inputs, output)
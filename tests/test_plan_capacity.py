@@ -0,0 +1,47 @@
+##
+# @file test_plan_capacity.py
+# @brief Tests of reading the task history from the stage manifests.
+#
+
+import json
+
+from manifest import MANIFEST
+from plan_capacity import fit_model, read_history
+
+
+def write_manifest(directory, entries):
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / MANIFEST, "w") as f:
+        json.dump(entries, f)
+
+
+def entry(size, runtime):
+    return {"inputs": {"in": [size, 1.0]}, "runtime": runtime}
+
+
+def test_per_segment_history_is_grouped_by_run_directory(tmp_path):
+    write_manifest(
+        tmp_path / "run0001", {"0": entry(1e9, 10), "1": entry(2e9, 20)}
+    )
+    write_manifest(tmp_path / "run0002", {"0": entry(1e9, None)})
+
+    history = sorted(read_history(str(tmp_path)))
+    assert history == [(1.0, 10, "run0001"), (2.0, 20, "run0001")]
+
+
+def test_analysis_history_is_keyed_by_run(tmp_path):
+    write_manifest(
+        tmp_path, {"run0001": entry(3e9, 300), "run0002": entry(4e9, 400)}
+    )
+
+    history = sorted(read_history(str(tmp_path), per_segment=False))
+    assert history == [(3.0, 300, "run0001"), (4.0, 400, "run0002")]
+    assert read_history(str(tmp_path / "missing"), per_segment=False) == []
+
+
+def test_fit_model():
+    intercept, slope, sigma = fit_model(
+        [(1.0, 15, "a"), (2.0, 25, "a"), (3.0, 35, "b")]
+    )
+    assert (intercept, slope) == (5.0, 10.0)
+    assert sigma == 0.0
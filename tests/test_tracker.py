@@ -0,0 +1,102 @@
+##
+# @file test_tracker.py
+# @brief Tests of the flow run tracker with an in-memory database and a
+# stub Flows client.
+#
+
+import pytest
+
+pytest.importorskip("globus_sdk")
+
+from tracker import RunTracker, percentile, report
+
+
+class FakeFlowsClient:
+    """Flows client serving runs and their logs from dicts, one run per
+    page of a listing.
+
+    """
+
+    def __init__(self, runs, logs):
+        self.runs = runs
+        self.logs = logs
+        self.fetched = []
+
+    def list_runs(self, filter_flow_id, marker=None, query_params=None):
+        n = marker or 0
+        return {
+            "runs": self.runs[n:n + 1],
+            "has_next_page": n + 1 < len(self.runs),
+            "marker": n + 1
+        }
+
+    def get_run(self, run_id):
+        self.fetched.append(run_id)
+        return {"run_id": run_id, "status": "ACTIVE"}
+
+    def get_run_logs(self, run_id, limit=100, marker=None):
+        return {"entries": self.logs.get(run_id, []), "has_next_page": False}
+
+
+def entry(state, code, t):
+    return {
+        "details": {"state_name": state}, "code": code,
+        "time": f"2026-01-01T00:{t:02}:00Z"
+    }
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile([7], 95) == 7
+    assert percentile(values, 50) == 50.5
+    assert percentile(values, 95) == pytest.approx(95.05)
+
+
+def test_refresh_records_state_latencies():
+    tracker = RunTracker(":memory:")
+    tracker.record("run1", "Run 1", "/data/run1")
+    fc = FakeFlowsClient(
+        [
+            {
+                "run_id": "run1", "status": "SUCCEEDED",
+                "start_time": "2026-01-01T00:00:00Z",
+                "completion_time": "2026-01-01T00:10:00Z"
+            }
+        ],
+        {
+            "run1": [
+                entry("TransferRawData", "ActionStarted", 0),
+                entry("TransferRawData", "ActionCompleted", 2),
+                entry("FitData", "ActionStarted", 2),
+                entry("FitData", "ActionCompleted", 9)
+            ]
+        }
+    )
+
+    assert tracker.refresh(fc=fc) == {"run1": "SUCCEEDED"}
+    durations = tracker.latencies()
+    assert durations["TransferRawData"] == [120]
+    assert durations["FitData"] == [420]
+    assert durations["Total"] == [600]
+    states = [row["state"] for row in report(durations)]
+    assert states == ["TransferRawData", "FitData", "Total"]
+
+
+def test_unlisted_run_is_fetched():
+    tracker = RunTracker(":memory:")
+    fc = FakeFlowsClient([], {})
+
+    assert tracker.refresh(["run2"], fc=fc) == {"run2": "ACTIVE"}
+    assert fc.fetched == ["run2"]
+
+
+def test_finished_run_is_not_fetched_again():
+    tracker = RunTracker(":memory:")
+    fc = FakeFlowsClient(
+        [{"run_id": "run1", "status": "FAILED"}], {}
+    )
+    tracker.refresh(["run1"], fc=fc)
+
+    fc.runs = []
+    assert tracker.refresh(["run1"], fc=fc) == {"run1": "FAILED"}
+    assert fc.fetched == []
@@ -0,0 +1,43 @@
+##
+# @file test_warmer.py
+# @brief Tests of the endpoint warmer with a stub Globus Compute client.
+#
+
+import time
+
+import pytest
+
+pytest.importorskip("globus_sdk")
+
+from warmer import EndpointWarmer
+
+
+class FakeComputeClient:
+    """Compute client counting the tasks it is sent."""
+
+    def __init__(self):
+        self.runs = 0
+
+    def register_function(self, fn, function_name):
+        return "noop"
+
+    def run(self, endpoint_id, function_id):
+        self.runs += 1
+
+
+def test_hold_survives_a_failed_check():
+    checks = []
+
+    def busy():
+        checks.append(1)
+        if len(checks) == 1:
+            raise RuntimeError("boom")
+        return True
+
+    client = FakeComputeClient()
+    warmer = EndpointWarmer(["ep"], interval=0.01, client=client)
+    thread = warmer.hold(busy)
+    time.sleep(0.1)
+    assert thread.is_alive()
+    assert len(checks) > 1
+    assert client.runs > 0
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+##
+# @file:  tracker.py
+# @brief: Track launched flow runs in a SQLite database with the start and
+# end time of each state of the flow, so that the latency of each pipeline
+# stage can be reported. Run statuses are fetched in bulk by listing the
+# flow's runs, and the logs of each run are fetched once, when it finishes.
+#
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+import statistics
+import threading
+import logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s - %(asctime)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+from flows_service import create_flows_client
+
+
+DATABASE = "~/.globus-flows-tracker.sqlite"
+FLOW_ID = "babd88e5-d31d-48c7-b3a0-b765389b5c22"
+TERMINAL = ("SUCCEEDED", "FAILED", "ENDED")
+
+# Stages reported first, in pipeline order; any other states follow:
+STAGES = [
+    "TransferRawData", "FitData", "ConvertData", "AnalyzeData",
+    "TransferPipelineOutput"
+]
+
+
+def parse_time(value):
+    """Return a Flows service timestamp as seconds since the epoch, or None.
+
+    """
+    if not value:
+        return None
+
+    return datetime.datetime.fromisoformat(
+        value.replace("Z", "+00:00")
+    ).timestamp()
+
+
+class RunTracker:
+    """SQLite-backed tracker of flow runs and the timing of their states.
+    Each launched run is recorded with its label and run directory; its
+    status is updated from bulk listings of the flow's runs, and once the
+    run has finished its log is read to record when each state started and
+    ended.
+
+    Attributes
+    ----------
+    path : str
+        Path to the SQLite database file.
+    flow_id : str
+        UUID of the tracked flow.
+
+    Methods
+    -------
+    record
+        Record a launched flow run.
+    refresh
+        Update the status of unfinished runs and the states of finished ones.
+    latencies
+        Return the durations of each state and of whole runs.
+
+    """
+
+    def __init__(self, path, flow_id=FLOW_ID):
+        """Constructor. Opens the database, creating it if necessary.
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite database file.
+        flow_id : str
+            UUID of the tracked flow (default=FLOW_ID).
+
+        """
+        self.path = path
+        self.flow_id = flow_id
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id TEXT PRIMARY KEY, "
+                "label TEXT, "
+                "run_dir TEXT, "
+                "status TEXT, "
+                "launched_t REAL, "
+                "started_t REAL, "
+                "completed_t REAL, "
+                "logged INTEGER DEFAULT 0)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS states ("
+                "run_id TEXT NOT NULL, "
+                "state TEXT NOT NULL, "
+                "status TEXT, "
+                "started_t REAL, "
+                "completed_t REAL, "
+                "PRIMARY KEY (run_id, state))"
+            )
+
+
+    def record(self, run_id, label=None, run_dir=None):
+        """Record a launched flow run.
+
+        Parameters
+        ----------
+        run_id : str
+            Flow run UUID.
+        label : str
+            Flow run label (default=None).
+        run_dir : str
+            Run directory which triggered the flow (default=None).
+
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO runs "
+                "(run_id, label, run_dir, status, launched_t) "
+                "VALUES (?, ?, ?, 'ACTIVE', ?)",
+                (run_id, label, run_dir, time.time())
+            )
+
+
+    def refresh(self, run_ids=None, fc=None, logs=True):
+        """Update the status of unfinished runs from listings of the flow's
+        runs, newest first, stopping once every wanted run has been seen or
+        the listing is older than the oldest of them. Runs which were not
+        listed are fetched one at a time. The log of each run which has
+        finished is then read, once, to record the timing of its states.
+
+        Parameters
+        ----------
+        run_ids : Iterable[str]
+            Flow run UUIDs whose status is wanted. Untracked runs are added.
+            If None, every unfinished tracked run (default=None).
+        fc : FlowsClient
+            Flows client. If None, the process-wide client (default=None).
+        logs : bool
+            Read the logs of finished runs (default=True).
+
+        Returns
+        -------
+        dict
+            Status of each wanted run keyed by run UUID.
+
+        """
+        fc = fc or create_flows_client()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT run_id, status, launched_t FROM runs"
+            ).fetchall()
+        known = {r[0]: (r[1], r[2]) for r in rows}
+
+        if run_ids is None:
+            wanted = {r for r, (s, _) in known.items() if s not in TERMINAL}
+        else:
+            wanted = set(run_ids)
+            for r in wanted - set(known):
+                self.record(r)
+                known[r] = ("ACTIVE", time.time())
+        statuses = {
+            r: known[r][0] for r in wanted if known[r][0] in TERMINAL
+        }
+        pending = wanted - set(statuses)
+        if pending:
+            oldest = min(known[r][1] or 0 for r in pending) - 3600
+
+            marker = None
+            while pending:
+                page = fc.list_runs(
+                    filter_flow_id=self.flow_id, marker=marker,
+                    query_params={"orderby": "start_time DESC"}
+                )
+                for run in page["runs"]:
+                    if run["run_id"] in pending:
+                        self._update(run)
+                        statuses[run["run_id"]] = run["status"]
+                        pending.discard(run["run_id"])
+                last = page["runs"][-1] if page["runs"] else None
+                if (
+                        not page.get("has_next_page")
+                        or not last
+                        or (parse_time(last.get("start_time")) or 0) < oldest
+                ):
+                    break
+                marker = page["marker"]
+
+            for r in pending: # Not listed, e.g. started by another user.
+                run = fc.get_run(r)
+                self._update(run)
+                statuses[r] = run["status"]
+
+        if not logs:
+            return statuses
+
+        with self._lock:
+            unlogged = [
+                r[0] for r in self._db.execute(
+                    "SELECT run_id FROM runs WHERE logged=0 AND status IN "
+                    f"({', '.join('?'*len(TERMINAL))})", TERMINAL
+                ).fetchall()
+            ]
+        for r in unlogged:
+            try:
+                self._read_log(fc, r)
+            except Exception as e:
+                logging.root.warning(f"Cannot read log of flow run {r}: {e}")
+
+        return statuses
+
+
+    def latencies(self, since=None):
+        """Return the durations of each state and of whole runs.
+
+        Parameters
+        ----------
+        since : float
+            Only include runs launched after this time (default=None).
+
+        Returns
+        -------
+        dict
+            Lists of durations in seconds keyed by state name. The time from
+            the start to the end of each successful run, as recorded by the
+            Flows service, is under "Total".
+
+        """
+        where, params = ("", ())
+        if since:
+            where, params = (" AND r.launched_t >= ?", (since,))
+        with self._lock:
+            states = self._db.execute(
+                "SELECT s.state, s.completed_t - s.started_t "
+                "FROM states s JOIN runs r ON s.run_id = r.run_id "
+                "WHERE s.completed_t IS NOT NULL AND s.started_t IS NOT NULL"
+                + where, params
+            ).fetchall()
+            totals = self._db.execute(
+                "SELECT r.completed_t - r.started_t FROM runs r "
+                "WHERE r.status = 'SUCCEEDED' AND r.started_t IS NOT NULL "
+                "AND r.completed_t IS NOT NULL" + where, params
+            ).fetchall()
+
+        durations = {}
+        for state, duration in states:
+            durations.setdefault(state, []).append(duration)
+        durations["Total"] = [t for t, in totals]
+
+        return durations
+
+
+    def _update(self, run):
+        """Store the status and times of a run from the Flows service."""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO runs (run_id, label) VALUES (?, ?)",
+                (run["run_id"], run.get("label"))
+            )
+            self._db.execute(
+                "UPDATE runs SET status=?, started_t=?, completed_t=? "
+                "WHERE run_id=?",
+                (
+                    run["status"], parse_time(run.get("start_time")),
+                    parse_time(run.get("completion_time")), run["run_id"]
+                )
+            )
+
+
+    def _read_log(self, fc, run_id):
+        """Read the whole log of a finished run and store the start and end
+        time of each state.
+
+        """
+        states = {}
+        marker = None
+        while True:
+            page = fc.get_run_logs(run_id, limit=100, marker=marker)
+            for entry in page["entries"]:
+                name = (entry.get("details") or {}).get("state_name")
+                if not name:
+                    continue
+                t = parse_time(entry.get("time"))
+                state = states.setdefault(name, [None, None, None])
+                code = entry.get("code", "")
+                if code.endswith("Started"):
+                    state[0] = state[0] or t
+                elif code.endswith(("Completed", "Succeeded", "Failed")):
+                    state[1] = t
+                    state[2] = "FAILED" if "Failed" in code else "SUCCEEDED"
+            if not page.get("has_next_page"):
+                break
+            marker = page["marker"]
+
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO states "
+                "(run_id, state, status, started_t, completed_t) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(run_id, n, s[2], s[0], s[1]) for n, s in states.items()]
+            )
+            self._db.execute(
+                "UPDATE runs SET logged=1 WHERE run_id=?", (run_id,)
+            )
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values, for integer p.
+
+    """
+    if len(values) == 1:
+        return values[0]
+
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def report(durations):
+    """Log the sample count, p50 and p95 duration of each state.
+
+    Parameters
+    ----------
+    durations : dict
+        Lists of durations in seconds keyed by state name, from
+        RunTracker.latencies.
+
+    Returns
+    -------
+    list of dict
+        The statistics of each state in report order.
+
+    """
+    order = [s for s in STAGES if s in durations]
+    order += sorted(s for s in durations if s not in STAGES + ["Total"])
+    order += ["Total"]
+
+    rows = []
+    logging.root.info(
+        f"{'State':<32}{'Runs':>6}{'p50 (s)':>10}{'p95 (s)':>10}"
+    )
+    for state in order:
+        values = durations.get(state)
+        if not values:
+            continue
+        row = {
+            "state": state,
+            "count": len(values),
+            "p50_s": percentile(values, 50),
+            "p95_s": percentile(values, 95),
+            "mean_s": statistics.fmean(values)
+        }
+        rows.append(row)
+        logging.root.info(
+            f"{state:<32}{row['count']:>6}{row['p50_s']:>10.0f}"
+            f"{row['p95_s']:>10.0f}"
+        )
+
+    return rows
+
+
+def parse_args():
+    """Parse arguments and return an argparse.Namespace.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Report per-stage latencies of the tracked flow runs"
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        default=DATABASE,
+        help=f"Path of the run tracker database [default={DATABASE}]."
+    )
+    parser.add_argument(
+        "--no-refresh",
+        action="store_true",
+        help="Report from the database without first updating unfinished "
+        "runs from the Flows service."
+    )
+    parser.add_argument(
+        "--since",
+        type=float,
+        help="(Optional) Only report runs launched in the last this many "
+        "hours."
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        help="(Optional) Write the statistics to this JSON file."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """The main: Update the tracked runs and report stage latencies.
+
+    """
+    args = parse_args()
+    path = os.path.expanduser(args.database)
+    if not os.path.exists(path):
+        sys.exit(f"ERROR: No run tracker database {path}")
+
+    tracker = RunTracker(path)
+    if not args.no_refresh:
+        tracker.refresh()
+
+    since = time.time() - args.since*3600 if args.since else None
+    rows = report(tracker.latencies(since))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=4)
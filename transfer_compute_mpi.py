@@ -18,14 +18,47 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 import time
+import threading
+import concurrent.futures
 
 import globus_sdk
-from globus_compute_sdk import Client
-from flows_service import create_flows_client
-from dirwatch import DirectoryTrigger
-
-
-def run_flow(event_file=None):
+from flows_service import create_flows_client, create_transfer_client
+from globus_flows.globus_api import compute_client, stats
+from dirwatch import DirectoryTrigger, LaunchPool
+from journal import RunJournal
+from tracker import RunTracker
+from warmer import EndpointWarmer
+
+# Compute endpoints at NERSC for FRIB analysis:
+COMPUTE_FIT_EP_ID      = "ff16dcd1-0632-4fdd-8b0c-d239d4f1b889"
+COMPUTE_CONVERT_EP_ID  = "f4d90d3e-ed80-4aae-b0de-62fdbe2a0739"
+COMPUTE_ANALYSIS_EP_ID = "5080ade8-846b-4964-88a1-2c602d5d38f4"
+
+# Flow and the collections it transfers between:
+FLOW_ID      = "babd88e5-d31d-48c7-b3a0-b765389b5c22"
+FRIB_DTN_ID  = "9656eff2-8105-445c-8501-154dfe1d88e5"
+NERSC_DTN_ID = "9d6d994a-6d04-11e5-ba46-22000b92c6ec"
+
+# Flow runs launched for the segments of each streamed run directory:
+STREAMED_RUNS = {}
+STREAMED_RUNS_LOCK = threading.Lock()
+
+# Tracker of the launched flow runs and the timing of their states:
+TRACKER = None
+TRACKER_LOCK = threading.Lock()
+
+# Endpoint statuses shared by the flow launches in this process, as (check
+# time, online) keyed by endpoint UUID:
+ENDPOINT_STATUS = {}
+ENDPOINT_STATUS_LOCK = threading.Lock()
+
+# Output directories made or found to exist by this process, as (collection
+# UUID, path):
+VERIFIED_DIRS = set()
+VERIFIED_DIRS_LOCK = threading.Lock()
+
+
+def run_flow(event_file=None, segments=None, analyze=True):
     """Configure and run the flow.
 
     Parameters
@@ -33,12 +66,22 @@ def run_flow(event_file=None):
     event_file : str
         Full path of the event file which triggers the flow. For untriggered 
         flows, the event_file is None [default=None]. 
+    segments : list of int
+        Run segments to transfer, fit and convert. All segments if None, no 
+        segments if empty [default=None].
+    analyze : bool
+        Analyze the run and transfer the output back to FRIB [default=True].
 
     Throws
     ------
     RuntimeError
         If any compute endpoints are not online.
 
+    Returns
+    -------
+    str
+        The flow run UUID, or None for a --dry-run.
+
     """
     args = parse_args()
 
@@ -46,8 +89,8 @@ def run_flow(event_file=None):
     # Endpoints for collections #
     #############################
     
-    frib_dtn_id  = "9656eff2-8105-445c-8501-154dfe1d88e5"
-    nersc_dtn_id = "9d6d994a-6d04-11e5-ba46-22000b92c6ec"
+    frib_dtn_id  = FRIB_DTN_ID
+    nersc_dtn_id = NERSC_DTN_ID
 
     ############################################
     # Setup paths for transfer and compute I/O #
@@ -100,9 +143,9 @@ def run_flow(event_file=None):
 
     # Compute endpoints at NERSC for FRIB analysis:
     
-    compute_fit_ep_id      = "ff16dcd1-0632-4fdd-8b0c-d239d4f1b889"
-    compute_convert_ep_id  = "f4d90d3e-ed80-4aae-b0de-62fdbe2a0739"
-    compute_analysis_ep_id = "5080ade8-846b-4964-88a1-2c602d5d38f4"
+    compute_fit_ep_id      = COMPUTE_FIT_EP_ID
+    compute_convert_ep_id  = COMPUTE_CONVERT_EP_ID
+    compute_analysis_ep_id = COMPUTE_ANALYSIS_EP_ID
 
     # Function UUIDs for remote execution on the above endpoints:
     
@@ -110,58 +153,62 @@ def run_flow(event_file=None):
     convert_function_id  = "2be66611-af61-4a9e-a0b2-3407675771c7"
     analysis_function_id = "62f120cd-9249-4124-b9df-44f8e1c44fe1"
     
-    # Check the endpoint status:
+    # Check the endpoint status. The endpoints are checked at once and the
+    # status is reused by launches within --endpoint-status-ttl seconds:
+
+    endpoints = {
+        compute_fit_ep_id: "Trace-fitting",
+        compute_convert_ep_id: "ROOT conversion",
+        compute_analysis_ep_id: "Analysis"
+    }
+    if args.coordinator_endpoint:
+        endpoints[args.coordinator_endpoint] = "Coordinator"
+    online = endpoints_online(endpoints, ttl=args.endpoint_status_ttl)
+    for endpoint_id, label in endpoints.items():
+        if not online[endpoint_id]:
+            raise RuntimeError(
+                f"{label} compute endpoint {endpoint_id} is not online!"
+            )
+
+    # The registered functions only fan the segments out to the endpoints
+    # above and wait for the results. In coordinator mode they run on a
+    # lightweight endpoint outside Slurm so that every allocated node is
+    # running callbacks:
+
+    fit_ep_id      = compute_fit_ep_id
+    convert_ep_id  = compute_convert_ep_id
+    analysis_ep_id = compute_analysis_ep_id
     
-    if not endpoint_online(compute_fit_ep_id):
-        raise RuntimeError(
-            f"Trace-fitting compute endpoint {compute_fit_ep_id} "
-            "is not online!"
-        )
-    if not endpoint_online(compute_convert_ep_id):
-        raise RuntimeError(
-            f"ROOT conversion compute endpoint {compute_convert_ep_id} "
-            "is not online!"
-        )
-    if not endpoint_online(compute_analysis_ep_id):
-        raise RuntimeError(
-            f"Analysis compute endpoint {compute_analysis_ep_id} "
-            "is not online!"
-        )
+    if args.coordinator_endpoint:
+        fit_ep_id      = args.coordinator_endpoint
+        convert_ep_id  = args.coordinator_endpoint
+        analysis_ep_id = args.coordinator_endpoint
 
     ##################
     # Configure flow #
     ##################
         
-    flow_id = "babd88e5-d31d-48c7-b3a0-b765389b5c22"
+    flow_id = FLOW_ID
     fc = create_flows_client(
         flow_id=flow_id, collection_ids=[frib_dtn_id, nersc_dtn_id]
     )
     flow_label = f"FRIB-NERSC Analysis Pipeline Run {run_num}"
+    if segments:
+        flow_label += f" Segment {', '.join(str(s) for s in segments)}"
+
+    # Only the requested segments are transferred, if any are given. The
+    # analysis flow run of a streamed run transfers none, as every segment
+    # has been transferred by its own flow run:
+    
+    include = ["*.evt"]
+    if segments is not None:
+        include = [f"run-{run_num:04}-{s:02}.evt" for s in segments]
 
     # Flow input schema:
 
     flow_input = {
-        "top_rawdata_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": transfer_toplevel
-        },
-        "top_fit_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": fit_toplevel
-        },
-        "top_converted_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": converted_toplevel
-        },
-        "top_analyzed_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": analyzed_toplevel
-        },
-        "compute_log_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": log_path
-        },
         "rawdata": {
+            "skip": segments == [],
             "source": {
                 "id": frib_dtn_id,
                 "path": pipeline_input,
@@ -175,8 +222,9 @@ def run_flow(event_file=None):
 		    "DATA_TYPE": "filter_rule",
 		    "method": "include",
 		    "type": "file",
-		    "name": "*.evt"
-                },
+		    "name": name
+                } for name in include
+            ] + [
                 {
 		    "DATA_TYPE": "filter_rule",
 		    "method": "exclude",
@@ -190,12 +238,8 @@ def run_flow(event_file=None):
             "notify_on_inactive": True,
             "recursive_tx": True
         },
-        "fit_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": fit_path
-        },
         "fit": {
-            "endpoint": compute_fit_ep_id,
+            "endpoint": fit_ep_id,
             "function": fit_function_id,
             "kwargs": {
                 "endpoint_id": compute_fit_ep_id,
@@ -203,12 +247,8 @@ def run_flow(event_file=None):
                 "output_path": fit_path
             },
         },
-        "converted_dir": {
-            "endpoint_id": nersc_dtn_id,
-            "path": converted_path
-        },
         "convert": {
-            "endpoint": compute_convert_ep_id,
+            "endpoint": convert_ep_id,
             "function": convert_function_id,
             "kwargs": {
                 "endpoint_id": compute_convert_ep_id,
@@ -217,7 +257,8 @@ def run_flow(event_file=None):
             },
         },
         "analyze": {
-            "endpoint": compute_analysis_ep_id,
+            "skip": not analyze,
+            "endpoint": analysis_ep_id,
             "function": analysis_function_id,
             "kwargs": {
                 "endpoint_id": compute_analysis_ep_id,
@@ -242,6 +283,71 @@ def run_flow(event_file=None):
         }
     }
 
+    # Output directories, parents first, made here before the flow runs:
+    directories = {
+        "top_rawdata_dir": transfer_toplevel,
+        "top_fit_dir": fit_toplevel,
+        "top_converted_dir": converted_toplevel,
+        "top_analyzed_dir": analyzed_toplevel,
+        "compute_log_dir": log_path,
+        "fit_dir": fit_path,
+        "converted_dir": converted_path
+    }
+    if segments is not None:
+        flow_input["fit"]["kwargs"]["segments"] = segments
+        flow_input["convert"]["kwargs"]["segments"] = segments
+
+    # Failed segments are resubmitted individually up to this many times:
+    for step in ("fit", "convert"):
+        flow_input[step]["kwargs"]["max_attempts"] = args.max_attempts
+        flow_input[step]["kwargs"]["retry_delay"] = args.retry_delay
+
+    # Each task processes several segments in turn, staging the next one
+    # while the current one is processed:
+    if args.segments_per_task > 1:
+        for step in ("fit", "convert"):
+            flow_input[step]["kwargs"]["segments_per_task"] = (
+                args.segments_per_task
+            )
+
+    # Sort groups of segments across the analysis blocks and merge the
+    # parts, rather than sorting the whole run on one node:
+    if args.parallel_analysis:
+        part, merge = args.parallel_analysis
+        flow_input["analyze"]["kwargs"].update({
+            "parallel": True,
+            "segments_per_task": args.analysis_segments_per_task,
+            "part_callback_id": part,
+            "merge_callback_id": merge
+        })
+
+    # Outputs which are current in their stage manifests are skipped unless
+    # reprocessing is forced:
+    if args.force:
+        for step in ("fit", "convert", "analyze"):
+            flow_input[step]["kwargs"]["force"] = True
+
+    # Callbacks registered since the originals, which take the warm keyword
+    # and lists of segments:
+    if args.fit_callback:
+        flow_input["fit"]["kwargs"]["callback_id"] = args.fit_callback
+    if args.convert_callback:
+        flow_input["convert"]["kwargs"]["callback_id"] = (
+            args.convert_callback
+        )
+
+    # Fused fitting also converts each segment, so there is nothing left
+    # for the conversion step to do:
+    if args.fused_callback:
+        flow_input["fit"]["kwargs"]["converted_path"] = converted_path
+        flow_input["fit"]["kwargs"]["fused_callback_id"] = args.fused_callback
+        flow_input["convert"]["kwargs"]["segments"] = []
+
+    # Run the job scripts in one long-lived container per block:
+    if args.warm:
+        for step in ("fit", "convert", "analyze"):
+            flow_input[step]["kwargs"]["warm"] = True
+
     ################
     # Run the flow #
     ################
@@ -256,23 +362,182 @@ def run_flow(event_file=None):
    
     if args.dry_run:
         logging.info(f"Running flow {flow_label} as UUID {flow_id} --dry-run")
-    else:
-        logging.info(f"Running flow {flow_label} as UUID {flow_id}")
-        flow_run_request = fc.run_flow(
-            body=flow_input,
-            label=flow_label,
-            run_monitors=[admins],
-            tags=["Transfer", "Compute", "FRIB"],
+        return None
+    
+    ensure_directories(nersc_dtn_id, list(directories.values()))
+
+    logging.info(f"Running flow {flow_label} as UUID {flow_id}")
+    flow_run_request = fc.run_flow(
+        body=flow_input,
+        label=flow_label,
+        run_monitors=[admins],
+        tags=["Transfer", "Compute", "FRIB"],
+    )
+    logging.debug(f"Globus API calls so far: {stats()}")
+    run_tracker().record(flow_run_request["run_id"], flow_label, event_file)
+
+    return flow_run_request["run_id"]
+
+
+def run_segment_flow(segment_file):
+    """Transfer, fit and convert a single finished run segment. The flow run 
+    is recorded so that the run can be analyzed once all of its segments 
+    have been processed.
+
+    Parameters
+    ----------
+    segment_file : str
+        Full path of the run segment event file, run-NNNN-SS.evt.
+
+    """
+    run_dir = os.path.dirname(segment_file)
+    name = os.path.splitext(os.path.basename(segment_file))[0]
+    seg = int(name.split("-")[-1])
+
+    run_id = None
+    try:
+        run_id = run_flow(run_dir, segments=[seg], analyze=False)
+    finally:
+        # Record failed launches too, the run is reprocessed in full:
+        with STREAMED_RUNS_LOCK:
+            STREAMED_RUNS.setdefault(run_dir, []).append(run_id)
+
+
+def run_stream_flow(event_file):
+    """Analyze a streamed run once its segment flow runs have finished. The 
+    launch pool holds this launch until then, see LaunchPool.finished. If 
+    any segment failed to launch or its flow run did not succeed, the whole 
+    run is processed again by a regular flow run.
+
+    Parameters
+    ----------
+    event_file : str
+        Full path of the run directory which triggers the flow.
+
+    Returns
+    -------
+    str
+        The flow run UUID, or None for a --dry-run.
+
+    """
+    with STREAMED_RUNS_LOCK:
+        run_ids = STREAMED_RUNS.pop(event_file, [])
+
+    statuses = {}
+    if run_ids and all(run_ids):
+        statuses = run_statuses(run_ids)
+    
+    if run_ids and all(statuses.get(r) == "SUCCEEDED" for r in run_ids):
+        logging.root.info(
+            f"All {len(run_ids)} segment flow runs for {event_file} "
+            "succeeded, analyzing the run"
         )
+        return run_flow(event_file, segments=[])
+    
+    logging.root.warning(
+        f"Segment flow runs for {event_file} did not all succeed "
+        f"({statuses}), processing the whole run"
+    )
+    return run_flow(event_file)
+
+
+def run_statuses(run_ids):
+    """Return the current status of flow runs.
+
+    Parameters
+    ----------
+    run_ids : list of str
+        Flow run UUIDs.
+
+    Returns
+    -------
+    dict
+        Run status keyed by run UUID.
+
+    """
+    tracker = run_tracker()
+    
+    return tracker.refresh(run_ids, logs=tracker.path != ":memory:")
+
+
+def run_tracker():
+    """Return the flow run tracker shared by this process, opening it on 
+    first use. With --tracker "", runs are tracked in memory only, to list 
+    their statuses in bulk, and their logs are not read.
+
+    Returns
+    -------
+    RunTracker
+        The shared tracker.
+
+    """
+    global TRACKER
+    with TRACKER_LOCK:
+        if TRACKER is None:
+            path = parse_args().tracker
+            TRACKER = RunTracker(
+                os.path.expanduser(path) if path else ":memory:"
+            )
+
+        return TRACKER
 
         
-def endpoint_online(endpoint_id):
+def login():
+    """Create the Globus clients used to launch and track the flow runs,
+    logging in to any service for which there are no saved tokens. Flow
+    runs are launched from worker threads, which cannot prompt for a login,
+    so this is done by the main thread before any launch.
+
+    """
+    create_flows_client(
+        flow_id=FLOW_ID, collection_ids=[FRIB_DTN_ID, NERSC_DTN_ID]
+    )
+    create_flows_client()
+    create_transfer_client(NERSC_DTN_ID)
+
+
+def ensure_directories(collection_id, paths):
+    """Make directories on a collection unless this process has already
+    made them or found that they exist. Each directory is made with a single
+    mkdir, which is not an error if it exists, and remembered for the life
+    of the process, so the top-level directories are only checked by the
+    first launch.
+
+    Parameters
+    ----------
+    collection_id : str
+        Collection UUID.
+    paths : list of str
+        Directory paths, parents first.
+
+    """
+    with VERIFIED_DIRS_LOCK:
+        missing = [p for p in paths if (collection_id, p) not in VERIFIED_DIRS]
+    if not missing:
+        return
+
+    tc = create_transfer_client(collection_id)
+    for path in missing:
+        try:
+            tc.operation_mkdir(collection_id, path)
+            logging.root.info(f"Created directory {path}")
+        except globus_sdk.TransferAPIError as e:
+            if e.code != "ExternalError.MkdirFailed.Exists":
+                raise
+        with VERIFIED_DIRS_LOCK:
+            VERIFIED_DIRS.add((collection_id, path))
+
+
+def endpoint_online(endpoint_id, ttl=0):
     """Check the endpoint status and return True if it is online.
 
     Parameters
     ----------
     endpoint_id : str
         Endpoing UUID.
+    ttl : float
+        Seconds for which a previous check of the endpoint is reused rather 
+        than asking the service again [default=0].
     
     Returns
     -------
@@ -280,17 +545,52 @@ def endpoint_online(endpoint_id):
         True if the endpoint is online, False otherwise.
 
     """
-    gcc = Client()
-    name = gcc.get_endpoint_metadata(endpoint_id)["name"]
-    hostname = gcc.get_endpoint_metadata(endpoint_id)["hostname"]
+    with ENDPOINT_STATUS_LOCK:
+        checked = ENDPOINT_STATUS.get(endpoint_id)
+    if checked and time.monotonic() - checked[0] < ttl:
+        return checked[1]
+    
+    gcc = compute_client()
+    metadata = gcc.get_endpoint_metadata(endpoint_id)
     status = gcc.get_endpoint_status(endpoint_id)["status"]
     
-    logging.root.info(f"Endpoint {name} on {hostname} status: '{status}'")
+    logging.root.info(
+        f"Endpoint {metadata['name']} on {metadata['hostname']} "
+        f"status: '{status}'"
+    )
 
-    if status != "online":
-        return False
+    online = status == "online"
+    with ENDPOINT_STATUS_LOCK:
+        ENDPOINT_STATUS[endpoint_id] = (time.monotonic(), online)
     
-    return True
+    return online
+
+
+def endpoints_online(endpoint_ids, ttl=0):
+    """Check the status of several endpoints concurrently.
+
+    Parameters
+    ----------
+    endpoint_ids : Iterable[str]
+        Endpoint UUIDs.
+    ttl : float
+        Seconds for which a previous check of an endpoint is reused, see 
+        endpoint_online [default=0].
+
+    Returns
+    -------
+    dict
+        True if the endpoint is online, False otherwise, keyed by UUID.
+
+    """
+    endpoint_ids = list(endpoint_ids)
+    with concurrent.futures.ThreadPoolExecutor(len(endpoint_ids)) as pool:
+        online = pool.map(
+            lambda endpoint_id: endpoint_online(endpoint_id, ttl),
+            endpoint_ids
+        )
+
+        return dict(zip(endpoint_ids, online))
 
 
 def parse_args():
@@ -318,16 +618,152 @@ def parse_args():
         nargs="?",
         default=30,
         help="Delay applied to the flow start in seconds to ensure all "
-        "data is copied in [default=30]. If --rundir is specified, this "
-        "parameter is ignored."
+        "data is copied in [default=30]. The run directory is complete once "
+        "the sizes and modification times of its files have been unchanged "
+        "for this long with no rsync temporary files present. If --rundir "
+        "is specified, this parameter is ignored."
+    )
+    input_group.add_argument(
+        "--marker",
+        type=str,
+        nargs="?",
+        help="Name of a marker file written into the run directory once "
+        "all of its data is copied in. If given, the run is complete as "
+        "soon as the marker exists, without waiting for --trigger-delay. "
+        "Ignored unless --watchdir is specified."
     ) 
     
+    input_group.add_argument(
+        "--watch-pattern",
+        type=str,
+        nargs="+",
+        default=["run*"],
+        help="Shell-style pattern(s) a new directory name must match to "
+        "trigger the flow [default=run*]. Ignored unless --watchdir is "
+        "specified."
+    )
+    input_group.add_argument(
+        "--scan-interval",
+        type=float,
+        nargs="?",
+        default=5,
+        help="Interval in seconds between checks of the watched "
+        "directories' modification times [default=5]. Directories are "
+        "only listed again when their mtime changes."
+    )
+    input_group.add_argument(
+        "--stream",
+        action="store_true",
+        help="Transfer, fit and convert each run segment in its own flow "
+        "run as soon as it has copied in, then analyze the run once all "
+        "of its segments are processed. Ignored unless --watchdir is "
+        "specified."
+    )
+    input_group.add_argument(
+        "--journal",
+        type=str,
+        nargs="?",
+        default="~/.globus-flows-watcher.sqlite",
+        help="Path of the watcher journal recording seen and triggered run "
+        "directories [default=~/.globus-flows-watcher.sqlite]. On restart, "
+        "runs which appeared or were in flight while the watcher was "
+        "stopped are triggered. Pass an empty string to disable the journal. "
+        "Not used with --dry-run."
+    )
+    input_group.add_argument(
+        "--backfill-limit",
+        type=int,
+        nargs="?",
+        default=2,
+        help="Maximum number of concurrent flow launches for runs backfilled "
+        "from the journal on restart [default=2]."
+    )
+    input_group.add_argument(
+        "--max-inflight",
+        type=int,
+        nargs="?",
+        default=4,
+        help="Maximum number of triggered flow runs which may be active at "
+        "once [default=4]. Further launches are queued until a run "
+        "finishes."
+    )
+    input_group.add_argument(
+        "--launch-workers",
+        type=int,
+        nargs="?",
+        default=2,
+        help="Number of threads launching queued flow runs [default=2]."
+    )
+    input_group.add_argument(
+        "--batch-window",
+        type=float,
+        nargs="?",
+        default=0,
+        help="Seconds a run which has copied in is held while other run "
+        "directories are still copying in, so that runs arriving close "
+        "together are launched together and their fit tasks share the "
+        "endpoint blocks started for them [default=0, launch at once]. "
+        "Held runs are launched as soon as no other run is pending."
+    )
+    input_group.add_argument(
+        "--keep-warm",
+        action="store_true",
+        help="While run directories are copying in or flow launches are "
+        "held or queued, send a no-op task to the fit and convert "
+        "endpoints every --keep-warm-interval seconds so that their blocks "
+        "are not released between runs."
+    )
+    input_group.add_argument(
+        "--keep-warm-interval",
+        type=float,
+        nargs="?",
+        default=20,
+        help="Seconds between keep-warm tasks. Must be shorter than the "
+        "endpoints' max_idletime [default=20]."
+    )
+    input_group.add_argument(
+        "--prewarm",
+        action="store_true",
+        help="As soon as a new run directory appears, start keeping the fit "
+        "and convert endpoints warm for --prewarm-hold seconds, so that "
+        "Slurm blocks are provisioned while the data is still copying in "
+        "and transferring to NERSC."
+    )
+    input_group.add_argument(
+        "--prewarm-hold",
+        type=float,
+        nargs="?",
+        default=900,
+        help="Seconds for which the endpoints are kept warm after a new run "
+        "directory appears. Should cover the copy-in and the raw data "
+        "transfer to NERSC [default=900]."
+    )
+    input_group.add_argument(
+        "--idle-timeout",
+        type=float,
+        nargs="?",
+        default=3600,
+        help="Seconds after which a run directory which has not changed but "
+        "is not complete, e.g. an empty directory or one with a leftover "
+        "rsync temporary file, is logged as stalled and no longer keeps the "
+        "endpoints warm or holds a batch. It is still triggered if it "
+        "completes [default=3600]."
+    )
+    input_group.add_argument(
+        "--rescan-interval",
+        type=float,
+        nargs="?",
+        default=300,
+        help="Interval in seconds between forced full listings of the "
+        "watched directories [default=300]."
+    )
+    
     mutex_group = input_group.add_mutually_exclusive_group(required=True)
     mutex_group.add_argument(
         "--watchdir",
         type=str,
-        nargs="?",
-        help="Directory path to watch for filesystem event triggers. "
+        nargs="+",
+        help="Directory path(s) to watch for filesystem event triggers. "
         "Mutually exclusive with --rundir."
     )
     mutex_group.add_argument(
@@ -338,15 +774,157 @@ def parse_args():
         "exclusive with --watchdir."
     )
     
+    parser.add_argument(
+        "--coordinator-endpoint",
+        type=str,
+        nargs="?",
+        help="(Optional) UUID of a lightweight compute endpoint, e.g. "
+        "frib-coordinator, on which to run the fit, convert and analyze "
+        "functions. These functions submit the per-segment work to the "
+        "fit, convert and analysis endpoints and wait for it to finish. "
+        "By default they run on those endpoints and hold a worker while "
+        "waiting."
+    )
+    parser.add_argument(
+        "--endpoint-status-ttl",
+        type=float,
+        default=60,
+        help="(Optional) Seconds for which an endpoint status check is "
+        "reused by later flow launches in the same process, rather than "
+        "checking the endpoint again [default=60]."
+    )
+    parser.add_argument(
+        "--fit-callback",
+        type=str,
+        metavar="UUID",
+        help="(Optional) UUID of the fitting callback, registered with "
+        "fit_mpi.py --register-callback. By default the original "
+        "registration is used, which supports neither --warm nor "
+        "--segments-per-task."
+    )
+    parser.add_argument(
+        "--convert-callback",
+        type=str,
+        metavar="UUID",
+        help="(Optional) UUID of the conversion callback, registered with "
+        "convert.py --register-callback. By default the original "
+        "registration is used, which supports neither --warm nor "
+        "--segments-per-task."
+    )
+    parser.add_argument(
+        "--fused-callback",
+        type=str,
+        metavar="UUID",
+        help="(Optional) Convert each segment to ROOT format on the node "
+        "which fitted it, from the fit output in node-local /tmp, instead "
+        "of in a separate conversion batch, using the fused fit and convert "
+        "callback with this UUID. Register it with fit_mpi.py "
+        "--register-fused-callback."
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="(Optional) Maximum attempts to fit or convert each segment. "
+        "A segment which fails, e.g. due to a node failure or walltime "
+        "kill, is resubmitted on its own [default=3]."
+    )
+    parser.add_argument(
+        "--retry-delay",
+        type=float,
+        default=30,
+        help="(Optional) Seconds before a failed segment is first "
+        "resubmitted, doubling for each further attempt [default=30]."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Fit, convert and analyze every segment, even those whose "
+        "outputs are current in the .manifest.json of each stage directory."
+    )
+    parser.add_argument(
+        "--segments-per-task",
+        type=int,
+        default=1,
+        help="(Optional) Number of segments fitted or converted in turn by "
+        "each task. The next segment is copied to node-local /tmp while "
+        "the current one is processed, and outputs are moved back to CFS "
+        "in the background. Requires --fit-callback and "
+        "--convert-callback, and is ignored with --fused-callback "
+        "[default=1]."
+    )
+    parser.add_argument(
+        "--parallel-analysis",
+        type=str,
+        nargs=2,
+        metavar=("PART_UUID", "MERGE_UUID"),
+        help="(Optional) Sort groups of consecutive segments as separate "
+        "tasks across the analysis endpoint's blocks and merge the sorted "
+        "parts with hadd, instead of sorting the whole run in one task, "
+        "using the part and merge callbacks with these UUIDs. Register "
+        "them with analyze.py --register-part-callback "
+        "--register-merge-callback. Correlations between events on either "
+        "side of a group boundary are lost."
+    )
+    parser.add_argument(
+        "--analysis-segments-per-task",
+        type=int,
+        default=1,
+        help="(Optional) Number of consecutive segments sorted by each task "
+        "of a parallel analysis [default=1]."
+    )
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="Run the fit, convert and analysis job scripts in a warm "
+        "container worker, started once per endpoint block and node, "
+        "instead of a new shifter container for every segment. Requires "
+        "--fit-callback and --convert-callback, or --fused-callback."
+    )
+    parser.add_argument(
+        "--tracker",
+        type=str,
+        default="~/.globus-flows-tracker.sqlite",
+        help="Path of the database recording each launched flow run and "
+        "the start and end of each of its states, for tracker.py "
+        "[default=~/.globus-flows-tracker.sqlite]. Pass an empty string to "
+        "disable."
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Setup the flow without submitting to Globus."
     )
+    parser.add_argument(
+        "--login",
+        action="store_true",
+        help="Log in to the Globus services used by the pipeline, if there "
+        "are no saved tokens, and exit. Run from a terminal before running "
+        "the watcher without one, e.g. from scrontab."
+    )
 
     parser.set_defaults(verbose=True)
+
+    args = parser.parse_args()
+
+    # The original fit and convert callback registrations take neither the
+    # warm keyword nor a list of segments. Fused fitting leaves nothing to
+    # convert:
+    callbacks = args.fused_callback or (
+        args.fit_callback and args.convert_callback
+    )
+    if args.warm and not callbacks:
+        parser.error(
+            "--warm requires --fit-callback and --convert-callback, or "
+            "--fused-callback"
+        )
+    if args.segments_per_task > 1 and not callbacks:
+        parser.error(
+            "--segments-per-task requires --fit-callback and "
+            "--convert-callback"
+        )
     
-    return parser.parse_args()
+    return args
 
 
 if __name__ == "__main__":
@@ -355,14 +933,52 @@ if __name__ == "__main__":
     """
     args = parse_args()
 
+    # Log in up front, as the flow runs are launched from worker threads:
+    try:
+        login()
+    except RuntimeError as e:
+        logging.root.error(e)
+        sys.exit(1)
+    if args.login:
+        sys.exit(0)
+
     # Configure the trigger for starting the pipeline and run it:    
     try:
         if args.watchdir:
+            # A dry run launches nothing, so leaves the journal alone:
+            journal = None
+            if args.journal and not args.dry_run:
+                journal = RunJournal(os.path.expanduser(args.journal))
             trigger = DirectoryTrigger(
-                watch_dir=os.path.expanduser(args.watchdir),
+                watch_dir=[os.path.expanduser(d) for d in args.watchdir],
                 delay=args.trigger_delay,
-                FlowRunner=run_flow
-            )        
+                FlowRunner=run_stream_flow if args.stream else run_flow,
+                patterns=args.watch_pattern,
+                interval=args.scan_interval,
+                rescan=args.rescan_interval,
+                SegmentRunner=run_segment_flow if args.stream else None,
+                journal=journal,
+                backfill_limit=args.backfill_limit,
+                marker=args.marker,
+                batch_window=args.batch_window,
+                idle_timeout=args.idle_timeout,
+                pool=LaunchPool(
+                    max_inflight=args.max_inflight,
+                    workers=args.launch_workers,
+                    run_statuses=None if args.dry_run else run_statuses
+                )
+            )
+            if (args.keep_warm or args.prewarm) and not args.dry_run:
+                warmer = EndpointWarmer(
+                    [COMPUTE_FIT_EP_ID, COMPUTE_CONVERT_EP_ID],
+                    interval=args.keep_warm_interval,
+                    client=compute_client()
+                )
+                warmer.hold(trigger.busy if args.keep_warm else None)
+                if args.prewarm:
+                    trigger.on_new = (
+                        lambda path: warmer.prewarm(args.prewarm_hold)
+                    )
             trigger.run()
         else:
             run_flow()
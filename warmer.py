@@ -0,0 +1,221 @@
+##
+# @file:  warmer.py
+# @brief: Keep Globus Compute endpoint blocks warm from the watcher by
+# submitting no-op tasks, so that runs which are known to be on their way do
+# not each pay the Slurm queue and worker start-up delay.
+#
+
+import time
+import logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s - %(asctime)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+import threading
+
+from globus_flows.globus_api import compute_client
+
+
+# The no-op function is registered once per process, on first use:
+NOOP_FUNCTION_ID = None
+NOOP_LOCK = threading.Lock()
+
+
+def noop():
+    """Keep-warm task. Does nothing, but counts as work for the endpoint so
+    that its idle timer is reset, or a block is provisioned if none is
+    running.
+
+    """
+    return None
+
+
+def noop_function_id(client):
+    """Return the UUID of the registered no-op function, registering it the
+    first time it is needed in this process.
+
+    Parameters
+    ----------
+    client : globus_flows.globus_api.RateLimited
+        Globus Compute client.
+
+    Returns
+    -------
+    str
+        UUID of the no-op function.
+
+    """
+    global NOOP_FUNCTION_ID
+    with NOOP_LOCK:
+        if NOOP_FUNCTION_ID is None:
+            NOOP_FUNCTION_ID = client.register_function(
+                noop, function_name="keep_warm_noop"
+            )
+
+        return NOOP_FUNCTION_ID
+
+
+class EndpointWarmer:
+    """Submit no-op tasks to compute endpoints to keep their blocks from
+    being released while more work is expected. The endpoints release a
+    block once it has been idle for max_idletime (30 s in the endpoint
+    configurations), so the interval must be shorter than this. The tasks
+    are not waited on; a failed submission is logged and otherwise ignored.
+
+    Attributes
+    ----------
+    endpoint_ids : list of str
+        Endpoint UUIDs to keep warm.
+    interval : float
+        Minimum seconds between no-op tasks sent to an endpoint.
+
+    Methods
+    -------
+    warm
+        Send a no-op task to each endpoint not warmed within the interval.
+    prewarm
+        Keep the endpoints warm for a period, starting now.
+    hold
+        Keep the endpoints warm from a background thread while busy or 
+        pre-warming.
+
+    """
+
+    def __init__(self, endpoint_ids, interval=20, client=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        endpoint_ids : Iterable[str]
+            Endpoint UUIDs to keep warm.
+        interval : float
+            Minimum seconds between no-op tasks sent to an endpoint
+            (default=20).
+        client : globus_flows.globus_api.RateLimited
+            Globus Compute client. If None, the rate-limited client shared 
+            by the process is used (default=None).
+
+        """
+        self.endpoint_ids = list(endpoint_ids)
+        self.interval = interval
+
+        self._client = client
+        self._last = {}
+        self._until = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+
+    def warm(self):
+        """Send a no-op task to each endpoint which has not been sent one
+        within the interval. The due endpoints are claimed under the lock
+        and the tasks sent without it, so that a slow or retried API call
+        does not block prewarm.
+
+        Returns
+        -------
+        list of str
+            UUIDs of the endpoints sent a task.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            due = [
+                e for e in self.endpoint_ids
+                if now - self._last.get(e, -self.interval) >= self.interval
+            ]
+            last = {e: self._last.get(e) for e in due}
+            for endpoint_id in due:
+                self._last[endpoint_id] = now
+
+        warmed = []
+        for endpoint_id in due:
+            try:
+                client = self._client or compute_client()
+                self._client = client
+                client.run(
+                    endpoint_id=endpoint_id,
+                    function_id=noop_function_id(client)
+                )
+            except Exception as e:
+                logging.root.warning(
+                    f"Cannot send keep-warm task to {endpoint_id}: {e}"
+                )
+                with self._lock: # Retry at the next check.
+                    if last[endpoint_id] is None:
+                        self._last.pop(endpoint_id, None)
+                    else:
+                        self._last[endpoint_id] = last[endpoint_id]
+                continue
+            warmed.append(endpoint_id)
+
+        if warmed:
+            logging.root.debug(f"Sent keep-warm tasks to {', '.join(warmed)}")
+
+        return warmed
+
+
+    def prewarm(self, seconds):
+        """Keep the endpoints warm for at least the given period, starting
+        now. Does not block; the no-op tasks are sent by the thread started
+        by hold, which must be running.
+
+        Parameters
+        ----------
+        seconds : float
+            Seconds from now for which the endpoints are kept warm.
+
+        """
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + seconds)
+        self._wake.set()
+
+
+    def hold(self, busy=None):
+        """Start a daemon thread which keeps the endpoints warm for as long
+        as busy() returns True or a pre-warm period is running, checking
+        every interval. An error in a check is logged and the thread carries
+        on at the next interval.
+
+        Parameters
+        ----------
+        busy : function
+            Function returning True while more work for the endpoints is
+            expected, e.g. DirectoryTrigger.busy. If None, the endpoints
+            are only kept warm when pre-warmed (default=None).
+
+        Returns
+        -------
+        threading.Thread
+            The started thread.
+
+        """
+        def loop():
+            holding = False
+            while True:
+                try:
+                    with self._lock:
+                        prewarming = time.monotonic() < self._until
+                    if prewarming or (busy and busy()):
+                        if not holding:
+                            logging.root.info(
+                                "More data expected, keeping endpoints "
+                                f"{', '.join(self.endpoint_ids)} warm"
+                            )
+                            holding = True
+                        self.warm()
+                    elif holding:
+                        logging.root.info(
+                            "No more data expected, releasing hold"
+                        )
+                        holding = False
+                except Exception as e:
+                    logging.root.warning(f"Keep-warm check failed: {e}")
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+
+        return thread